@@ -1,2 +1,2 @@
-from controller import CommandLineCaller
+from controller import CommandLineCaller,CommandLinePipeline
 from workerpool import PoolManager
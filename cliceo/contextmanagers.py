@@ -1,4 +1,7 @@
 import os
+import errno
+import fcntl
+import shutil
 import tempfile
 import contextlib2
 from . import tempdir
@@ -36,6 +39,64 @@ def RemoveFileOnExit(fpath):
     unlink(fpath)
 
 
+# ioctl request cloning a file's extents into another file on filesystems
+# with copy-on-write support, e.g. Btrfs and XFS (FICLONE in linux/fs.h)
+FICLONE = 0x40049409
+
+STAGING_METHODS = ('reflink','hardlink','symlink','copy')
+
+# Errors of a staging method that does not work across filesystems, on the
+# filesystem at hand or for the user
+_UNSUPPORTED = frozenset([errno.EXDEV,errno.EOPNOTSUPP,errno.ENOTTY,
+                          errno.EINVAL,errno.EPERM])
+
+def _reflink(src,dst):
+  src_fd = os.open(src,os.O_RDONLY)
+  try:
+    dst_fd = os.open(dst,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o644)
+    try:
+      fcntl.ioctl(dst_fd,FICLONE,src_fd)
+    except (IOError,OSError):
+      os.unlink(dst)
+      raise
+    finally:
+      os.close(dst_fd)
+  finally:
+    os.close(src_fd)
+
+def _symlink(src,dst):
+  os.symlink(os.path.abspath(src),dst)
+
+def _hardlink(src,dst):
+  os.link(src,dst)
+
+_STAGERS = {'reflink':_reflink,'hardlink':_hardlink,'symlink':_symlink,
+            'copy':shutil.copyfile}
+
+def stage_file(src,dst,methods=STAGING_METHODS):
+  '''
+  Make the file at src available at dst by the first of methods that works,
+  returning its name:
+    reflink   copy-on-write clone, taking constant time and space
+    hardlink  second name for the same file on the same filesystem
+    symlink   symbolic link to the absolute path of src
+    copy      full copy of the contents
+  Hard and symbolic links share the contents of src, so only methods
+  'reflink' and 'copy' are safe for programs that modify their inputs.
+  An existing dst is never replaced. Only failures meaning that a method is
+  not supported for src and dst move on to the next method.
+  '''
+  if os.path.lexists(dst):
+    raise OSError(errno.EEXIST,os.strerror(errno.EEXIST),dst)
+  for method in methods:
+    try:
+      _STAGERS[method](src,dst)
+      return method
+    except (IOError,OSError) as e:
+      if method == methods[-1] or e.errno not in _UNSUPPORTED:
+        raise
+
+
 class CLIcontextManager(object):
   def __enter__(self):
     return self
@@ -65,8 +126,21 @@ class CLIcontextManager(object):
                                                              suffix=suffix,
                                                              prefix=prefix))
   
+  def stage_file(self,src,dirpath=None,name=None,methods=STAGING_METHODS):
+    '''
+    Place the existing file at src in dirpath (the working directory by
+    default) under name (the name of src by default) without copying it if
+    possible, see stage_file(), returning the path of the staged file, which
+    is removed on exit
+    '''
+    dst = os.path.join('.' if dirpath is None else dirpath,
+                       os.path.basename(src) if name is None else name)
+    stage_file(src,dst,methods)
+    self.register_for_removal(dst)
+    return dst
+  
   def register_for_removal(self,fpath):
-    self.push(RemoveFileOnExit(fpath))
+    self.exitstack.enter_context(RemoveFileOnExit(fpath))
   
   def random_name(self,dirpath=None,suffix="",prefix=tempfile.template):
     dirpath = '.' if dirpath is None else dirpath
@@ -79,4 +153,6 @@ class CLIcontextManager(object):
   
   def __exit__(self,*exception_details):
     if hasattr(self,'_exitstack'):
-      self._exitstack.close()
+      # Pass on exception details so that registered exit callbacks can tell
+      # whether the context is being left because of an error
+      return self._exitstack.__exit__(*exception_details)
@@ -1,6 +1,86 @@
+import io
 import os
+import sys
+import errno
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+from functools import partial
 from . import contextmanagers
+from . import resources
+from . import mapped
+from . import tracing
+
+
+def _restore_SIGPIPE():
+  # Python ignores SIGPIPE and launched processes inherit that setting, so a
+  # pipeline stage writing to a reader that has exited would not be stopped
+  signal.signal(signal.SIGPIPE,signal.SIG_DFL)
+
+def _chain_preexec(*fns):
+  '''
+  preexec_fn for subprocess.Popen() calling each of fns that is not None
+  '''
+  fns = [fn for fn in fns if fn is not None]
+  def preexec():
+    for fn in fns:
+      fn()
+  return fns[0] if len(fns) == 1 else preexec
+
+def _read_streams(streams):
+  '''
+  Read each stream in streams to EOF concurrently, so that no process writing
+  to one of them blocks on a full pipe, and return the contents in order.
+  None entries yield None.
+  '''
+  contents = [None]*len(streams)
+  def read(i,stream):
+    contents[i] = stream.read()
+    stream.close()
+  threads = [threading.Thread(target=read,args=(i,stream))
+             for i,stream in enumerate(streams) if stream is not None]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return contents
+
+
+class _StdinFeeder(threading.Thread):
+  '''
+  Writes chunks to pipe, the STDIN of a launched process, in a separate
+  thread and closes it when done. Stops early without error if the process
+  exits before reading everything. Any other error is raised by finish().
+  '''
+  def __init__(self,pipe,chunks):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.pipe = pipe
+    self.chunks = chunks
+    self.exc_info = None
+  
+  def run(self):
+    try:
+      for chunk in self.chunks:
+        self.pipe.write(chunk)
+    except IOError as e:
+      if e.errno != errno.EPIPE:
+        self.exc_info = sys.exc_info()
+    except Exception:
+      self.exc_info = sys.exc_info()
+    finally:
+      try:
+        self.pipe.close()
+      except IOError:
+        pass
+  
+  def finish(self):
+    self.join()
+    if self.exc_info is not None:
+      raise self.exc_info[0],self.exc_info[1],self.exc_info[2]
 
 
 class CommandLineCaller(object):
@@ -15,6 +95,26 @@ class CommandLineCaller(object):
                     No default value -- a call string must be provided at
                     initialization
     :param PIDpublisher: Callable for reporting the PID of launched process
+    :param input_source: Data to feed to STDIN of the launched program
+                         May be a string, a file object, or an iterable of
+                         string chunks, e.g. a generator
+                         A file object backed by a file descriptor becomes
+                         the program's STDIN directly; other sources are
+                         written to a pipe while output is being read, so
+                         chunks are pulled from a generator only as fast as
+                         the program consumes them
+    :param nthreads: Number of threads the launched program should use
+                     If not None, thread count environment variables
+                     (OMP_NUM_THREADS etc.) of the launched process are set to
+                     this value
+                     Defaults to the value of class attribute cores_per_task,
+                     which deriving classes may set to declare how many cores
+                     each call needs
+  
+  Deriving classes may also set class attribute resource_classes to the names
+  of the resource classes each call uses, limiting how many calls run at once
+  in a PoolManager (see resources.ResourceGate). Launched programs run at the
+  priority set for those classes.
     
     Temporary working directory control:
       :param in_tmpdir: Boolean flag indicating whether a TemporaryWorkingDirectory
@@ -24,6 +124,24 @@ class CommandLineCaller(object):
                          specified by the OS
                          Ignored if in_tmpdir evaluates to False
     
+    Output file control:
+      :param output_files: Names of files, relative to the working directory,
+                           the program is expected to produce
+                           After the call, attribute 'outputs' maps each name
+                           to a mapped.MappedFile handle through which the file
+                           can be read lazily and released when no longer
+                           needed
+                           Files moved out of a temporary working directory
+                           are owned by their handles, and removed once they
+                           are released or garbage collected
+                           Defaults to the value of class attribute
+                           output_files
+      :param outputs_loc: Location where declared output files produced in a
+                          temporary working directory are moved to be kept
+                          If None, files are moved to the temporary location
+                          specified by the OS
+                          Ignored if in_tmpdir evaluates to False
+    
     STDOUT/STDERR control:
       :param capture_stdout: Boolean flag indicating whether the STDOUT output
                              of created process should be captured
@@ -32,6 +150,13 @@ class CommandLineCaller(object):
       :param silence_stdout: Boolean flag indicating whether the STDOUT output
                              of created process should be redirected to os.devnull
                              Ignored if capture_stdout evaluates to True
+      :param stdout_path: Path of a file to which the STDOUT output of created
+                          process is written directly, without passing through
+                          Python, relative to the working directory (the
+                          temporary one, if in_tmpdir evaluates to True), so it
+                          may also be named in output_files
+                          Takes precedence over capture_stdout and
+                          silence_stdout
       :param err_to_out: Boolean flag indicating whether STDERR output of created
                          process should be redirected to STDOUT (2>&1)
       :param capture_stderr: Boolean flag indicating whether the STDERR output
@@ -43,20 +168,38 @@ class CommandLineCaller(object):
                              of created process should be redirected to os.devnull
                              Ignored if either err_to_out or capture_stdout
                              evaluate to True
+      :param stderr_path: Path of a file to which the STDERR output of created
+                          process is written directly, as with stdout_path
+                          Takes precedence over capture_stderr and
+                          silence_stderr
+                          Ignored if err_to_out evaluates to True
 
   '''
   
+  cores_per_task = None
+  output_files = ()
+  resource_classes = ()
+  
   @classmethod
   def get_CLI_context_manager(cls):
     return contextmanagers.CLIcontextManager()
   
   def __init__(self,callstr,PIDpublisher=None,in_tmpdir=False,tmpdir_loc=None,
                     capture_stdout=False,silence_stdout=False,
-                    err_to_out=False,capture_stderr=False,silence_stderr=False):
+                    err_to_out=False,capture_stderr=False,silence_stderr=False,
+                    input_source=None,nthreads=None,output_files=None,
+                    outputs_loc=None,stdout_path=None,stderr_path=None):
     self.callstr = callstr
     self.PIDpublisher = PIDpublisher
+    self.input_source = input_source
+    self.nthreads = self.cores_per_task if nthreads is None else nthreads
     self.tmpdir = in_tmpdir
     self.tmpdir_loc = tmpdir_loc
+    if output_files is not None:
+      self.output_files = output_files
+    self.outputs_loc = outputs_loc
+    self.stdout_path = stdout_path
+    self.stderr_path = None if err_to_out else stderr_path
     self.cliCM = self.get_CLI_context_manager()
     
     self.stdout = subprocess.PIPE if capture_stdout else False if silence_stdout\
@@ -67,12 +210,66 @@ class CommandLineCaller(object):
       self.stderr = subprocess.PIPE if capture_stderr else False if silence_stderr\
                                                                       else None
   
+  def _popen_kwargs(self):
+    '''
+    Keyword arguments to subprocess.Popen() beyond stream redirection
+    '''
+    kwargs = {'shell':True}
+    if self.nthreads is not None:
+      kwargs['env'] = resources.thread_count_env(self.nthreads)
+    priority = resources.child_priority()
+    if priority is not None:
+      kwargs['preexec_fn'] = partial(resources.apply_priority,*priority)
+    return kwargs
+  
+  def _stdin(self):
+    '''
+    STDIN argument to subprocess.Popen(): None if there is no input source,
+    the input source itself if it is a file with a file descriptor, otherwise
+    subprocess.PIPE
+    '''
+    if self.input_source is None:
+      return None
+    try:
+      self.input_source.fileno()
+      return self.input_source
+    except (AttributeError,IOError,ValueError):
+      return subprocess.PIPE
+  
+  def _input_chunks(self):
+    if isinstance(self.input_source,str):
+      return [self.input_source]
+    elif hasattr(self.input_source,'read'):
+      return iter(lambda: self.input_source.read(io.DEFAULT_BUFFER_SIZE),'')
+    else:
+      return iter(self.input_source)
+  
   def _run(self,callstr):
-    child_p = subprocess.Popen(callstr,stdout=self.stdout,stderr=self.stderr,
-                               shell=True)
+    popen_kwargs = self._popen_kwargs()
+    stdin = self._stdin()
+    if stdin is not None:
+      popen_kwargs['stdin'] = stdin
+    with tracing.span('spawn'):
+      child_p = subprocess.Popen(callstr,stdout=self.stdout,stderr=self.stderr,
+                                 **popen_kwargs)
     if callable(self.PIDpublisher):
       self.PIDpublisher(child_p.pid)
-    self.captured_stdout,self.captured_stderr = child_p.communicate()
+    tracing.begin('program run')
+    if stdin is not subprocess.PIPE:
+      self.captured_stdout,self.captured_stderr = child_p.communicate()
+    elif isinstance(self.input_source,str):
+      self.captured_stdout,self.captured_stderr = child_p.communicate(
+                                                             self.input_source)
+    else:
+      feeder = _StdinFeeder(child_p.stdin,self._input_chunks())
+      feeder.start()
+      self.captured_stdout,self.captured_stderr = _read_streams(
+                                                             [child_p.stdout,
+                                                              child_p.stderr])
+      feeder.finish()
+      child_p.wait()
+    tracing.end('program run')
+    self.returncode = child_p.returncode
   
   def call(self):
     '''
@@ -84,9 +281,55 @@ class CommandLineCaller(object):
     '''
     self._run(self.callstr)
   
+  def result(self):
+    '''
+    Value handed back in place of this controller when it is run by a
+    PoolManager, which sends it from the worker to the parent process.
+    
+    Returns the controller itself. Deriving classes should override this method
+    to return only what the caller needs (e.g. parsed output), sparing the
+    pickling and transfer of the whole controller.
+    '''
+    return self
+  
+  def _keep_outputs(self,exc_type,exc_value,traceback):
+    '''
+    Exit callback collecting declared output files once the call completes
+    successfully. Runs before a temporary working directory is removed.
+    '''
+    if exc_type is not None:
+      return
+    self.outputs = {}
+    for name in self.output_files:
+      if not os.path.isfile(name):
+        raise IOError(errno.ENOENT,'Declared output file was not produced',
+                      name)
+      if self.tmpdir:
+        fd,path = tempfile.mkstemp(prefix='cliceo-',
+                                   suffix='-'+os.path.basename(name),
+                                   dir=self.outputs_loc)
+        os.close(fd)
+        shutil.move(name,path)
+        # Removed with the handle unless it is handed over by pickling, e.g.
+        # when only contents read from it leave a pool worker
+        self.outputs[name] = mapped.MappedFile(path,owner=True)
+      else:
+        self.outputs[name] = mapped.MappedFile(os.path.abspath(name))
+  
   def __call__(self):
     if self.tmpdir:
       self.tmpdir = self.cliCM.enter_tmpdir(self.tmpdir_loc)
+    if self.output_files:
+      self.cliCM.push(self._keep_outputs)
+    
+    # Opened after entering the working directory and closed before declared
+    # outputs are collected
+    if self.stdout_path is not None:
+      self.stdout = open(self.stdout_path,'wb')
+      self.cliCM.push(self.stdout)
+    if self.stderr_path is not None:
+      self.stderr = open(self.stderr_path,'wb')
+      self.cliCM.push(self.stderr)
     
     if self.stdout is False or self.stderr is False:
       devnull = open(os.devnull,'w')
@@ -97,5 +340,99 @@ class CommandLineCaller(object):
         self.stderr = devnull
     
     with self.cliCM:
-      return self.call()
+      result = self.call()
+      tracing.begin('CLI context cleanup')
+    tracing.end('CLI context cleanup')
+    return result
+
 
+class CommandLinePipeline(CommandLineCaller):
+  '''
+  Runs a chain of command line programs connected by OS pipes, each stage's
+  STDOUT feeding the next stage's STDIN, with all stages running concurrently
+  as in a shell pipeline and no intermediate output written to files.
+  
+  Initialization parameters:
+    :param stages: Sequence of pipeline stages, each either a call string or a
+                   CommandLineCaller instance whose callstr, STDERR control and
+                   nthreads are used for that stage
+    All CommandLineCaller initialization parameters are accepted. input_source
+    feeds the first stage, STDOUT control applies to the last stage, STDERR
+    control and nthreads to stages given as call strings, whose STDERR output
+    is written to a single file if stderr_path is given. PIDpublisher is
+    called with a tuple of the PIDs of all stages started so far every time a
+    stage is started.
+  
+  After the call, attribute 'captured_stderr' holds a list with the captured
+  STDERR output of each stage (None for stages whose STDERR was not captured)
+  and attribute 'returncodes' holds the exit status of each stage. If starting
+  or waiting for any stage fails, all stages are killed.
+  '''
+  
+  def __init__(self,stages,**kwargs):
+    CommandLineCaller.__init__(self,None,**kwargs)
+    self.stages = []
+    self._own_stages = []
+    for stage in stages:
+      if not isinstance(stage,CommandLineCaller):
+        stage = CommandLineCaller(stage,nthreads=self.nthreads)
+        stage.stderr = self.stderr
+        self._own_stages.append(stage)
+      self.stages.append(stage)
+    self.callstr = ' | '.join(stage.callstr for stage in self.stages)
+  
+  def _stage_stream(self,stream):
+    if stream is False:
+      if not hasattr(self,'_devnull'):
+        self._devnull = open(os.devnull,'w')
+        self.cliCM.push(self._devnull)
+      return self._devnull
+    return stream
+  
+  def _run(self,callstr):
+    procs = []
+    feeder = None
+    stage_stdin = self._stdin()
+    try:
+      for i,stage in enumerate(self.stages):
+        is_last = i == len(self.stages)-1
+        popen_kwargs = stage._popen_kwargs()
+        popen_kwargs['preexec_fn'] = _chain_preexec(_restore_SIGPIPE,
+                                              popen_kwargs.get('preexec_fn'))
+        # Stages given as call strings follow the pipeline's STDERR control,
+        # resolved to a file when the call started
+        stage_stderr = self.stderr if stage in self._own_stages \
+                                                            else stage.stderr
+        with tracing.span('spawn',stage=i):
+          proc = subprocess.Popen(stage.callstr,stdin=stage_stdin,
+                         stdout=self.stdout if is_last else subprocess.PIPE,
+                                  stderr=self._stage_stream(stage_stderr),
+                                  **popen_kwargs)
+        procs.append(proc)
+        if i == 0:
+          if stage_stdin is subprocess.PIPE:
+            feeder = _StdinFeeder(proc.stdin,self._input_chunks())
+            feeder.start()
+        elif stage_stdin is not None:
+          # The stage just started must hold the only read end of the pipe, so
+          # that the stage writing to it stops if the reader exits early
+          stage_stdin.close()
+        stage_stdin = None if is_last else proc.stdout
+        if callable(self.PIDpublisher):
+          self.PIDpublisher(tuple(p.pid for p in procs))
+      
+      with tracing.span('program run'):
+        outputs = _read_streams([procs[-1].stdout]+[p.stderr for p in procs])
+        if feeder is not None:
+          feeder.finish()
+        self.returncodes = [proc.wait() for proc in procs]
+      self.captured_stdout = outputs[0]
+      self.captured_stderr = outputs[1:]
+    except BaseException:
+      if stage_stdin not in (None,subprocess.PIPE,self.input_source):
+        stage_stdin.close()
+      for proc in procs:
+        resources.kill_process_tree(proc.pid)
+      for proc in procs:
+        proc.wait()
+      raise
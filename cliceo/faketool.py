@@ -0,0 +1,88 @@
+r'''
+Synthetic command line program with controllable behavior, standing in for
+real tools when testing pools at scale:
+
+  python -m cliceo.faketool --runtime 0.05 --runtime-dist exponential \
+                            --output-bytes 4096 --memory-bytes 10000000 \
+                            --fail-rate 0.01 --hang-rate 0.001 \
+                            --seed 7 --task 42
+
+Random choices are drawn from a generator seeded with both --seed and --task,
+so every task behaves the same way on every run.
+'''
+import sys
+import time
+import random
+import argparse
+
+
+RUNTIME_DISTRIBUTIONS = ('fixed','uniform','exponential','lognormal')
+
+def draw_runtime(rng,mean,distribution):
+  '''
+  Runtime in seconds with the given mean, drawn from distribution
+  '''
+  if mean <= 0:
+    return 0.0
+  if distribution == 'fixed':
+    return mean
+  elif distribution == 'uniform':
+    return rng.uniform(0,2*mean)
+  elif distribution == 'exponential':
+    return rng.expovariate(1.0/mean)
+  # Log-normal with sigma 1, heavy tailed like many real tool runtimes
+  return rng.lognormvariate(0,1)*mean/1.6487212707001282 # exp(0.5)
+
+def touch_memory(nbytes,page_size=4096):
+  '''
+  Allocate nbytes and write to every page, so that they count toward RSS
+  '''
+  block = bytearray(nbytes)
+  for i in xrange(0,nbytes,page_size):
+    block[i] = 1
+  return block
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m cliceo.faketool',
+                                   description=__doc__.split('\n\n')[0])
+  parser.add_argument('--runtime',type=float,default=0.0,
+                      help='mean runtime in seconds')
+  parser.add_argument('--runtime-dist',choices=RUNTIME_DISTRIBUTIONS,
+                      default='fixed')
+  parser.add_argument('--output-bytes',type=int,default=0,
+                      help='number of bytes written to STDOUT')
+  parser.add_argument('--memory-bytes',type=int,default=0,
+                      help='memory allocated and held while running')
+  parser.add_argument('--fail-rate',type=float,default=0.0,
+                      help='probability of exiting with status 1')
+  parser.add_argument('--hang-rate',type=float,default=0.0,
+                      help='probability of hanging before finishing')
+  parser.add_argument('--hang-seconds',type=float,default=3600.0,
+                      help='duration of a hang')
+  parser.add_argument('--seed',type=int,default=0)
+  parser.add_argument('--task',type=int,default=0,
+                      help='task number, combined with the seed')
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parse_args(argv)
+  rng = random.Random('%d:%d' % (args.seed,args.task))
+  runtime = draw_runtime(rng,args.runtime,args.runtime_dist)
+  fails = rng.random() < args.fail_rate
+  hangs = rng.random() < args.hang_rate
+  memory = touch_memory(args.memory_bytes)
+  time.sleep(runtime)
+  if hangs:
+    time.sleep(args.hang_seconds)
+  remaining = args.output_bytes
+  line = 'x'*79+'\n'
+  while remaining > 0:
+    sys.stdout.write(line[:remaining] if remaining < len(line) else line)
+    remaining -= len(line)
+  sys.stdout.flush()
+  del memory
+  return 1 if fails else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,383 @@
+'''
+A fleet of worker processes shared by several jobs, so that jobs running at
+the same time never start more than the fleet's number of processes between
+them.
+
+Jobs submitted from the process owning a WorkerFleet share it directly. To
+share one fleet between separately launched processes, e.g. several pipelines
+on one host, run it with serve() in a process of its own and submit jobs to
+the proxy returned by connect().
+'''
+import sys
+import Queue
+import signal
+import cPickle
+import threading
+import multiprocessing
+from multiprocessing.managers import SyncManager,BaseManager,BaseProxy
+from functools import partial
+from tblib import pickling_support
+from .controller import CommandLineCaller
+from .workerpool import init_process_to_ignore_SIGINT
+from . import resources
+from . import mapped
+
+
+def _kill_registered(registered):
+  for pid in resources.registered_PIDs(registered):
+    resources.kill_process_tree(pid)
+
+def _register_PID(PIDregistry,cancelled,job_id,PID):
+  PIDregistry[(job_id,multiprocessing.current_process().name)] = PID
+  # The job may have been cancelled before PID was registered, too late for
+  # the fleet to find it
+  if job_id in cancelled:
+    _kill_registered(PID)
+
+def _run_task(job_id,work_doer,is_controller,kwargs,PIDregistry,cancelled,
+              item):
+  if job_id in cancelled:
+    # The result of a task of a failed job is discarded
+    return None
+  try:
+    if is_controller:
+      caller = work_doer(item,PIDpublisher=partial(_register_PID,PIDregistry,
+                                                   cancelled,job_id),
+                         **kwargs)
+      try:
+        caller()
+      finally:
+        PIDregistry.pop((job_id,multiprocessing.current_process().name),None)
+      result = caller.result()
+    else:
+      result = work_doer(item,**kwargs)
+    # Pickled here, because the pool drops a result it fails to pickle
+    # without ever calling back
+    return mapped._Prepickled(cPickle.dumps(result,cPickle.HIGHEST_PROTOCOL))
+  except Exception:
+    pickling_support.install()
+    return sys.exc_info()
+
+def _is_error(result):
+  return isinstance(result,tuple) and len(result) == 3 and \
+                  isinstance(result[0],type) and issubclass(result[0],Exception)
+
+# Put on the result queue of a job after all its results
+_DONE = object()
+
+
+class FleetJob(object):
+  '''
+  Job submitted to a WorkerFleet with submit(), iterated over like a
+  PoolManager for its results, in no particular order.
+  
+  If a task fails, no further tasks of the job are started, programs launched
+  by its running CommandLineCaller tasks are killed, and the error is raised
+  by the job's iterator, with the failed item's label, if items are labeled,
+  in error_on_label. Other jobs are not affected.
+  '''
+  def __init__(self,job_id,work_doer,sequence_to_map,weight,labeled,kwargs):
+    self.job_id = job_id
+    self.work_doer = work_doer
+    self.is_controller = isinstance(work_doer,type) and \
+                                      issubclass(work_doer,CommandLineCaller)
+    self.kwargs = kwargs
+    self.weight = float(weight)
+    self.labeled = labeled
+    self.tasks = iter(sequence_to_map)
+    self.results = Queue.Queue()
+    # Scheduling state, guarded by the fleet's lock
+    self.virtual_time = 0.0
+    self.outstanding = 0
+    self.exhausted = False
+    self.failed = False
+  
+  def next_task(self):
+    if self.labeled:
+      return next(self.tasks)
+    return None,next(self.tasks)
+  
+  def fail(self,label,exc_info):
+    self.failed = True
+    self.results.put((label,exc_info))
+  
+  def _iterate(self):
+    while True:
+      entry = self.results.get()
+      if entry is _DONE:
+        return
+      label,result = entry
+      if _is_error(result):
+        if self.labeled:
+          self.error_on_label = label
+        raise result[0],result[1],result[2] # Exception type, value, traceback
+      yield (label,result) if self.labeled else result
+  
+  def __iter__(self):
+    if not hasattr(self,'_iterator'):
+      self._iterator = self._iterate()
+    return self._iterator
+  
+  def next(self):
+    return next(self.__iter__())
+
+
+class WorkerFleet(object):
+  '''
+  Pool of numproc worker processes running the tasks of any number of jobs.
+  Tasks are started as workers become free, from the job that has had the
+  least service relative to its weight, so that jobs running at the same time
+  share the fleet in proportion to their weights.
+  
+  Unlike in a PoolManager, workers are started before jobs are known, so the
+  work_doer and keyword arguments of a job, as well as its items, must be
+  picklable, e.g. a module level function or CommandLineCaller subclass.
+  Keyword arguments are pickled with every task, so large read-only ones are
+  best passed as mapped.Broadcast handles.
+  
+  Initialization parameters:
+    :param numproc: Number of worker processes
+                    If None, the number of CPUs
+  '''
+  def __init__(self,numproc=None):
+    self.manager = SyncManager()
+    self.manager.start(initializer=init_process_to_ignore_SIGINT)
+    self.PIDregistry = self.manager.dict()
+    # Ids of failed jobs, none of whose tasks may start or launch programs
+    self.cancelled = self.manager.dict()
+    self.pool = multiprocessing.Pool(numproc,
+                                     initializer=init_process_to_ignore_SIGINT)
+    self.numproc = self.pool._processes
+    self.jobs = []
+    self.in_flight = 0
+    self._job_ids = iter(xrange(sys.maxint))
+    self._closing = False
+    self._cond = threading.Condition()
+    self._scheduler = threading.Thread(target=self._schedule)
+    self._scheduler.daemon = True
+    self._scheduler.start()
+  
+  def submit(self,work_doer,sequence_to_map,weight=1,labeled_items=False,
+             number_seq_items=False,**kwargs):
+    '''
+    Submit a job mapping work_doer, an arbitrary callable or a
+    CommandLineCaller subclass, over sequence_to_map, with the labeling of
+    items as in PoolManager, returning the FleetJob
+    '''
+    if labeled_items and number_seq_items:
+      raise ValueError("Only one of 'labeled_items' and 'number_seq_items' "\
+                       "may be true")
+    if weight <= 0:
+      raise ValueError("'weight' must be positive")
+    # Fail here rather than in the pool's task handling thread
+    cPickle.dumps((work_doer,kwargs),cPickle.HIGHEST_PROTOCOL)
+    if number_seq_items:
+      sequence_to_map = enumerate(sequence_to_map)
+    with self._cond:
+      if self._closing:
+        raise ValueError('Jobs cannot be submitted to a closed fleet')
+      job = FleetJob(next(self._job_ids),work_doer,sequence_to_map,weight,
+                     labeled_items or number_seq_items,kwargs)
+      # A new job starts level with the least served running job rather than
+      # catching up on service received by jobs before it was submitted
+      if self.jobs:
+        job.virtual_time = min(j.virtual_time for j in self.jobs)
+      self.jobs.append(job)
+      self._cond.notify_all()
+    return job
+  
+  def _next_job(self):
+    if self.in_flight >= self.numproc:
+      return None
+    ready = [job for job in self.jobs if not (job.exhausted or job.failed)]
+    if not ready:
+      return None
+    return min(ready,key=lambda job: job.virtual_time)
+  
+  def _finish_if_done(self,job):
+    if (job.exhausted or job.failed) and not job.outstanding and \
+                                                              job in self.jobs:
+      self.jobs.remove(job)
+      if job.failed:
+        # None of its tasks is left to be started
+        self.cancelled.pop(job.job_id,None)
+      else:
+        job.results.put(_DONE)
+  
+  def _schedule(self):
+    with self._cond:
+      while True:
+        job = self._next_job()
+        if job is None:
+          if self._closing and not self.jobs:
+            return
+          self._cond.wait()
+          continue
+        try:
+          label,item = job.next_task()
+        except StopIteration:
+          job.exhausted = True
+          self._finish_if_done(job)
+          continue
+        except Exception:
+          job.fail(None,sys.exc_info())
+          self._cancel(job)
+          self._finish_if_done(job)
+          continue
+        job.outstanding += 1
+        job.virtual_time += 1/job.weight
+        self.in_flight += 1
+        self.pool.apply_async(_run_task,(job.job_id,job.work_doer,
+                                         job.is_controller,job.kwargs,
+                                         self.PIDregistry,self.cancelled,
+                                         item),
+                              callback=partial(self._complete,job,label))
+  
+  def _complete(self,job,label,result):
+    # Called in the pool's result handling thread
+    with self._cond:
+      self.in_flight -= 1
+      job.outstanding -= 1
+      if not job.failed:
+        if _is_error(result):
+          job.fail(label,result)
+          self._cancel(job)
+        else:
+          job.results.put((label,result))
+      self._finish_if_done(job)
+      self._cond.notify_all()
+  
+  def _cancel(self,job):
+    # Cancelled first, so that a task registering a program after its job's
+    # programs are killed kills it itself
+    self.cancelled[job.job_id] = True
+    for (job_id,_),registered in self.PIDregistry.items():
+      if job_id == job.job_id:
+        _kill_registered(registered)
+  
+  def close(self):
+    '''
+    Wait for all submitted jobs to be dispatched and finish, then stop the
+    worker processes
+    '''
+    with self._cond:
+      self._closing = True
+      self._cond.notify_all()
+    self._scheduler.join()
+    self.pool.close()
+    self.pool.join()
+    self.manager.shutdown()
+  
+  def terminate(self):
+    '''
+    Stop the worker processes right away, killing all programs they launched
+    '''
+    try:
+      raise RuntimeError('Worker fleet terminated')
+    except RuntimeError:
+      terminated = sys.exc_info()
+    with self._cond:
+      self._closing = True
+      for job in self.jobs:
+        if not job.failed:
+          job.fail(None,terminated)
+        self.cancelled[job.job_id] = True
+      self.jobs = []
+      self._cond.notify_all()
+    for registered in self.PIDregistry.values():
+      _kill_registered(registered)
+    self.pool.terminate()
+    self.manager.shutdown()
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self,exc_type,exc_value,traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.terminate()
+
+
+class FleetJobProxy(BaseProxy):
+  '''
+  Proxy of a FleetJob submitted through connect(), iterated over like the job
+  itself, with error_on_label set in the same way
+  '''
+  _exposed_ = ('next','__getattribute__')
+  
+  def __iter__(self):
+    return self
+  
+  def next(self):
+    try:
+      return self._callmethod('next')
+    except StopIteration:
+      raise
+    except Exception:
+      exc_info = sys.exc_info()
+      try:
+        self.error_on_label = self._callmethod('__getattribute__',
+                                               ('error_on_label',))
+      except AttributeError:
+        pass
+      raise exc_info[0],exc_info[1],exc_info[2]
+
+
+class FleetProxy(BaseProxy):
+  '''
+  Proxy of a WorkerFleet run by serve() in another process
+  '''
+  _exposed_ = ('submit',)
+  _method_to_typeid_ = {'submit':'FleetJob'}
+  
+  def submit(self,work_doer,sequence_to_map,**kwargs):
+    '''
+    Submit a job as with WorkerFleet.submit(), returning a FleetJobProxy
+    The items of sequence_to_map are sent to the fleet along with the job.
+    '''
+    return self._callmethod('submit',(work_doer,list(sequence_to_map)),
+                            kwargs)
+
+
+class FleetManager(BaseManager):
+  pass
+
+FleetManager.register('get_fleet',proxytype=FleetProxy)
+FleetManager.register('FleetJob',proxytype=FleetJobProxy,create_method=False)
+
+
+def _stop_serving(signum,frame):
+  raise SystemExit
+
+def serve(address,authkey,numproc=None):
+  '''
+  Run a WorkerFleet of numproc worker processes in the current process,
+  serving jobs submitted through connect() with the same address, a socket
+  path or (host,port) pair, and authkey, until SIGINT or SIGTERM, when the
+  fleet is terminated
+  
+  Work doers and keyword arguments of jobs are unpickled in this process, so
+  the modules defining them must be importable here.
+  A job runs to completion even if the process that submitted it goes away.
+  '''
+  workers = WorkerFleet(numproc)
+  try:
+    class Server(FleetManager):
+      pass
+    Server.register('get_fleet',callable=lambda: workers,
+                    proxytype=FleetProxy)
+    server = Server(address=address,authkey=authkey).get_server()
+    signal.signal(signal.SIGTERM,_stop_serving)
+    server.serve_forever()
+  finally:
+    workers.terminate()
+
+def connect(address,authkey):
+  '''
+  FleetProxy of the fleet served at address by serve(), to which jobs are
+  submitted as to a WorkerFleet
+  '''
+  manager = FleetManager(address=address,authkey=authkey)
+  manager.connect()
+  return manager.get_fleet()
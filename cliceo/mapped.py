@@ -0,0 +1,222 @@
+import os
+import mmap
+import cPickle
+import tempfile
+
+
+class MappedFile(object):
+  '''
+  Handle to a file that is read lazily through a read-only memory map.
+  
+  A handle holds little more than the file path, so it is cheap to pickle and
+  send to another process. A handle that owns the file removes it when
+  release() is called or, failing that, when the handle is garbage collected.
+  Handles created directly own the file only if owner is true; pickling a
+  handle hands ownership over to the handle created by unpickling it.
+  '''
+  def __init__(self,path,owner=False):
+    self.path = path
+    self._map = None
+    self._owner = owner
+  
+  def __getstate__(self):
+    self._owner = False
+    return {'path':self.path}
+  
+  def __setstate__(self,state):
+    self.__dict__.update(state)
+    self._map = None
+    self._owner = True
+  
+  @property
+  def size(self):
+    return os.path.getsize(self.path)
+  
+  def open(self,mode='rb'):
+    return open(self.path,mode)
+  
+  def mmap(self):
+    '''
+    Read-only memory map of the file contents, supporting slicing without
+    reading the whole file. An empty file is mapped to an empty string.
+    '''
+    if self._map is None:
+      with open(self.path,'rb') as fh:
+        if os.fstat(fh.fileno()).st_size:
+          self._map = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+          self._map = ''
+    return self._map
+  
+  def read(self):
+    return self.mmap()[:]
+  
+  def close(self):
+    if self._map is not None:
+      if not isinstance(self._map,str):
+        self._map.close()
+      self._map = None
+  
+  def release(self):
+    '''
+    Close the memory map and remove the file
+    '''
+    self.close()
+    self._owner = False
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self,*exception_details):
+    self.release()
+  
+  def __del__(self):
+    if getattr(self,'_owner',False):
+      self.release()
+
+
+class SpilledResult(MappedFile):
+  '''
+  Handle to a result written to a spill file by spill_if_large()
+  
+  A spilled string can be read in place through mmap(); any other object is
+  stored pickled and must be restored with load().
+  '''
+  def __init__(self,path,pickled):
+    MappedFile.__init__(self,path)
+    self.pickled = pickled
+  
+  def __getstate__(self):
+    state = MappedFile.__getstate__(self)
+    state['pickled'] = self.pickled
+    return state
+  
+  def load(self):
+    '''
+    Restore the spilled result and release the spill file
+    '''
+    try:
+      if self.pickled:
+        with self.open() as fh:
+          return cPickle.load(fh)
+      return self.read()
+    finally:
+      self.release()
+
+
+class Broadcast(MappedFile):
+  '''
+  Read-only value shared by the processes of a pool without a copy per
+  process.
+  
+  A string, bytearray or buffer is written to a file once and read through a
+  shared memory map, so views of it in all processes share the same physical
+  pages of the page cache. Any other value gains nothing from broadcasting: it
+  is held by the handle itself, and worker processes forked after the handle
+  was created share it copy-on-write as they would any other object of their
+  parent. Only if the handle is pickled, e.g. to be sent to an already running
+  process, is such a value pickled to a file, to be loaded once per unpickled
+  handle on first access to value.
+  
+  Unlike other handles, an unpickled Broadcast never removes the file; the
+  creator must call release(), or use the Broadcast as a context manager.
+  '''
+  def __init__(self,value,dirpath=None):
+    self.dirpath = dirpath
+    if isinstance(value,(str,bytearray,buffer)):
+      MappedFile.__init__(self,self._write(value))
+      self.pickled = False
+      self._loaded = False
+    else:
+      # Written to a file only when pickled
+      MappedFile.__init__(self,None)
+      self.pickled = True
+      self._value = value
+      self._loaded = True
+  
+  def _write(self,data):
+    fd,path = tempfile.mkstemp(prefix='cliceo-broadcast-',dir=self.dirpath)
+    with os.fdopen(fd,'wb') as fh:
+      fh.write(data)
+    return path
+  
+  def __getstate__(self):
+    if self.path is None:
+      self.path = self._write(cPickle.dumps(self._value,
+                                            cPickle.HIGHEST_PROTOCOL))
+    return {'path':self.path,'pickled':self.pickled}
+  
+  def __setstate__(self,state):
+    MappedFile.__setstate__(self,state)
+    self._owner = False
+    self._loaded = False
+  
+  def view(self):
+    '''
+    Memory map of a broadcast string or buffer, supporting slicing and
+    searching without copying it into the process
+    '''
+    if self.pickled:
+      raise ValueError('Only a broadcast string or buffer can be viewed in '\
+                       'place')
+    return self.mmap()
+  
+  @property
+  def value(self):
+    if not self.pickled:
+      return self.view()
+    if not self._loaded:
+      with self.open() as fh:
+        self._value = cPickle.load(fh)
+      self._loaded = True
+    return self._value
+  
+  def release(self):
+    '''
+    Close the memory map, remove any file and drop a value held in memory
+    '''
+    if self.path is not None:
+      MappedFile.release(self)
+    if self.pickled:
+      self._value = None
+      self._loaded = False
+
+
+class _Prepickled(object):
+  '''
+  Object already pickled to a string, re-pickled at the cost of copying that
+  string and restored to the original object on unpickling
+  '''
+  __slots__ = ('data',)
+  
+  def __init__(self,data):
+    self.data = data
+  
+  def __reduce__(self):
+    return (cPickle.loads,(self.data,))
+
+
+def spill_if_large(obj,threshold,dirpath=None):
+  '''
+  Return obj unchanged in effect if its serialized size is below threshold
+  bytes, otherwise write it to a spill file in dirpath (system temporary
+  location by default) and return a SpilledResult handle to that file.
+  
+  Strings are written as-is, anything else is pickled. A small object is
+  returned in its pickled form so that it is not pickled a second time on
+  its way to another process.
+  '''
+  if isinstance(obj,str):
+    data,pickled = obj,False
+  else:
+    data,pickled = cPickle.dumps(obj,cPickle.HIGHEST_PROTOCOL),True
+  if len(data) < threshold:
+    return _Prepickled(data) if pickled else obj
+  fd,path = tempfile.mkstemp(prefix='cliceo-spill-',dir=dirpath)
+  with os.fdopen(fd,'wb') as fh:
+    fh.write(data)
+  return SpilledResult(path,pickled)
@@ -0,0 +1,388 @@
+import os
+import time
+import threading
+import collections
+import psutil
+
+
+# Environment variables through which the common threading runtimes (OpenMP,
+# OpenBLAS, MKL, Accelerate, numexpr) are told how many threads to start
+THREAD_COUNT_ENV_VARS = ('OMP_NUM_THREADS','OPENBLAS_NUM_THREADS',
+                         'MKL_NUM_THREADS','VECLIB_MAXIMUM_THREADS',
+                         'NUMEXPR_NUM_THREADS')
+
+def thread_count_env(nthreads,base_env=None):
+  '''
+  Copy of base_env (os.environ by default) with every variable in
+  THREAD_COUNT_ENV_VARS set to nthreads
+  '''
+  env = dict(os.environ if base_env is None else base_env)
+  env.update((var,str(nthreads)) for var in THREAD_COUNT_ENV_VARS)
+  return env
+
+def set_thread_count(nthreads):
+  '''
+  Set thread count variables in the environment of the current process, to be
+  inherited by every process it launches
+  '''
+  os.environ.update(thread_count_env(nthreads,{}))
+
+def available_cpus():
+  try:
+    return sorted(psutil.Process().cpu_affinity())
+  except (AttributeError,NotImplementedError):
+    # Platforms without affinity support
+    return range(psutil.cpu_count())
+
+def partition_cpus(cores_per_task,cpus=None):
+  '''
+  Split cpus (all CPUs available to this process by default) into disjoint
+  slots of cores_per_task CPUs each. Leftover CPUs are not assigned to a slot.
+  '''
+  if cores_per_task < 1:
+    raise ValueError("'cores_per_task' must be a positive integer")
+  cpus = available_cpus() if cpus is None else list(cpus)
+  return [cpus[i:i+cores_per_task]
+          for i in xrange(0,len(cpus)-cores_per_task+1,cores_per_task)]
+
+def pin_current_process(cpus):
+  psutil.Process().cpu_affinity(list(cpus))
+
+def registered_PIDs(registered):
+  '''
+  PIDs in a PID registry value, which is a single PID or, for a pipeline of
+  processes, a tuple of PIDs
+  '''
+  return registered if isinstance(registered,tuple) else (registered,)
+
+def kill_process_tree(pid):
+  try:
+    top_proc = psutil.Process(pid=pid)
+    children = top_proc.children(recursive=True)
+    for proc in [top_proc]+children:
+      try:
+        proc.kill()
+      except psutil.NoSuchProcess:
+        pass
+  except psutil.NoSuchProcess:
+    pass
+
+def process_tree_rss(pid):
+  '''
+  Total resident memory of process pid, which may also be a tuple of PIDs, and
+  all of their descendants
+  '''
+  procs = []
+  for single_pid in registered_PIDs(pid):
+    try:
+      top_proc = psutil.Process(pid=single_pid)
+      procs.extend([top_proc]+top_proc.children(recursive=True))
+    except psutil.NoSuchProcess:
+      pass
+  total = 0
+  for proc in procs:
+    try:
+      total += proc.memory_info().rss
+    except psutil.NoSuchProcess:
+      pass
+  return total
+
+
+class MemoryGate(object):
+  '''
+  Admission control delaying the start of a task while running it could
+  exhaust memory. Each admitted task reserves its estimated memory until it is
+  released; a task is admitted only if
+    - the reserved estimates plus the new estimate do not exceed memory_budget,
+      where a running task whose registered process tree (see PIDregistry)
+      already uses more than its estimate is counted at its actual RSS, and
+    - system available memory, less the not yet used portion of reservations
+      and the new estimate, stays above min_available
+  A task is always admitted when no other task holds a reservation, so a job
+  degrades to serial execution rather than stalling.
+  
+  Initialization parameters:
+    :param manager: Started multiprocessing SyncManager providing the lock and
+                    dict shared by gate copies in all worker processes
+    :param task_memory: Estimated memory in bytes needed by each task, or a
+                        callable returning the estimate given a task argument
+    :param memory_budget: Maximum memory in bytes all running tasks together
+                          may use
+    :param min_available: Minimum system available memory in bytes
+    :param PIDregistry: Mapping of worker process name to the PID of the
+                        process that worker launched
+    :param poll_interval: Seconds between admission attempts
+  '''
+  def __init__(self,manager,task_memory=0,memory_budget=None,
+               min_available=None,PIDregistry=None,poll_interval=0.5):
+    self.lock = manager.Lock()
+    self.reservations = manager.dict()
+    self.task_memory = task_memory
+    self.memory_budget = memory_budget
+    self.min_available = min_available
+    self.PIDregistry = PIDregistry
+    self.poll_interval = poll_interval
+  
+  def estimate(self,arg):
+    return self.task_memory(arg) if callable(self.task_memory)\
+                                                          else self.task_memory
+  
+  def _in_use(self,name):
+    if self.PIDregistry is None:
+      return 0
+    pid = self.PIDregistry.get(name)
+    return 0 if pid is None else process_tree_rss(pid)
+  
+  def _fits(self,estimate):
+    reservations = self.reservations.copy()
+    if not reservations:
+      return True
+    in_use = dict((name,self._in_use(name)) for name in reservations)
+    if self.memory_budget is not None:
+      committed = sum(max(in_use[name],reserved)
+                      for name,reserved in reservations.iteritems())
+      if committed+estimate > self.memory_budget:
+        return False
+    if self.min_available is not None:
+      unclaimed = sum(max(reserved-in_use[name],0)
+                      for name,reserved in reservations.iteritems())
+      available = psutil.virtual_memory().available
+      if available-unclaimed-estimate < self.min_available:
+        return False
+    return True
+  
+  def acquire(self,name,arg,proceed):
+    '''
+    Block until the task with argument arg, about to run in worker process
+    name, is admitted. Returns False without reserving anything if
+    proceed.value turns False while waiting.
+    '''
+    estimate = self.estimate(arg)
+    while proceed.value:
+      with self.lock:
+        if self._fits(estimate):
+          self.reservations[name] = estimate
+          return True
+      time.sleep(self.poll_interval)
+    return False
+  
+  def release(self,name):
+    self.reservations.pop(name,None)
+
+
+class ConcurrencyGate(object):
+  '''
+  Admission control limiting the number of tasks running at once to a target
+  that may be changed at any time with resize(), e.g. by an Autoscaler.
+  Worker processes beyond the target wait, idle, before starting their task.
+  
+  Initialization parameters:
+    :param manager: Started multiprocessing SyncManager providing the shared
+                    state of gate copies in all worker processes
+    :param target: Initial maximum number of tasks running at once
+    :param poll_interval: Seconds between admission attempts
+  '''
+  def __init__(self,manager,target,poll_interval=0.1):
+    self.lock = manager.Lock()
+    self.target = manager.Value('i',target)
+    self.running = manager.dict()
+    self.poll_interval = poll_interval
+  
+  def resize(self,target):
+    self.target.value = target
+  
+  def acquire(self,name,arg,proceed):
+    while proceed.value:
+      with self.lock:
+        if len(self.running) < self.target.value:
+          self.running[name] = True
+          return True
+      time.sleep(self.poll_interval)
+    return False
+  
+  def release(self,name):
+    self.running.pop(name,None)
+
+
+class ResourceGate(object):
+  '''
+  Admission control limiting, for each of a set of named resource classes, the
+  number of running tasks that use it, e.g. at most 4 tasks reading heavily
+  from local disk and 2 running a license-limited program, while tasks using
+  none of them run freely. A task is admitted once every class it uses has
+  capacity left and takes all of them at once, so that it never holds one
+  class while waiting for another.
+  
+  Each class may also set the priority of programs launched by
+  CommandLineCallers while a task holding it runs (see child_priority()).
+  
+  Initialization parameters:
+    :param manager: Started multiprocessing SyncManager providing the lock and
+                    dict shared by gate copies in all worker processes
+    :param limits: Mapping of resource class name to the maximum number of
+                   tasks using it that may run at once
+    :param task_classes: Names of the classes every task uses, or a callable
+                         returning the names given a task argument
+    :param priorities: Mapping of resource class name to a dictionary with
+                       keys 'nice', a niceness increment, and/or 'ionice', an
+                       (I/O scheduling class, level) pair as taken by
+                       psutil.Process.ionice()
+                       A task using several classes gets the lowest of their
+                       priorities
+    :param poll_interval: Seconds between admission attempts
+  '''
+  def __init__(self,manager,limits,task_classes=(),priorities=None,
+               poll_interval=0.1):
+    self.check(limits,task_classes,priorities)
+    self.limits = dict(limits)
+    self.priorities = dict(priorities or {})
+    self.task_classes = task_classes
+    self.lock = manager.Lock()
+    self.held = manager.dict()
+    self.poll_interval = poll_interval
+  
+  @staticmethod
+  def check(limits,task_classes=(),priorities=None):
+    '''
+    Raise ValueError unless limits are positive and all classes named in
+    task_classes, unless it is callable, and priorities have a limit
+    '''
+    if any(limit < 1 for limit in limits.values()):
+      raise ValueError('Resource class limits must be positive integers')
+    named = list(priorities or ())
+    if not callable(task_classes):
+      named.extend(task_classes)
+    for name in named:
+      if name not in limits:
+        raise ValueError('Unknown resource class %r' % (name,))
+  
+  def classes(self,arg):
+    classes = tuple(self.task_classes(arg) if callable(self.task_classes)
+                    else self.task_classes)
+    self.check(self.limits,classes)
+    return classes
+  
+  def priority(self,classes):
+    '''
+    (nice,ionice) priority of programs launched by a task using classes, or
+    None if no class sets one
+    '''
+    nice = [self.priorities[name]['nice'] for name in classes
+            if 'nice' in self.priorities.get(name,{})]
+    ionice = [tuple(self.priorities[name]['ionice']) for name in classes
+              if 'ionice' in self.priorities.get(name,{})]
+    if not (nice or ionice):
+      return None
+    # Higher I/O scheduling class and level numbers mean lower priority
+    return (max(nice) if nice else None,max(ionice) if ionice else None)
+  
+  def _has_capacity(self,classes):
+    in_use = collections.Counter(name for held in self.held.values()
+                                 for name in held)
+    return all(in_use[name] < self.limits[name] for name in classes)
+  
+  def acquire(self,name,arg,proceed):
+    classes = self.classes(arg)
+    if not classes:
+      return True
+    while proceed.value:
+      with self.lock:
+        if self._has_capacity(classes):
+          self.held[name] = classes
+          set_child_priority(self.priority(classes))
+          return True
+      time.sleep(self.poll_interval)
+    return False
+  
+  def release(self,name):
+    self.held.pop(name,None)
+    set_child_priority(None)
+
+
+# (nice,ionice) priority of programs launched from the current process
+_child_priority = None
+
+def set_child_priority(priority):
+  global _child_priority
+  _child_priority = priority
+
+def child_priority():
+  '''
+  (nice,ionice) priority, either of which may be None, that programs launched
+  from the current process should run at, set by a ResourceGate while a task
+  holding resource classes runs, or None
+  '''
+  return _child_priority
+
+def apply_priority(nice=None,ionice=None):
+  '''
+  Lower the CPU and/or I/O priority of the current process, e.g. in a
+  launched program before it starts
+  '''
+  if nice is not None:
+    os.nice(nice)
+  if ionice is not None:
+    try:
+      psutil.Process().ionice(*ionice)
+    except AttributeError:
+      # Platforms without I/O priorities
+      pass
+
+
+class LoadScalingPolicy(object):
+  '''
+  Scaling policy for an Autoscaler, reducing the number of concurrently
+  running tasks by one while the machine is overloaded or short of memory and
+  increasing it by one while at least one CPU's worth of capacity is idle.
+  
+  Initialization parameters:
+    :param min_workers: Number of running tasks never scaled below
+    :param overload: Ratio of 1-minute load average to CPU count above which
+                     the machine counts as overloaded
+    :param min_available_memory: System available memory in bytes below which
+                                 the machine counts as short of memory
+  '''
+  def __init__(self,min_workers=1,overload=1.0,min_available_memory=None):
+    self.min_workers = min_workers
+    self.overload = overload
+    self.min_available_memory = min_available_memory
+  
+  def __call__(self,current,maximum):
+    ncpus = psutil.cpu_count()
+    short_of_memory = self.min_available_memory is not None and \
+                psutil.virtual_memory().available < self.min_available_memory
+    if short_of_memory or psutil.getloadavg()[0] > self.overload*ncpus:
+      return max(current-1,self.min_workers)
+    idle_cpus = ncpus*(100.0-psutil.cpu_percent())/100
+    if idle_cpus >= 1:
+      return min(current+1,maximum)
+    return current
+
+
+class Autoscaler(threading.Thread):
+  '''
+  Daemon thread resizing gate, a ConcurrencyGate, every interval seconds to
+  the target returned by policy, a callable taking the current target and
+  maximum and returning the new target, which is clamped to 1..maximum
+  '''
+  def __init__(self,gate,policy,maximum,interval):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.gate = gate
+    self.policy = policy
+    self.maximum = maximum
+    self.interval = interval
+    self._stopped = threading.Event()
+  
+  def run(self):
+    # The first CPU utilization reading only establishes a baseline
+    psutil.cpu_percent()
+    while not self._stopped.wait(self.interval):
+      current = self.gate.target.value
+      target = max(1,min(self.policy(current,self.maximum),self.maximum))
+      if target != current:
+        self.gate.resize(target)
+  
+  def stop(self):
+    self._stopped.set()
+    self.join()
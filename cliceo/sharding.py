@@ -0,0 +1,85 @@
+'''
+Splitting of large files into shards, byte ranges aligned to record
+boundaries, that can be mapped over without the records passing through the
+process doing the splitting.
+
+Records are separated by a delimiter. A file is split into records at a fixed
+offset within each occurrence of the delimiter, by default just past its end,
+so that with the default '\n' records are lines including their newline, and
+with delimiter '\n>' and split_at 1 records are FASTA entries.
+'''
+from . import mapped
+
+
+class FileShard(object):
+  '''
+  Byte range [start,end) of the file at path, starting at a record boundary
+  and ending at one or at the end of the file. A shard holds only its
+  coordinates, so it is cheap to pickle and send to another process, where its
+  records are read through a memory map.
+  '''
+  __slots__ = ('path','start','end','delimiter','split_at')
+  
+  def __init__(self,path,start,end,delimiter='\n',split_at=None):
+    self.path = path
+    self.start = start
+    self.end = end
+    self.delimiter = delimiter
+    self.split_at = len(delimiter) if split_at is None else split_at
+  
+  def __reduce__(self):
+    return (type(self),(self.path,self.start,self.end,self.delimiter,
+                        self.split_at))
+  
+  def __len__(self):
+    return self.end-self.start
+  
+  def read(self):
+    handle = mapped.MappedFile(self.path)
+    try:
+      return handle.mmap()[self.start:self.end]
+    finally:
+      handle.close()
+  
+  def records(self):
+    '''
+    Iterate over (offset,record) pairs of the records in the shard, where
+    offset is the position of the record in the file
+    '''
+    handle = mapped.MappedFile(self.path)
+    try:
+      data = handle.mmap()
+      pos = self.start
+      while pos < self.end:
+        # Next split point past pos
+        found = data.find(self.delimiter,max(pos-self.split_at+1,0),
+                          self.end)
+        end = self.end if found < 0 else found+self.split_at
+        yield pos,data[pos:end]
+        pos = end
+    finally:
+      handle.close()
+
+
+def FileShards(path,shard_size,delimiter='\n',split_at=None):
+  '''
+  Split the file at path into FileShards of at least shard_size bytes each,
+  except for the last one, ending at the first record boundary past that size
+  
+  Only the neighbourhood of each shard boundary is read.
+  '''
+  if shard_size < 1:
+    raise ValueError("'shard_size' must be a positive integer")
+  split_at = len(delimiter) if split_at is None else split_at
+  handle = mapped.MappedFile(path)
+  try:
+    data = handle.mmap()
+    size = len(data)
+    start = 0
+    while start < size:
+      found = data.find(delimiter,max(start+shard_size-split_at,0))
+      end = size if found < 0 else min(found+split_at,size)
+      yield FileShard(path,start,end,delimiter,split_at)
+      start = end
+  finally:
+    handle.close()
@@ -0,0 +1,137 @@
+'''
+Result sinks to which pool workers write results directly, so that only small
+acknowledgements pass through the pool's result pipe and the parent process.
+
+Each worker process appends (label,result) records to its own shard file in a
+shared directory. Shards can be read while they are being written, with a
+ShardReader, or once the pool is done, with iterate_shards() or merge_shards().
+'''
+import os
+import json
+import glob
+import struct
+import cPickle
+
+
+FORMATS = ('jsonl','pickle')
+
+# Length prefix of each pickle frame
+_FRAME_HEADER = struct.Struct('>I')
+
+
+def _check_format(format):
+  if format not in FORMATS:
+    raise ValueError("Shard format must be one of %s" % ', '.join(FORMATS))
+
+
+class ShardSink(object):
+  '''
+  Writes results to one shard file per worker process in directory, as JSON
+  lines of the form {"label": ..., "result": ...} or as length-prefixed pickle
+  frames of (label,result) tuples. Every record is flushed as it is written,
+  so that it can be read right away.
+  
+  Initialization parameters:
+    :param directory: Existing directory in which shard files are created
+    :param format: 'jsonl' or 'pickle'
+  '''
+  def __init__(self,directory,format='jsonl'):
+    _check_format(format)
+    self.directory = directory
+    self.format = format
+    self._fh = None
+  
+  def __getstate__(self):
+    return {'directory':self.directory,'format':self.format,'_fh':None}
+  
+  @property
+  def path(self):
+    return os.path.join(self.directory,'%d.%s' % (os.getpid(),self.format))
+  
+  def write(self,label,result):
+    if self._fh is None:
+      self._fh = open(self.path,'ab')
+    if self.format == 'jsonl':
+      self._fh.write(json.dumps({'label':label,'result':result})+'\n')
+    else:
+      frame = cPickle.dumps((label,result),cPickle.HIGHEST_PROTOCOL)
+      self._fh.write(_FRAME_HEADER.pack(len(frame))+frame)
+    self._fh.flush()
+  
+  def close(self):
+    if self._fh is not None:
+      self._fh.close()
+      self._fh = None
+
+
+class ShardReader(object):
+  '''
+  Reads (label,result) records from the shard files in directory, remembering
+  how far each file has been read, so that repeated calls to read_new() yield
+  only records completed since the previous call
+  '''
+  def __init__(self,directory,format='jsonl'):
+    _check_format(format)
+    self.directory = directory
+    self.format = format
+    self.offsets = {}
+  
+  def _records(self,data):
+    '''
+    Complete records in data, paired with the offset just past each
+    '''
+    pos = 0
+    if self.format == 'jsonl':
+      while True:
+        end = data.find('\n',pos)
+        if end < 0:
+          return
+        record = json.loads(data[pos:end])
+        pos = end+1
+        yield (record['label'],record['result']),pos
+    else:
+      while pos+_FRAME_HEADER.size <= len(data):
+        size, = _FRAME_HEADER.unpack_from(data,pos)
+        end = pos+_FRAME_HEADER.size+size
+        if end > len(data):
+          return
+        record = cPickle.loads(data[pos+_FRAME_HEADER.size:end])
+        pos = end
+        yield record,pos
+  
+  def read_new(self):
+    for path in sorted(glob.glob(os.path.join(self.directory,
+                                              '*.'+self.format))):
+      offset = self.offsets.get(path,0)
+      with open(path,'rb') as fh:
+        fh.seek(offset)
+        data = fh.read()
+      for record,end in self._records(data):
+        self.offsets[path] = offset+end
+        yield record
+
+
+def iterate_shards(directory,format='jsonl'):
+  '''
+  Iterate over all (label,result) records in the shard files in directory
+  '''
+  return ShardReader(directory,format).read_new()
+
+def merge_shards(directory,out_path,format='jsonl'):
+  '''
+  Concatenate the complete records of all shard files in directory into a
+  single file in the same format, returning the number of records
+  '''
+  reader = ShardReader(directory,format)
+  count = 0
+  with open(out_path,'wb') as out:
+    for path in sorted(glob.glob(os.path.join(directory,'*.'+format))):
+      if os.path.abspath(path) == os.path.abspath(out_path):
+        continue
+      with open(path,'rb') as fh:
+        data = fh.read()
+      end = 0
+      for _,end in reader._records(data):
+        count += 1
+      out.write(data[:end])
+  return count
@@ -0,0 +1,191 @@
+'''
+Soak test harness running a PoolManager job of fake tool calls (see faketool)
+and reporting throughput, tail latency, memory use over time and anything left
+behind by the job: processes still running and temporary directories not
+removed. Runs offline, e.g. for a scaling regression check:
+
+  python -m cliceo.soak --tasks 200000 --numproc 16 -- --runtime 0.01
+
+Arguments after -- are passed on to every fake tool call.
+'''
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+import psutil
+from .controller import CommandLineCaller
+from .workerpool import PoolManager
+from . import faketool
+
+# Run by path, so that calls work from any working directory
+FAKETOOL_PATH = os.path.splitext(os.path.abspath(faketool.__file__))[0]+'.py'
+
+
+class FakeToolCaller(CommandLineCaller):
+  '''
+  Runs the fake tool for task number task, with tool_args passed on to it,
+  and reports its exit status, output size and latency as result
+  '''
+  def __init__(self,task,tool_args=(),**kwargs):
+    callstr = ' '.join([sys.executable,FAKETOOL_PATH,
+                        '--task',str(task)]+list(tool_args))
+    CommandLineCaller.__init__(self,callstr,capture_stdout=True,**kwargs)
+  
+  def call(self):
+    started = time.time()
+    CommandLineCaller.call(self)
+    self.latency = time.time()-started
+  
+  def result(self):
+    return {'returncode':self.returncode,
+            'output_bytes':len(self.captured_stdout),
+            'latency':self.latency}
+
+
+def percentile(sorted_values,fraction):
+  if not sorted_values:
+    return None
+  index = int(round(fraction*(len(sorted_values)-1)))
+  return sorted_values[index]
+
+def _rss(procs):
+  total = 0
+  for proc in procs:
+    try:
+      total += proc.memory_info().rss
+    except psutil.NoSuchProcess:
+      pass
+  return total
+
+
+class RSSSampler(threading.Thread):
+  '''
+  Daemon thread recording, every interval seconds, the RSS of the current
+  process and the total RSS of all its descendants
+  '''
+  def __init__(self,interval):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.interval = interval
+    self.samples = []
+    self._stopped = threading.Event()
+    self._started = time.time()
+  
+  def sample(self):
+    parent = psutil.Process()
+    self.samples.append({'time':time.time()-self._started,
+                         'parent_rss':_rss([parent]),
+                         'children_rss':_rss(parent.children(recursive=True))})
+  
+  def run(self):
+    self.sample()
+    while not self._stopped.wait(self.interval):
+      self.sample()
+  
+  def stop(self):
+    self._stopped.set()
+    self.join()
+    self.sample()
+
+
+def _temp_entries(tmpdir_loc):
+  return set(name for name in os.listdir(tmpdir_loc)
+             if os.path.isdir(os.path.join(tmpdir_loc,name)))
+
+def _live_children():
+  children = []
+  for proc in psutil.Process().children(recursive=True):
+    try:
+      if proc.status() != psutil.STATUS_ZOMBIE:
+        children.append({'pid':proc.pid,'cmdline':' '.join(proc.cmdline())})
+    except psutil.NoSuchProcess:
+      pass
+  return children
+
+def run_soak(ntasks,numproc=None,tool_args=(),sample_interval=1.0,
+             in_tmpdir=True,tmpdir_loc=None,settle_time=1.0,
+             **poolmanager_kwargs):
+  '''
+  Run ntasks fake tool calls in a PoolManager of numproc workers, passing on
+  any other keyword arguments to PoolManager, and return a report dictionary:
+    tasks             number of tasks completed
+    failures          number of tasks whose tool call exited with nonzero
+                      status
+    elapsed           seconds from start to end of iteration
+    throughput        tasks per second
+    latency           tool call latency percentiles in seconds (p50, p90, p99,
+                      p999 and max)
+    output_bytes      total tool output received
+    rss_samples       RSS of this process and of all its descendants over time
+    peak_parent_rss   highest sampled RSS of this process
+    peak_children_rss highest sampled total RSS of descendants
+    leaked_processes  descendants still running settle_time seconds after the
+                      job ended
+    leaked_tempdirs   directories created in the temporary location during
+                      the job and not removed
+  '''
+  tmpdir_loc = tempfile.gettempdir() if tmpdir_loc is None else tmpdir_loc
+  temp_before = _temp_entries(tmpdir_loc)
+  sampler = RSSSampler(sample_interval)
+  sampler.start()
+  latencies,failures,output_bytes = [],0,0
+  started = time.time()
+  try:
+    for result in PoolManager(FakeToolCaller,xrange(ntasks),numproc,
+                              tool_args=tool_args,in_tmpdir=in_tmpdir,
+                              tmpdir_loc=tmpdir_loc,**poolmanager_kwargs):
+      latencies.append(result['latency'])
+      failures += result['returncode'] != 0
+      output_bytes += result['output_bytes']
+  finally:
+    elapsed = time.time()-started
+    sampler.stop()
+  time.sleep(settle_time)
+  latencies.sort()
+  return {'tasks':len(latencies),'failures':failures,'elapsed':elapsed,
+          'throughput':len(latencies)/elapsed if elapsed > 0 else 0.0,
+          'latency':dict([('p50',percentile(latencies,0.5)),
+                          ('p90',percentile(latencies,0.9)),
+                          ('p99',percentile(latencies,0.99)),
+                          ('p999',percentile(latencies,0.999)),
+                          ('max',latencies[-1] if latencies else None)]),
+          'output_bytes':output_bytes,
+          'rss_samples':sampler.samples,
+          'peak_parent_rss':max(s['parent_rss'] for s in sampler.samples),
+          'peak_children_rss':max(s['children_rss'] for s in sampler.samples),
+          'leaked_processes':_live_children(),
+          'leaked_tempdirs':sorted(_temp_entries(tmpdir_loc)-temp_before)}
+
+def main(argv=None):
+  argv = sys.argv[1:] if argv is None else argv
+  if '--' in argv:
+    tool_args = argv[argv.index('--')+1:]
+    argv = argv[:argv.index('--')]
+  else:
+    tool_args = []
+  parser = argparse.ArgumentParser(prog='python -m cliceo.soak',
+                                   description=__doc__.split('\n\n')[0])
+  parser.add_argument('--tasks',type=int,default=1000)
+  parser.add_argument('--numproc',type=int,default=None)
+  parser.add_argument('--sample-interval',type=float,default=1.0)
+  parser.add_argument('--maxtasksperchild',type=int,default=None)
+  parser.add_argument('--no-tmpdir',action='store_true',
+                      help='run tool calls in the current directory')
+  parser.add_argument('--samples',action='store_true',
+                      help='include all RSS samples in the report')
+  args = parser.parse_args(argv)
+  report = run_soak(args.tasks,args.numproc,tool_args,args.sample_interval,
+                    in_tmpdir=not args.no_tmpdir,
+                    maxtasksperchild=args.maxtasksperchild)
+  if not args.samples:
+    del report['rss_samples']
+  json.dump(report,sys.stdout,indent=2,sort_keys=True)
+  sys.stdout.write('\n')
+  return 1 if report['leaked_processes'] or report['leaked_tempdirs'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,142 @@
+import os
+import time
+import tempfile
+import threading
+
+
+class PoolStats(object):
+  '''
+  Progress counters of a PoolManager run, kept in the parent process, plus
+  optional per-worker activity reported by worker processes.
+  
+  Initialization parameters:
+    :param total: Number of items to be processed, if known in advance
+    :param worker_activity: Shared mapping of worker process name to the time
+                            the worker started its current task, or None if
+                            the worker is idle
+  '''
+  def __init__(self,total=None,worker_activity=None):
+    self.total = total
+    self.worker_activity = worker_activity
+    self.started = time.time()
+    self.dispatched = 0
+    self.completed = 0
+    self._lock = threading.Lock()
+  
+  def count_dispatched(self,sequence):
+    '''
+    Pass through items of sequence, counting each as it is handed to the pool
+    '''
+    for item in sequence:
+      with self._lock:
+        self.dispatched += 1
+      yield item
+  
+  def count_completed(self,n=1):
+    with self._lock:
+      self.completed += n
+  
+  def snapshot(self):
+    '''
+    Dictionary of current progress figures:
+      elapsed     seconds since the run started
+      dispatched  items handed to the pool
+      completed   items whose results were received
+      in_flight   tasks running, i.e. busy workers (None if worker activity
+                  is not tracked)
+      queued      items dispatched but neither running nor completed,
+                  counting a running batch or shard as a single item
+                  Items are dispatched ahead of the workers taking them, so
+                  dispatched is no measure of work in progress.
+      throughput  completed items per second
+      eta         estimated seconds until completion (None if total unknown)
+      workers     worker process name -> seconds busy with the current task,
+                  or None if idle (None if worker activity is not tracked)
+    '''
+    now = time.time()
+    with self._lock:
+      dispatched,completed = self.dispatched,self.completed
+    elapsed = now-self.started
+    throughput = completed/elapsed if elapsed > 0 else 0.0
+    if self.total is None or not throughput:
+      eta = None
+    else:
+      eta = (self.total-completed)/throughput
+    if self.worker_activity is None:
+      workers = running = None
+    else:
+      workers = dict((name,None if since is None else now-since)
+                     for name,since in self.worker_activity.items())
+      running = sum(1 for busy in workers.values() if busy is not None)
+    queued = max(0,dispatched-completed-(running or 0))
+    return {'elapsed':elapsed,'dispatched':dispatched,'completed':completed,
+            'in_flight':running,'queued':queued,'throughput':throughput,
+            'eta':eta,'total':self.total,'workers':workers}
+
+
+class StatsReporter(threading.Thread):
+  '''
+  Daemon thread passing a PoolStats snapshot to callback every interval
+  seconds until stopped, and once more when stopped
+  '''
+  def __init__(self,stats,callback,interval):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.stats = stats
+    self.callback = callback
+    self.interval = interval
+    self._stopped = threading.Event()
+  
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      self.callback(self.stats.snapshot())
+  
+  def stop(self):
+    self._stopped.set()
+    self.join()
+    self.callback(self.stats.snapshot())
+
+
+class MetricsFileExporter(object):
+  '''
+  Stats callback writing a snapshot to path in the Prometheus text exposition
+  format, e.g. for the node exporter textfile collector. The file is replaced
+  atomically, so readers never see a partial write.
+  '''
+  def __init__(self,path,prefix='cliceo_pool'):
+    self.path = path
+    self.prefix = prefix
+    # Temporary files are created readable by their owner only, but the
+    # collector reading the file usually runs as another user; the umask can
+    # only be read by setting it, so it is read once, before the reporter
+    # thread calling this exporter starts
+    umask = os.umask(0)
+    os.umask(umask)
+    self.mode = 0o644 & ~umask
+  
+  def format(self,snapshot):
+    metrics = [('items_dispatched_total',snapshot['dispatched']),
+               ('items_completed_total',snapshot['completed']),
+               ('items_queued',snapshot['queued']),
+               ('throughput_items_per_second',snapshot['throughput']),
+               ('elapsed_seconds',snapshot['elapsed'])]
+    if snapshot['total'] is not None:
+      metrics.append(('items_total',snapshot['total']))
+    if snapshot['eta'] is not None:
+      metrics.append(('eta_seconds',snapshot['eta']))
+    if snapshot['in_flight'] is not None:
+      metrics.append(('tasks_running',snapshot['in_flight']))
+    if snapshot['workers'] is not None:
+      busy = [t for t in snapshot['workers'].values() if t is not None]
+      metrics.append(('workers_seen',len(snapshot['workers'])))
+      metrics.append(('workers_busy',len(busy)))
+    return ''.join('%s_%s %s\n' % (self.prefix,name,value)
+                   for name,value in metrics)
+  
+  def __call__(self,snapshot):
+    fd,tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(
+                                                                   self.path)))
+    with os.fdopen(fd,'w') as fh:
+      os.fchmod(fd,self.mode)
+      fh.write(self.format(snapshot))
+    os.rename(tmppath,self.path)
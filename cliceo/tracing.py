@@ -0,0 +1,166 @@
+'''
+Opt-in tracing of task lifecycle phases in the Chrome trace event format,
+readable by chrome://tracing and Perfetto.
+
+Each process writes its events as JSON lines to its own file in a shared trace
+directory, so no coordination is needed while tracing. read_events() and
+write_trace() combine the files into a single trace. Module level functions
+record events through the tracer activated in the current process and do
+nothing if there is none.
+'''
+import os
+import json
+import glob
+import time
+import threading
+import contextlib2
+
+
+def _now_us():
+  return int(time.time()*1e6)
+
+
+class Tracer(object):
+  '''
+  Writes trace events of the current process to trace_dir
+  '''
+  def __init__(self,trace_dir,process_name=None):
+    self.trace_dir = trace_dir
+    self.pid = os.getpid()
+    self._lock = threading.Lock()
+    self._fh = open(os.path.join(trace_dir,'%d.jsonl' % self.pid),'a')
+    if process_name is not None:
+      self.emit({'ph':'M','name':'process_name','pid':self.pid,
+                 'args':{'name':process_name}})
+  
+  def emit(self,event):
+    line = json.dumps(event)+'\n'
+    with self._lock:
+      self._fh.write(line)
+      self._fh.flush()
+  
+  def _event(self,ph,name,ts=None,**fields):
+    event = {'ph':ph,'name':name,'pid':self.pid,
+             'tid':threading.current_thread().ident,
+             'ts':_now_us() if ts is None else ts}
+    event.update(fields)
+    self.emit(event)
+  
+  def begin(self,name,**args):
+    self._event('B',name,args=args)
+  
+  def end(self,name):
+    self._event('E',name)
+  
+  def complete(self,name,ts,dur,**args):
+    self._event('X',name,ts=ts,dur=dur,args=args)
+  
+  @contextlib2.contextmanager
+  def span(self,name,**args):
+    ts = _now_us()
+    try:
+      yield
+    finally:
+      self.complete(name,ts,_now_us()-ts,**args)
+  
+  def async_span(self,name,task_id,ts,end_ts):
+    '''
+    Span not nested in the call stack of any thread, e.g. a task waiting in a
+    queue between processes
+    '''
+    for ph,t in [('b',ts),('e',end_ts)]:
+      self._event(ph,name,ts=t,cat='task',id=task_id)
+  
+  def close(self):
+    self._fh.close()
+
+
+_tracer = None
+
+def activate(trace_dir,process_name=None):
+  global _tracer
+  _tracer = Tracer(trace_dir,process_name)
+  return _tracer
+
+def deactivate():
+  global _tracer
+  if _tracer is not None:
+    _tracer.close()
+    _tracer = None
+
+def begin(name,**args):
+  if _tracer is not None:
+    _tracer.begin(name,**args)
+
+def end(name):
+  if _tracer is not None:
+    _tracer.end(name)
+
+def complete(name,ts,dur,**args):
+  if _tracer is not None:
+    _tracer.complete(name,ts,dur,**args)
+
+def span(name,**args):
+  if _tracer is not None:
+    return _tracer.span(name,**args)
+  return contextlib2.ExitStack() # No-op context
+
+
+class TracedTask(object):
+  '''
+  Task argument or result tagged with the id under which its dispatch and
+  receipt are recorded by the parent process
+  '''
+  __slots__ = ('task_id','obj')
+  
+  def __init__(self,task_id,obj):
+    self.task_id = task_id
+    self.obj = obj
+  
+  def __reduce__(self):
+    return (type(self),(self.task_id,self.obj))
+
+
+class TaskTimeline(object):
+  '''
+  Parent side record of task dispatch and result receipt times, from which the
+  time each task spent queued and in transfer is traced once the matching
+  worker events are known
+  '''
+  def __init__(self,tracer):
+    self.tracer = tracer
+    self.dispatched = {}
+    self.received = {}
+  
+  def tag_dispatched(self,sequence):
+    for task_id,item in enumerate(sequence):
+      self.dispatched[task_id] = _now_us()
+      yield TracedTask(task_id,item)
+  
+  def untag_received(self,traced_result):
+    self.received[traced_result.task_id] = _now_us()
+    return traced_result.obj
+  
+  def trace_queueing_and_transfer(self,worker_events):
+    for event in worker_events:
+      if event.get('ph') == 'X' and event['name'] == 'task':
+        task_id = event['args'].get('task_id')
+        if task_id in self.dispatched:
+          self.tracer.async_span('queued',task_id,self.dispatched[task_id],
+                                 event['ts'])
+        if task_id in self.received:
+          self.tracer.async_span('result transfer',task_id,
+                                 event['ts']+event['dur'],
+                                 self.received[task_id])
+
+
+def read_events(trace_dir):
+  events = []
+  for path in glob.glob(os.path.join(trace_dir,'*.jsonl')):
+    with open(path) as fh:
+      events.extend(json.loads(line) for line in fh if line.endswith('\n'))
+  return events
+
+def write_trace(events,out_path):
+  with open(out_path,'w') as fh:
+    json.dump({'traceEvents':events,'displayTimeUnit':'ms'},fh)
@@ -1,21 +1,45 @@
+import os
 import sys
+import time
+import glob
+import shutil
+import pstats
+import cProfile
+import tempfile
+import hashlib
+import cPickle
+import Queue
+import importlib
+import threading
+import collections
 import psutil
 import multiprocessing
 from multiprocessing.managers import SyncManager
+from multiprocessing.util import Finalize
 import signal
 from ctypes import c_bool
 from functools import partial
 import contextlib2
 from tblib import pickling_support
 from .controller import CommandLineCaller
+from . import resources
+from . import mapped
+from . import telemetry
+from . import tracing
 
 
 class LabeledObject(object):
+  __slots__ = ('label','obj','is_result')
+  
   def __init__(self,label,obj,is_result=False):
     self.label = label
     self.obj = obj
     self.is_result = is_result
   
+  def __reduce__(self):
+    # Pickle as a bare argument tuple rather than an instance dict
+    return (type(self),(self.label,self.obj,self.is_result))
+  
   @property
   def result(self):
     if self.is_result:
@@ -49,43 +73,740 @@ def LabeledObjectsSequence(sequence_of_label_item_pairs):
   for label,item in sequence_of_label_item_pairs:
     yield LabeledObject(label,item)
 
+class Batch(LabeledObject):
+  '''
+  Several sequence items handled as a single task. label is the list of item
+  labels, or None if the items are not labeled, and obj is the list of item
+  values or, once the batch is a result, the list of per-item results.
+  '''
+  __slots__ = ()
+  
+  def __len__(self):
+    return len(self.obj)
+
+def BatchedSequence(sequence,batch_size=None,batch_bytes=None):
+  '''
+  Group items of sequence, LabeledObjects or bare values, into Batches of at
+  most batch_size items and, unless a single item is larger, at most
+  batch_bytes total item length
+  '''
+  labels,values,nbytes = [],[],0
+  for item in sequence:
+    value = item.obj if isinstance(item,LabeledObject) else item
+    size = len(value) if batch_bytes is not None else 0
+    if values and batch_bytes is not None and nbytes+size > batch_bytes:
+      yield Batch(labels or None,values)
+      labels,values,nbytes = [],[],0
+    if isinstance(item,LabeledObject):
+      labels.append(item.label)
+    values.append(value)
+    nbytes += size
+    if batch_size is not None and len(values) == batch_size:
+      yield Batch(labels or None,values)
+      labels,values,nbytes = [],[],0
+  if values:
+    yield Batch(labels or None,values)
+
+class TrackedTask(object):
+  '''
+  Task whose loss with a dead worker process is watched for (see
+  WorkerLossMonitor), dispatched for the attempt-th time, or, coming back, its
+  result
+  '''
+  __slots__ = ('task_id','attempt','obj')
+  
+  def __init__(self,task_id,attempt,obj):
+    self.task_id = task_id
+    self.attempt = attempt
+    self.obj = obj
+  
+  def __reduce__(self):
+    return (TrackedTask,(self.task_id,self.attempt,self.obj))
+
+def TrackedSequence(sequence):
+  for task_id,item in enumerate(sequence):
+    yield TrackedTask(task_id,0,item)
+
+class AffinityToken(object):
+  '''
+  Task telling a worker to take the next item from its affinity queue, or to
+  steal one from another worker's queue if its own is empty
+  '''
+  __slots__ = ()
+  
+  def __reduce__(self):
+    return (AffinityToken,())
+
+def AffinitySequence(sequence,key,queues):
+  '''
+  Put each item of sequence into the one of queues selected by the hash of
+  its key, given by key(item), passing through an AffinityToken for each
+  '''
+  for item in sequence:
+    value = item.obj if isinstance(item,LabeledObject) else item
+    queues[hash(key(value)) % len(queues)].put(item)
+    yield AffinityToken()
+
+class RecordFailure(Exception):
+  '''
+  Raised by call_on_records() for the error exc_info raised by the work done
+  for the record at offset, for the worker to return that error labeled with
+  the offset
+  '''
+  def __init__(self,offset,exc_info):
+    Exception.__init__(self,offset)
+    self.offset = offset
+    self.exc_info = exc_info
+
+def call_on_records(work_callable,shard):
+  '''
+  Do the work for each record of a sharding.FileShard, returning a Batch of
+  per-record results labeled with the offsets of the records
+  '''
+  offsets,results = [],[]
+  for offset,record in shard.records():
+    offsets.append(offset)
+    try:
+      results.append(work_callable(record))
+    except Exception:
+      raise RecordFailure(offset,sys.exc_info())
+  return Batch(offsets,results,is_result=True)
+
+def pickle_digest(obj):
+  return hashlib.sha1(cPickle.dumps(obj,cPickle.HIGHEST_PROTOCOL)).hexdigest()
+
+class TaskDeduplicator(object):
+  '''
+  Coalesces sequence items with equal keys into a single task. An item whose
+  key matches a task in flight waits for that task's result, and one whose key
+  matches one of the memo_size most recently used results gets that result
+  without a task at all. Tasks are labeled with their key, and results are
+  fanned out from keys to the labels of all items that share them.
+  
+  Initialization parameters:
+    :param key: Callable returning the key, hashable and picklable, of a
+                sequence item (without its label)
+                If None, a digest of the pickled item
+    :param memo_size: Maximum number of results kept for reuse after their task
+                      completed
+    :param labeled: Boolean flag indicating whether results are yielded with
+                    the labels of sequence items
+  '''
+  def __init__(self,key=None,memo_size=1024,labeled=True):
+    self.key = pickle_digest if key is None else key
+    self.memo_size = memo_size
+    self.labeled = labeled
+    self.memo = collections.OrderedDict()
+    # Key of each task in flight -> labels of all items waiting for it
+    self.waiting = {}
+    # Items answered from the memo, yielded along with the next task result
+    self.ready = collections.deque()
+    self._lock = threading.Lock()
+  
+  def dispatch(self,sequence):
+    '''
+    Pass through a task for each item of sequence whose key is neither in
+    flight nor in the memo
+    '''
+    for item in sequence:
+      if isinstance(item,LabeledObject):
+        label,value = item.label,item.obj
+      else:
+        label,value = None,item
+      key = self.key(value)
+      with self._lock:
+        if key in self.memo:
+          self.memo[key] = self.memo.pop(key) # Most recently used goes last
+          self.ready.append((label,self.memo[key]))
+          continue
+        elif key in self.waiting:
+          self.waiting[key].append(label)
+          continue
+        self.waiting[key] = [label]
+      yield LabeledObject(key,value)
+  
+  def original_label(self,key):
+    '''
+    Label of the item for which the task with key was dispatched
+    '''
+    with self._lock:
+      return self.waiting[key][0]
+  
+  def _complete(self,key,result):
+    with self._lock:
+      labels = self.waiting.pop(key)
+      if self.memo_size:
+        self.memo[key] = result
+        while len(self.memo) > self.memo_size:
+          self.memo.popitem(last=False)
+    return labels
+  
+  def _output(self,label,result):
+    return (label,result) if self.labeled else result
+  
+  def fan_out(self,results):
+    '''
+    Yield the result of each (key,result) pair in results for every item with
+    that key, and results answered from the memo
+    '''
+    for key,result in results:
+      for label in self._complete(key,result):
+        yield self._output(label,result)
+      while self.ready:
+        yield self._output(*self.ready.popleft())
+    # Exhausted results mean the whole sequence was dispatched
+    while self.ready:
+      yield self._output(*self.ready.popleft())
+
+class PartialAggregate(object):
+  '''
+  Combination of results flushed by a worker process, sent to the parent in
+  place of the acknowledgement of a result
+  '''
+  __slots__ = ('value',)
+  
+  def __init__(self,value):
+    self.value = value
+  
+  def __reduce__(self):
+    return (type(self),(self.value,))
+
+class ResultAccumulator(object):
+  '''
+  Running combination of values by combiner, a function of two values
+  returning their combination, e.g. operator.add
+  Results are combined as they complete, in no particular order, and partial
+  combinations from different workers are combined with each other, so
+  combiner must be associative and commutative.
+  '''
+  def __init__(self,combiner):
+    self.combiner = combiner
+    self.value = None
+    self.count = 0
+  
+  def add(self,value):
+    self.value = value if not self.count else self.combiner(self.value,value)
+    self.count += 1
+  
+  def take(self):
+    value = self.value
+    self.value,self.count = None,0
+    return value
+
+def call_batched(work_callable,batch_splitter,values):
+  '''
+  Do the work for a list of values in one call and split the result into the
+  list of per-value results, with batch_splitter if given
+  '''
+  result = work_callable(values)
+  if batch_splitter is not None:
+    result = batch_splitter(result,values)
+  results = list(result)
+  if len(results) != len(values):
+    raise ValueError('Batch of %d items split into %d results'
+                     % (len(values),len(results)))
+  return results
+
 class Worker(object):
   def __init__(self,work_callable,permission_to_proceed,sleep_lock,
-               ready_to_die_queue,PIDcleanup=None):
+               ready_to_die_queue,PIDcleanup=None,nthreads=None,cpu_slots=None,
+               gates=(),result_extractor=None,spill_threshold=None,
+               spill_dir=None,activity=None,trace_dir=None,profile_dir=None,
+               batched=False,sink=None,setup=None,teardown=None,
+               affinity_queues=None,affinity_slots=None,inflight=None,
+               claims=None,combiner=None,flush_every=None,partials=None):
     self.callable = work_callable
     self.proceed = permission_to_proceed
     self.sleep_lock = sleep_lock
     self.ready_to_die_queue = ready_to_die_queue
     self.PIDcleanup = PIDcleanup
+    self.nthreads = nthreads
+    self.cpu_slots = cpu_slots
+    # Admission gates, e.g. resources.MemoryGate, each of which must admit a
+    # task before it is started
+    self.gates = gates
+    self.result_extractor = result_extractor
+    self.spill_threshold = spill_threshold
+    self.spill_dir = spill_dir
+    # Shared mapping to which the start time of the current task, or None when
+    # idle, is reported under the worker process name
+    self.activity = activity
+    self.trace_dir = trace_dir
+    self.profile_dir = profile_dir
+    # Whether work_callable returns a list of per-item results, each of which
+    # is extracted and spilled separately
+    self.batched = batched
+    # Result sink, e.g. sinks.ShardSink, to which results are written instead
+    # of being returned
+    self.sink = sink
+    # Called once in each worker process, with no arguments and with the value
+    # returned by setup, respectively
+    self.setup = setup
+    self.teardown = teardown
+    # Queues of items routed by affinity key, one per worker, of which this
+    # worker claims the one with an index taken from affinity_slots
+    self.affinity_queues = affinity_queues
+    self.affinity_slots = affinity_slots
+    # Shared mappings of (task id,attempt) of every TrackedTask started to the
+    # identity (see _process_identity) and name of the worker process running
+    # it and the task itself, and of worker identity to the slots the worker
+    # took, through which a WorkerLossMonitor recovers from the death of
+    # worker processes
+    # Records are removed by the monitor once results arrive.
+    self.inflight = inflight
+    self.claims = claims
+    # Results are combined by combiner in the worker process instead of being
+    # returned, flushing the combination with the acknowledgement of the task
+    # that brings it to flush_every results and putting whatever is left on
+    # queue partials when the process exits
+    self.combiner = combiner
+    self.flush_every = flush_every
+    self.partials = partials
+    self._tracked = None
+  
+  def initialize(self):
+    '''
+    Called once in each worker process before it receives any tasks
+    '''
+    if self.nthreads is not None:
+      resources.set_thread_count(self.nthreads)
+    if self.cpu_slots is not None:
+      # Take a set of CPUs no other worker is pinned to and return it when this
+      # worker process exits, so that a replacement worker can pick it up
+      cpus = self.cpu_slots.get()
+      resources.pin_current_process(cpus)
+      Finalize(None,self.cpu_slots.put,args=(cpus,),exitpriority=10)
+      self.claim_slot('cpu_slots',cpus)
+    if self.affinity_queues is not None:
+      self.affinity_slot = self.affinity_slots.get()
+      Finalize(None,self.affinity_slots.put,args=(self.affinity_slot,),
+               exitpriority=10)
+      self.claim_slot('affinity_slots',self.affinity_slot)
+    if self.claims is not None:
+      # Entered for every worker, so that the monitor can tell a worker that
+      # died from one that exited after sending all its results
+      self.claims.setdefault(_process_identity(),())
+      Finalize(None,self.claims.pop,args=(_process_identity(),None),
+               exitpriority=10)
+    if self.PIDcleanup is not None:
+      # A worker retired by maxtasksperchild must not leave its name in the PID
+      # registry, or its last PID could be killed after being reused
+      Finalize(None,self.PIDcleanup,exitpriority=10)
+    if self.sink is not None:
+      Finalize(None,self.sink.close,exitpriority=10)
+    if self.profile_dir is not None:
+      profiler = cProfile.Profile()
+      Finalize(None,_dump_profile,args=(profiler,self.profile_dir),
+               exitpriority=5)
+      profiler.enable()
+    if self.trace_dir is not None:
+      tracer = tracing.activate(self.trace_dir,
+                                multiprocessing.current_process().name)
+      Finalize(None,tracing.deactivate,exitpriority=0)
+      started = int(psutil.Process().create_time()*1e6)
+      tracer.complete('worker startup',started,tracing._now_us()-started)
+    if self.setup is not None:
+      global _worker_state
+      with tracing.span('worker setup'):
+        _worker_state = self.setup()
+    if self.teardown is not None:
+      Finalize(None,_call_teardown,args=(self.teardown,),exitpriority=10)
+    if self.combiner is not None:
+      self.accumulator = ResultAccumulator(self.combiner)
+      Finalize(None,self.flush_remaining,exitpriority=10)
+  
+  def claim_slot(self,kind,slot):
+    '''
+    Record a slot taken by this process from the queue named kind, to be
+    returned to the queue should the process die without returning it itself
+    '''
+    if self.claims is not None:
+      identity = _process_identity()
+      self.claims[identity] = self.claims.get(identity,())+((kind,slot),)
+  
+  def admit(self,argval):
+    '''
+    Pass through all admission gates, returning the list of gates passed, or
+    None if shutdown was announced while waiting for admission
+    Gates already passed are released if a gate fails, e.g. on a task memory
+    estimate or resource classes that cannot be determined for argval.
+    '''
+    name = multiprocessing.current_process().name
+    admitted_by = []
+    for gate in self.gates:
+      try:
+        admitted = gate.acquire(name,argval,self.proceed)
+      except Exception:
+        self.release(admitted_by)
+        raise
+      if not admitted:
+        self.release(admitted_by)
+        return None
+      admitted_by.append(gate)
+    return admitted_by
+  
+  def release(self,admitted_by):
+    name = multiprocessing.current_process().name
+    for gate in reversed(admitted_by):
+      gate.release(name)
+  
+  def claim_affine_item(self):
+    '''
+    Take the next item from this worker's affinity queue or, if it is empty,
+    from the longest of the other queues
+    An item is queued for every token dispatched, so one is always left.
+    '''
+    own_queue = self.affinity_queues[self.affinity_slot]
+    while True:
+      try:
+        return own_queue.get_nowait()
+      except Queue.Empty:
+        pass
+      others = sorted((q for q in self.affinity_queues if q is not own_queue),
+                      key=lambda q: q.qsize(),reverse=True)
+      for queue in others:
+        try:
+          return queue.get_nowait()
+        except Queue.Empty:
+          pass
+  
+  def per_item(self,fn,result):
+    '''
+    Apply fn to result or, for a batch, to each item result
+    '''
+    if isinstance(result,Batch):
+      return Batch(result.label,[fn(r) for r in result.result],is_result=True)
+    elif self.batched:
+      return [fn(r) for r in result]
+    return fn(result)
+  
+  def extract_result(self,result):
+    if self.result_extractor is not None:
+      result = self.result_extractor(result)
+    return result
+  
+  def spill_result(self,result):
+    if self.spill_threshold is not None:
+      result = mapped.spill_if_large(result,self.spill_threshold,self.spill_dir)
+    return result
+  
+  def sink_result(self,arg,result):
+    '''
+    Write the result of task arg to the sink, returning the acknowledgement to
+    be sent in its place
+    '''
+    label = arg.label if isinstance(arg,LabeledObject) else None
+    if isinstance(result,Batch):
+      label,result = result.label,result.result
+      for item_label,item_result in zip(label,result):
+        self.sink.write(item_label,item_result)
+      return Batch(label,[None]*len(result),is_result=True)
+    elif self.batched:
+      for item_label,item_result in zip(label or [None]*len(result),result):
+        self.sink.write(item_label,item_result)
+      return [None]*len(result)
+    self.sink.write(label,result)
+    return None
+  
+  def combine_result(self,result):
+    '''
+    Combine the result of a task, or each item result of a batch, into this
+    worker's accumulator, returning the acknowledgement to be sent in its
+    place: None per item, except for the last item when the combination is
+    due to be flushed, which carries it as a PartialAggregate
+    '''
+    if isinstance(result,Batch):
+      values = result.result
+    elif self.batched:
+      values = result
+    else:
+      values = [result]
+    for value in values:
+      self.accumulator.add(value)
+    acks = [None]*len(values)
+    if acks and self.flush_every is not None and \
+                                     self.accumulator.count >= self.flush_every:
+      acks[-1] = PartialAggregate(self.spill_result(self.accumulator.take()))
+    if isinstance(result,Batch):
+      return Batch(result.label,acks,is_result=True)
+    elif self.batched:
+      return acks
+    return acks[0]
+  
+  def flush_remaining(self):
+    if self.accumulator.count:
+      self.partials.put(self.accumulator.take())
+  
+  def prepickle(self,result,reapply_label):
+    '''
+    Pickle the result of a tracked task here, so that a failure to pickle it
+    is returned as the task's error rather than lost by the pool
+    '''
+    try:
+      return mapped._Prepickled(cPickle.dumps(result,cPickle.HIGHEST_PROTOCOL))
+    except Exception:
+      pickling_support.install()
+      return reapply_label(sys.exc_info())
+  
+  def labeled_result(self,result,reapply_label):
+    if self._tracked is not None:
+      return self.prepickle(reapply_label(result),reapply_label)
+    return reapply_label(result)
   
   def __call__(self,arg):
+    if isinstance(arg,TrackedTask):
+      self._tracked = arg
+      try:
+        return TrackedTask(arg.task_id,arg.attempt,self(arg.obj))
+      finally:
+        self._tracked = None
+    if isinstance(arg,tracing.TracedTask):
+      with tracing.span('task',task_id=arg.task_id):
+        return tracing.TracedTask(arg.task_id,self(arg.obj))
+    if isinstance(arg,AffinityToken) and self.proceed.value:
+      arg = self.claim_affine_item()
     if self.proceed.value:
+      if self._tracked is not None:
+        # Recorded for recovery should this process die before the result of
+        # arg reaches the parent
+        self.inflight[(self._tracked.task_id,self._tracked.attempt)] = \
+            (_process_identity(),multiprocessing.current_process().name,arg)
       with LabeledObject.strip_label(arg) as (argval,reapply_label):
         try:
-          result = self.callable(argval)
-          if self.PIDcleanup is not None:
-            self.PIDcleanup()
+          with tracing.span('admission'):
+            admitted_by = self.admit(argval)
         except Exception:
-          result = sys.exc_info()
-          # Automagically allow pickling traceback details for returning them to
-          # pool manager, allowing manager to raise error with correct traceback
           pickling_support.install()
-        return reapply_label(result)
-    else:
-      # Signal to pool manager readiness to be terminated
-      self.ready_to_die_queue.get()
-      self.ready_to_die_queue.task_done()
-      # Sleep until terminated by waiting to acquire lock
-      self.sleep_lock.acquire()
+          return self.labeled_result(sys.exc_info(),reapply_label)
+        if admitted_by is not None:
+          if self.activity is not None:
+            name = multiprocessing.current_process().name
+            self.activity[name] = time.time()
+          try:
+            with tracing.span('work'):
+              result = self.callable(argval)
+            if self.PIDcleanup is not None:
+              self.PIDcleanup()
+            with tracing.span('result handling'):
+              result = self.per_item(self.extract_result,result)
+              # A sink is written, and a combiner given, the results
+              # themselves, and only acknowledgements are sent back
+              if self.sink is not None:
+                result = self.sink_result(arg,result)
+              elif self.combiner is not None:
+                result = self.combine_result(result)
+              else:
+                result = self.per_item(self.spill_result,result)
+          except RecordFailure as failure:
+            result = LabeledObject(failure.offset,failure.exc_info,
+                                   is_result=True)
+            pickling_support.install()
+          except Exception:
+            result = sys.exc_info()
+            # Automagically allow pickling traceback details for returning
+            # them to pool manager, allowing manager to raise error with
+            # correct traceback
+            pickling_support.install()
+          finally:
+            self.release(admitted_by)
+            if self.activity is not None:
+              self.activity[name] = None
+          return self.labeled_result(result,reapply_label)
+    # Shutdown was announced before the task could start
+    # Signal to pool manager readiness to be terminated
+    self.ready_to_die_queue.get()
+    self.ready_to_die_queue.task_done()
+    # Sleep until terminated by waiting to acquire lock
+    self.sleep_lock.acquire()
+
+
+_worker_state = None
+
+def get_worker_state():
+  '''
+  Value returned by the worker_setup function of the pool, called in the
+  current worker process (None outside worker processes or without setup)
+  '''
+  return _worker_state
+
+def _call_teardown(teardown):
+  teardown(_worker_state)
+
+def _dump_profile(profiler,profile_dir):
+  profiler.disable()
+  profiler.dump_stats(os.path.join(profile_dir,'%d.prof' % os.getpid()))
 
 
 def PartializedControllerCallable(cls,*partial_args,**partial_kwargs):
   def do_work(cls,*args,**kwargs):
     caller = cls(*args,**kwargs)
     caller()
-    return caller
+    return caller.result()
   return partial(do_work,cls,*partial_args,**partial_kwargs)
 
+class WorkerLostError(Exception):
+  '''
+  Worker process died, e.g. killed by the OOM killer, while running a task
+  '''
+  pass
+
+_identity = None
+
+def _process_identity():
+  '''
+  (PID,creation time) of the current process, which unlike its PID is never
+  taken by a later process
+  '''
+  global _identity
+  if _identity is None or _identity[0] != os.getpid():
+    _identity = (os.getpid(),psutil.Process().create_time())
+  return _identity
+
+def _alive(identity):
+  pid,created = identity
+  try:
+    process = psutil.Process(pid)
+    return process.create_time() == created and \
+           process.status() != psutil.STATUS_ZOMBIE
+  except psutil.NoSuchProcess:
+    return False
+
+def _failed_task_result(task,exc_info):
+  if isinstance(task,LabeledObject):
+    return task.reapply_label_to_result(exc_info)
+  return exc_info
+
+class WorkerLossMonitor(threading.Thread):
+  '''
+  Daemon thread checking every interval seconds for worker processes that
+  died. multiprocessing.Pool replaces a dead worker but never completes the
+  task it was running, leaving the pool's result iterator waiting forever, so
+  for each such task the monitor
+    - kills the programs the worker registered in PIDregistry,
+    - releases the worker's admission gates and activity record, and
+    - under policy 'retry', dispatches the task again, up to retries times,
+      or else, and under policy 'fail', completes it with a WorkerLostError
+  Slots taken by dead workers (see Worker.claim_slot) are returned to their
+  queues, so that replacement workers can take them.
+  
+  Workers are entered in claims until they exit cleanly, so that only those
+  that died count as lost, and are identified by PID and creation time, so
+  that a worker taking the PID of a dead one is not. Tasks are TrackedTasks, recorded in inflight by the
+  worker running them.
+  Records are removed here, as results reach the pool's result iterator, so
+  that a worker dying after its task finished but before its result was sent
+  does not go unnoticed. A task whose result does arrive after it was
+  recovered, or more than once, is completed only once.
+  '''
+  def __init__(self,inflight,claims,slot_queues,policy,retries,interval,
+               PIDregistry=None,gates=(),activity=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.inflight = inflight
+    self.claims = claims
+    self.slot_queues = slot_queues
+    self.policy = policy
+    self.retries = retries
+    self.interval = interval
+    self.PIDregistry = PIDregistry
+    self.gates = gates
+    self.activity = activity
+    # Task ids of recovered tasks, and of those of them completed since
+    self.recovered = set()
+    self.resolved = set()
+    self.lock = threading.Lock()
+    self._stopped = threading.Event()
+  
+  def watch(self,pool,results):
+    '''
+    Start monitoring pool, whose imap_unordered() iterator results is to
+    receive the results of lost tasks, intercepting results as they arrive
+    '''
+    self.pool = pool
+    self.results = results
+    self._set = results._set
+    results._set = self.arrived
+    self.start()
+  
+  def deliver(self,result):
+    # Completes one task of the iterator, as the pool's result handler would
+    self._set(None,(True,result))
+  
+  def arrived(self,i,obj):
+    '''
+    Called in place of the iterator's _set() by the pool's result handler
+    thread, and for the results of retried tasks
+    '''
+    success,value = obj
+    if success and isinstance(value,TrackedTask):
+      with self.lock:
+        self.inflight.pop((value.task_id,value.attempt),None)
+        if value.task_id in self.recovered:
+          if value.task_id in self.resolved:
+            return
+          self.resolved.add(value.task_id)
+      obj = (True,value.obj)
+    self._set(i,obj)
+  
+  def retried(self,result):
+    self.arrived(None,(True,result))
+  
+  def recover(self,key,name,task):
+    task_id,attempt = key
+    with self.lock:
+      if self.inflight.pop(key,None) is None:
+        # The result arrived in the meantime
+        return
+      self.recovered.add(task_id)
+      resolved = task_id in self.resolved
+      retry = not resolved and self.policy == 'retry' and \
+                                                    attempt < self.retries
+      if not (resolved or retry):
+        self.resolved.add(task_id)
+    if self.PIDregistry is not None:
+      registered = self.PIDregistry.pop(name,None)
+      if registered is not None:
+        for pid in resources.registered_PIDs(registered):
+          resources.kill_process_tree(pid)
+    for gate in self.gates:
+      gate.release(name)
+    if self.activity is not None:
+      self.activity.pop(name,None)
+    if resolved:
+      return
+    elif retry:
+      self.pool.apply_async(_call_worker_in_worker_proc,
+                            (TrackedTask(task_id,attempt+1,task),),
+                            callback=self.retried)
+    else:
+      try:
+        raise WorkerLostError('Worker process %s died while running a task '\
+                              'after %d attempt(s)' % (name,attempt+1))
+      except WorkerLostError:
+        self.deliver(_failed_task_result(task,sys.exc_info()))
+  
+  def check(self):
+    # Workers that died without exiting cleanly, all records of which are in
+    # inflight by now, as dead processes write no more of them
+    died = set()
+    for worker,claimed in self.claims.items():
+      if not _alive(worker):
+        self.claims.pop(worker,None)
+        died.add(worker)
+        for kind,slot in claimed:
+          self.slot_queues[kind].put(slot)
+    for key,(worker,name,task) in self.inflight.items():
+      if worker in died:
+        self.recover(key,name,task)
+  
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      self.check()
+  
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
 def _call_worker_in_worker_proc(task_arg):
   return globals()['worker'](task_arg)
 
@@ -96,17 +817,298 @@ def registerPID(PIDregistry,PID):
   PIDregistry[multiprocessing.current_process().name] = PID
 
 class PoolManager(object):
+  '''
+  Maps work_doer, an arbitrary callable or a CommandLineCaller subclass, over
+  sequence_to_map in a pool of numproc worker processes. Any extra keyword
+  arguments are passed on to work_doer.
+  
+  CPU oversubscription control:
+    :param cores_per_task: Number of cores each task needs, e.g. the thread
+                           count of a multithreaded CLI program
+                           numproc is capped so that numproc*cores_per_task
+                           does not exceed the number of available CPUs, and
+                           thread count environment variables (OMP_NUM_THREADS
+                           etc.) in worker processes are set to this value
+                           Defaults to cores_per_task class attribute if
+                           work_doer is a CommandLineCaller subclass
+    :param pin_workers: Boolean flag indicating whether each worker process,
+                        along with everything it launches, should be pinned to
+                        its own set of cores_per_task CPUs (1 if cores_per_task
+                        is None)
+  
+  Memory admission control (see resources.MemoryGate):
+    :param task_memory: Estimated memory in bytes needed by each task, or a
+                        callable returning the estimate given a sequence item
+    :param memory_budget: Maximum memory in bytes running tasks together may
+                          use, counting the RSS of processes launched by
+                          CommandLineCaller work_doers
+    :param min_available_memory: Minimum system available memory in bytes
+                                 below which no new task is started
+  
+  Result transport:
+    :param result_extractor: Callable applied to each result inside the worker
+                             process, reducing it to what is sent back, e.g.
+                             to a few fields of a CommandLineCaller (see also
+                             CommandLineCaller.result())
+    :param spill_threshold: Size in bytes above which a result is written to a
+                            spill file by the worker instead of being sent
+                            through the pool's result pipe
+                            Such results are yielded as mapped.SpilledResult
+                            handles, to be consumed with load() or mmap() and
+                            release()
+    :param spill_dir: Directory where spill files are created
+                      If None, the temporary location specified by the OS
+  
+  Worker process lifetime:
+    :param maxtasksperchild: Number of tasks after which a worker process is
+                             replaced by a fresh one, releasing any memory
+                             leaked by the work done in it
+                             If None, workers live as long as the pool
+    :param preload_modules: Names of modules to import in the parent process
+                            before workers are forked, so that every worker,
+                            including replacement workers, starts with them
+                            already loaded and shares their memory pages
+  
+  Progress telemetry (see telemetry.PoolStats):
+    :param collect_stats: Boolean flag indicating whether progress and
+                          per-worker activity should be tracked and made
+                          available through snapshot()
+    :param stats_callback: Callable periodically passed a snapshot() while
+                           results are being iterated over, and once at the
+                           end, e.g. a telemetry.MetricsFileExporter
+                           Implies collect_stats
+    :param stats_interval: Seconds between calls to stats_callback
+  
+  Tracing and profiling:
+    :param trace_file: Path of a Chrome trace/Perfetto JSON file to be written
+                       once iteration ends, tracing for every task the time
+                       spent queued, in admission, working, handling and
+                       transferring its result, as well as worker startup and,
+                       for CommandLineCaller work_doers, program spawning,
+                       running and CLI context cleanup
+    :param profile_file: Path of a file to which cProfile statistics of all
+                         worker processes, merged, are written once iteration
+                         ends (readable with pstats)
+                         Workers terminated after an error do not contribute
+  
+  Resource classes (see resources.ResourceGate):
+    :param resource_limits: Mapping of resource class name, e.g. 'disk' or a
+                            license-limited program, to the maximum number of
+                            tasks using it that may run at once
+                            Tasks using none of the classes are not limited
+    :param resource_classes: Names of the resource classes every task uses, or
+                             a callable returning the names given a sequence
+                             item (the list of items in a batch)
+                             Defaults to the resource_classes class attribute
+                             if work_doer is a CommandLineCaller subclass
+    :param resource_priorities: Mapping of resource class name to the 'nice'
+                                increment and/or 'ionice' (class,level) of
+                                programs launched by CommandLineCaller tasks
+                                using it
+  
+  Dynamic resizing (see resources.ConcurrencyGate):
+    :param resizable: Boolean flag indicating whether the number of tasks
+                      running at once may be changed with resize() while the
+                      pool runs, between 1 and numproc
+    :param initial_numproc: Number of tasks running at once when a resizable
+                            pool starts
+                            If None, numproc
+    :param scaling_policy: Callable taking the current and maximum number of
+                           tasks running at once and returning the desired
+                           number, called every scaling_interval seconds while
+                           results are being iterated over, e.g. a
+                           resources.LoadScalingPolicy
+                           Implies resizable
+    :param scaling_interval: Seconds between calls to scaling_policy
+  
+  Batching:
+    :param batch_size: Maximum number of sequence items passed to work_doer
+                       together, as a list, in a single task, e.g. to have a
+                       CommandLineCaller process several inputs in one program
+                       run
+    :param batch_bytes: Maximum total length of the sequence items in a batch,
+                        e.g. of input strings; an item longer than this is
+                        batched alone
+    :param batch_splitter: Callable taking the result of a batch and the list
+                           of items in it and returning the list of per-item
+                           results, in the same order
+                           If None, the result of a batch must itself be that
+                           list
+    Results are yielded per item, with their labels if items are labeled.
+    result_extractor and spill_threshold apply to per-item results, and
+    task_memory, if callable, is given the list of items in a batch. If a batch
+    fails, error_on_label is the list of labels of all items in it.
+  
+  File sharding (see sharding.FileShards):
+    :param map_records: Boolean flag indicating whether sequence_to_map is a
+                        sequence of sharding.FileShards, over the records of
+                        which work_doer is to be mapped
+                        Each shard is a single task, reading its records in
+                        the worker process, and results are yielded per
+                        record, labeled with the record's offset in the file
+                        Progress counts shards as dispatched but records as
+                        completed
+                        If the work for a record fails, error_on_label is the
+                        record's offset
+  
+  Per-worker state:
+    :param worker_setup: Callable run once in each worker process before it
+                         receives any tasks, e.g. to load reference data
+                         Its return value is available to every task run in
+                         that process through get_worker_state()
+    :param worker_teardown: Callable run when a worker process exits, passed
+                            the value returned by worker_setup (None without
+                            it), e.g. to close connections
+                            Workers terminated after an error skip it
+  
+  Broadcasting (see mapped.Broadcast):
+    :param broadcast: Mapping of keyword argument name to a large read-only
+                      value, such as a reference sequence or lookup table,
+                      passed on to work_doer as a mapped.Broadcast handle
+                      Only strings, bytearrays and buffers benefit: they are
+                      written once, to files removed when iteration ends, and
+                      read in place from the page cache, outside the heap of
+                      any process. Other values are shared by the forked
+                      worker processes copy-on-write exactly as a plain
+                      keyword argument is, including the copying of pages
+                      that reference counting writes to
+    :param broadcast_dir: Directory where broadcast files are created
+                          If None, the temporary location specified by the OS
+  
+  Affinity scheduling:
+    :param affinity_key: Callable returning the affinity key of a sequence
+                         item, e.g. the reference file it reads
+                         Items with the same key are queued for the same
+                         worker process, which takes them in turn, so that
+                         they find warm caches and per-worker state; a worker
+                         whose queue is empty steals from the longest queue
+                         Not compatible with batching or map_records
+  
+  Worker loss recovery (see WorkerLossMonitor):
+    :param worker_loss_policy: What to do with a task whose worker process
+                               died, e.g. killed by the OOM killer, while
+                               running it: 'fail' to raise a WorkerLostError
+                               for it, 'retry' to run it again
+                               If None, such a task is never completed and
+                               iteration waits for it forever
+    :param worker_loss_retries: Number of times a task is run again under
+                                policy 'retry' before it fails
+    :param worker_check_interval: Seconds between checks for dead workers
+  
+  Deduplication (see TaskDeduplicator):
+    :param dedup_key: Callable returning the key of a sequence item, or True
+                      to key items by a digest of their pickled value
+                      Items with equal keys are run as a single task, whose
+                      result is yielded for each of them, with their labels
+    :param dedup_memo_size: Maximum number of results kept for items whose
+                            duplicates come after their task completed
+    Results of duplicates are the same object, e.g. the same
+    mapped.SpilledResult handle.
+  
+  Aggregation:
+    :param combiner: Function of two results returning their combination,
+                     e.g. operator.add or merging of two histograms, which
+                     must be associative and commutative
+                     Each worker process combines the results of its tasks,
+                     after result extraction, so that only small
+                     acknowledgements and a few partial combinations are sent
+                     back; results are yielded as None, with their labels if
+                     labeled, and reduce() returns the combination of all of
+                     them
+                     Not compatible with dedup_key, result_sink or
+                     worker_loss_policy
+    :param flush_every: Number of results after which a worker sends back its
+                        partial combination, bounding its size
+                        If None, each worker sends its combination once, when
+                        it exits
+  
+  Result sinks:
+    :param result_sink: Sink to which worker processes write (label,result)
+                        records, after result extraction, instead of sending
+                        results back, e.g. a sinks.ShardSink
+                        Results are then yielded as None, with their labels if
+                        labeled, merely acknowledging completion
+                        Not compatible with dedup_key
+  '''
   def __init__(self,work_doer,sequence_to_map,numproc=None,labeled_items=False,
-                    number_seq_items=False,**kwargs):
+                    number_seq_items=False,cores_per_task=None,
+                    pin_workers=False,task_memory=0,memory_budget=None,
+                    min_available_memory=None,result_extractor=None,
+                    spill_threshold=None,spill_dir=None,maxtasksperchild=None,
+                    preload_modules=(),collect_stats=False,stats_callback=None,
+                    stats_interval=10.0,trace_file=None,profile_file=None,
+                    resizable=False,initial_numproc=None,scaling_policy=None,
+                    scaling_interval=5.0,batch_size=None,batch_bytes=None,
+                    batch_splitter=None,dedup_key=None,dedup_memo_size=1024,
+                    result_sink=None,map_records=False,worker_setup=None,
+                    worker_teardown=None,broadcast=None,broadcast_dir=None,
+                    affinity_key=None,worker_loss_policy=None,
+                    worker_loss_retries=1,worker_check_interval=1.0,
+                    combiner=None,flush_every=None,resource_limits=None,
+                    resource_classes=None,resource_priorities=None,**kwargs):
     if labeled_items and number_seq_items:
       raise ValueError("Only one of 'labeled_items' and 'number_seq_items' "\
                        "may be true")
-    elif labeled_items:
+    total = len(sequence_to_map) if hasattr(sequence_to_map,'__len__') else None
+    if labeled_items:
       self.sequence_to_map = LabeledObjectsSequence(sequence_to_map)
     elif number_seq_items:
       self.sequence_to_map = LabeledObjectsSequence(enumerate(sequence_to_map))
     else:
       self.sequence_to_map = sequence_to_map
+    batched = batch_size is not None or batch_bytes is not None
+    if batched and batch_size is not None and batch_size < 1:
+      raise ValueError("'batch_size' must be a positive integer")
+    elif batch_splitter is not None and not batched:
+      raise ValueError("'batch_splitter' requires 'batch_size' or "\
+                       "'batch_bytes'")
+    if map_records and (labeled_items or number_seq_items or batched or
+                        dedup_key is not None):
+      # Records are labeled with their offsets and batched by shard
+      raise ValueError("'map_records' cannot be combined with labeled or "\
+                       "numbered items, batching or deduplication")
+    if broadcast and set(broadcast).intersection(kwargs):
+      raise ValueError("Names in 'broadcast' must differ from other keyword "\
+                       "arguments")
+    if affinity_key is not None and (batched or map_records):
+      raise ValueError("'affinity_key' cannot be combined with batching or "\
+                       "'map_records'")
+    if worker_loss_policy not in (None,'fail','retry'):
+      raise ValueError("'worker_loss_policy' must be 'fail' or 'retry'")
+    if result_sink is not None and dedup_key is not None:
+      # Results would be written under item keys rather than labels
+      raise ValueError("'result_sink' cannot be combined with 'dedup_key'")
+    if combiner is not None and (dedup_key is not None or
+                                 result_sink is not None or
+                                 worker_loss_policy is not None):
+      # Duplicates would be combined once, and combinations held by lost
+      # workers could not be recovered
+      raise ValueError("'combiner' cannot be combined with 'dedup_key', "\
+                       "'result_sink' or 'worker_loss_policy'")
+    elif flush_every is not None and (combiner is None or flush_every < 1):
+      raise ValueError("'flush_every' must be a positive integer and "\
+                       "requires 'combiner'")
+    if resource_limits is None and (resource_classes is not None or
+                                    resource_priorities is not None):
+      raise ValueError("'resource_classes' and 'resource_priorities' require "\
+                       "'resource_limits'")
+    
+    is_controller = isinstance(work_doer,type) and issubclass(work_doer,
+                                                             CommandLineCaller)
+    if resource_limits is not None:
+      if resource_classes is None:
+        resource_classes = work_doer.resource_classes if is_controller else ()
+      resources.ResourceGate.check(resource_limits,resource_classes,
+                                   resource_priorities)
+    if cores_per_task is None and is_controller:
+      cores_per_task = work_doer.cores_per_task
+    if cores_per_task is not None or pin_workers:
+      # Never run more tasks at once than there are cores to give them
+      cpu_slots = resources.partition_cpus(cores_per_task or 1)
+      if not cpu_slots:
+        raise ValueError("Fewer CPUs available than 'cores_per_task'")
+      numproc = len(cpu_slots) if numproc is None else min(numproc,
+                                                           len(cpu_slots))
     
     self.shared_resources_manager = SyncManager()
     self.shared_resources_manager.start(initializer=init_process_to_ignore_SIGINT)
@@ -115,13 +1117,123 @@ class PoolManager(object):
     self.sleep_lock.acquire() # Workers will sleep by waiting to acquire lock
     self.ready_to_die_queue = self.shared_resources_manager.JoinableQueue()
     
-    if isinstance(work_doer,type) and issubclass(work_doer,CommandLineCaller):
+    worker_kwargs = {'nthreads':cores_per_task,'gates':[],'batched':batched,
+                     'sink':result_sink,'setup':worker_setup,
+                     'teardown':worker_teardown,
+                     'result_extractor':result_extractor,
+                     'spill_threshold':spill_threshold,'spill_dir':spill_dir}
+    if collect_stats or stats_callback is not None:
+      worker_kwargs['activity'] = self.shared_resources_manager.dict()
+      self.stats = telemetry.PoolStats(total,worker_kwargs['activity'])
+      self.sequence_to_map = self.stats.count_dispatched(self.sequence_to_map)
+      if stats_callback is not None:
+        self.stats_reporter = telemetry.StatsReporter(self.stats,stats_callback,
+                                                      stats_interval)
+    if dedup_key is not None:
+      self.deduplicator = TaskDeduplicator(
+                                   None if dedup_key is True else dedup_key,
+                                   dedup_memo_size,
+                                   labeled=labeled_items or number_seq_items)
+      self.sequence_to_map = self.deduplicator.dispatch(self.sequence_to_map)
+    if batched:
+      self.sequence_to_map = BatchedSequence(self.sequence_to_map,batch_size,
+                                             batch_bytes)
+    if affinity_key is not None:
+      nslots = multiprocessing.cpu_count() if numproc is None else numproc
+      worker_kwargs['affinity_queues'] = [self.shared_resources_manager.Queue()
+                                          for _ in xrange(nslots)]
+      worker_kwargs['affinity_slots'] = self.shared_resources_manager.Queue()
+      for slot in xrange(nslots):
+        worker_kwargs['affinity_slots'].put(slot)
+      self.sequence_to_map = AffinitySequence(self.sequence_to_map,
+                                              affinity_key,
+                                              worker_kwargs['affinity_queues'])
+    if trace_file is not None:
+      self.trace_file = trace_file
+      worker_kwargs['trace_dir'] = tempfile.mkdtemp(prefix='cliceo-trace-')
+      self.tracer = tracing.Tracer(worker_kwargs['trace_dir'],'PoolManager')
+      self.task_timeline = tracing.TaskTimeline(self.tracer)
+      self.sequence_to_map = self.task_timeline.tag_dispatched(
+                                                           self.sequence_to_map)
+    if profile_file is not None:
+      self.profile_file = profile_file
+      worker_kwargs['profile_dir'] = tempfile.mkdtemp(prefix='cliceo-profile-')
+      self.worker_profile_glob = os.path.join(worker_kwargs['profile_dir'],
+                                              '*.prof')
+    if pin_workers:
+      worker_kwargs['cpu_slots'] = self.shared_resources_manager.Queue()
+      for cpus in cpu_slots:
+        worker_kwargs['cpu_slots'].put(cpus)
+    
+    if resource_limits is not None:
+      # First in line, so that a task waiting for a resource class holds no
+      # concurrency slot or memory reservation
+      worker_kwargs['gates'].append(resources.ResourceGate(
+                                                 self.shared_resources_manager,
+                                                 resource_limits,
+                                                 resource_classes,
+                                                 resource_priorities))
+    
+    if resizable or scaling_policy is not None:
+      # All numproc worker processes are started, but only as many of them as
+      # the gate's target allows run a task at any time
+      maximum = multiprocessing.cpu_count() if numproc is None else numproc
+      self.concurrency_gate = resources.ConcurrencyGate(
+                                                 self.shared_resources_manager,
+                                                 initial_numproc or maximum)
+      worker_kwargs['gates'].append(self.concurrency_gate)
+      if scaling_policy is not None:
+        self.autoscaler = resources.Autoscaler(self.concurrency_gate,
+                                               scaling_policy,maximum,
+                                               scaling_interval)
+    
+    if is_controller:
       self.PIDregistry = self.shared_resources_manager.dict()
+    if memory_budget is not None or min_available_memory is not None:
+      memory_gate = resources.MemoryGate(self.shared_resources_manager,
+                                         task_memory=task_memory,
+                                         memory_budget=memory_budget,
+                                         min_available=min_available_memory,
+                                   PIDregistry=getattr(self,'PIDregistry',None))
+      worker_kwargs['gates'].append(memory_gate)
+    
+    if worker_loss_policy is not None:
+      self.sequence_to_map = TrackedSequence(self.sequence_to_map)
+      worker_kwargs['inflight'] = self.shared_resources_manager.dict()
+      worker_kwargs['claims'] = self.shared_resources_manager.dict()
+      slot_queues = dict((kind,worker_kwargs[kind])
+                         for kind in ['cpu_slots','affinity_slots']
+                         if kind in worker_kwargs)
+      self.worker_monitor = WorkerLossMonitor(worker_kwargs['inflight'],
+                                              worker_kwargs['claims'],
+                                              slot_queues,worker_loss_policy,
+                                              worker_loss_retries,
+                                              worker_check_interval,
+                                   PIDregistry=getattr(self,'PIDregistry',None),
+                                              gates=worker_kwargs['gates'],
+                                      activity=worker_kwargs.get('activity'))
+    
+    if combiner is not None:
+      self.accumulator = ResultAccumulator(combiner)
+      self.worker_partials = self.shared_resources_manager.Queue()
+      worker_kwargs.update(combiner=combiner,flush_every=flush_every,
+                           partials=self.worker_partials)
+    
+    if broadcast:
+      self.broadcasts = [mapped.Broadcast(value,broadcast_dir)
+                         for value in broadcast.values()]
+      kwargs.update(zip(broadcast.keys(),self.broadcasts))
+    
+    if is_controller:
       work_callable = PartializedControllerCallable(work_doer,
                                                     PIDpublisher=partial(
                                                                    registerPID,
                                                              self.PIDregistry),
                                                    **kwargs)
+      if batched:
+        work_callable = partial(call_batched,work_callable,batch_splitter)
+      elif map_records:
+        work_callable = partial(call_on_records,work_callable)
     
       def unregisterPID():
         try:
@@ -130,11 +1242,15 @@ class PoolManager(object):
           pass
       
       worker = Worker(work_callable,self.permission,self.sleep_lock,
-                      self.ready_to_die_queue,unregisterPID)
+                      self.ready_to_die_queue,unregisterPID,**worker_kwargs)
     else:
       work_callable = partial(work_doer,**kwargs)
+      if batched:
+        work_callable = partial(call_batched,work_callable,batch_splitter)
+      elif map_records:
+        work_callable = partial(call_on_records,work_callable)
       worker = Worker(work_callable,self.permission,self.sleep_lock,
-                      self.ready_to_die_queue)
+                      self.ready_to_die_queue,**worker_kwargs)
     
     def init_worker_process(worker):
       # Proper handling to KeyboardInterrupt achieved by having workers ignore
@@ -142,10 +1258,15 @@ class PoolManager(object):
       # worker shutdown.
       # See: http://noswap.com/blog/python-multiprocessing-keyboardinterrupt
       init_process_to_ignore_SIGINT()
+      worker.initialize()
       globals()['worker'] = worker
     
+    for module_name in preload_modules:
+      importlib.import_module(module_name)
+    
     self.proc_pool = multiprocessing.Pool(numproc,initializer=init_worker_process,
-                                          initargs=(worker,))
+                                          initargs=(worker,),
+                                          maxtasksperchild=maxtasksperchild)
   
   def announce_shutdown(self):
     for _ in xrange(self.proc_pool._processes):
@@ -159,36 +1280,90 @@ class PoolManager(object):
   
   def cleanup_workers(self):
     if hasattr(self,'PIDregistry'):
-      for pid in self.PIDregistry.values():
-        try:
-          top_proc = psutil.Process(pid=pid)
-          children = top_proc.children(recursive=True)
-          for proc in [top_proc]+children:
-            try:
-              proc.kill()
-            except psutil.NoSuchProcess:
-              pass
-        except psutil.NoSuchProcess:
-          pass
+      for registered in self.PIDregistry.values():
+        for pid in resources.registered_PIDs(registered):
+          resources.kill_process_tree(pid)
     self.ready_to_die_queue.join()
   
+  def _received(self,results):
+    '''
+    Per-item results, with their labels if labeled, from results of tasks run
+    by the pool, raising the error of any failed task
+    '''
+    for r in results:
+      if isinstance(r,tracing.TracedTask):
+        r = self.task_timeline.untag_received(r)
+      rval = r.result if isinstance(r,LabeledObject) else r
+      if isinstance(rval,tuple) and len(rval) == 3 and \
+                   isinstance(rval[0],type) and issubclass(rval[0],Exception):
+        if isinstance(r,LabeledObject):
+          if not hasattr(self,'deduplicator'):
+            self.error_on_label = r.label
+          elif self.deduplicator.labeled:
+            # Tasks are labeled with item keys
+            to_original = self.deduplicator.original_label
+            self.error_on_label = map(to_original,r.label)\
+                           if isinstance(r,Batch) else to_original(r.label)
+        raise rval[0],rval[1],rval[2] # Exception type, value, traceback
+      elif isinstance(r,Batch):
+        for item in (rval if r.label is None else zip(r.label,rval)):
+          yield item
+      else:
+        yield (r.label,rval) if isinstance(r,LabeledObject) else r
+  
+  def _fold_partials(self,results):
+    '''
+    Combine partial combinations flushed by workers into the pool's
+    accumulator, yielding bare acknowledgements in their place
+    '''
+    for r in results:
+      if isinstance(r,PartialAggregate):
+        self._add_partial(r.value)
+        r = None
+      elif isinstance(r,tuple) and isinstance(r[1],PartialAggregate):
+        self._add_partial(r[1].value)
+        r = (r[0],None)
+      yield r
+  
+  def _add_partial(self,value):
+    if isinstance(value,mapped.SpilledResult):
+      value = value.load()
+    self.accumulator.add(value)
+  
+  def _collect_remaining_partials(self):
+    # Put on the queue by workers as they exit
+    while True:
+      try:
+        self.accumulator.add(self.worker_partials.get_nowait())
+      except Queue.Empty:
+        return
+  
   def _iterate(self):
     '''
     Sequence order will not be preserved!
     '''
     try:
-      results = self.proc_pool.imap_unordered(_call_worker_in_worker_proc,
-                                              self.sequence_to_map)
+      if hasattr(self,'stats_reporter'):
+        self.stats_reporter.start()
+      if hasattr(self,'autoscaler'):
+        self.autoscaler.start()
+      pool_results = self.proc_pool.imap_unordered(_call_worker_in_worker_proc,
+                                                   self.sequence_to_map)
+      if hasattr(self,'worker_monitor'):
+        self.worker_monitor.watch(self.proc_pool,pool_results)
+      results = self._received(pool_results)
+      if hasattr(self,'deduplicator'):
+        results = self.deduplicator.fan_out(results)
+      if hasattr(self,'accumulator'):
+        results = self._fold_partials(results)
       for r in results:
-        rval = r.result if isinstance(r,LabeledObject) else r
-        if isinstance(rval,tuple) and len(rval) == 3 and issubclass(rval[0],
-                                                                    Exception):
-          if isinstance(r,LabeledObject):
-            self.error_on_label = r.label
-          raise rval[0],rval[1],rval[2] # Exception type, value, traceback
-        else:
-          yield (r.label,rval) if isinstance(r,LabeledObject) else r
+        if hasattr(self,'stats'):
+          self.stats.count_completed()
+        yield r
     except:
+      if hasattr(self,'worker_monitor') and self.worker_monitor.is_alive():
+        # Workers are about to be terminated, not lost
+        self.worker_monitor.stop()
       self.announce_shutdown()
       self.cleanup_workers()
       self.proc_pool.terminate()
@@ -196,7 +1371,73 @@ class PoolManager(object):
     finally:
       self.proc_pool.close()
       self.proc_pool.join()
+      if hasattr(self,'stats_reporter') and self.stats_reporter.is_alive():
+        self.stats_reporter.stop()
+      if hasattr(self,'autoscaler') and self.autoscaler.is_alive():
+        self.autoscaler.stop()
+      if hasattr(self,'worker_monitor') and self.worker_monitor.is_alive():
+        self.worker_monitor.stop()
+      if hasattr(self,'stats'):
+        # Worker activity is kept by the shared resources manager, and every
+        # worker is idle by now
+        self.stats.worker_activity = dict.fromkeys(
+                                           self.stats.worker_activity.keys())
+      if hasattr(self,'worker_partials'):
+        self._collect_remaining_partials()
       self.shared_resources_manager.shutdown()
+      if hasattr(self,'trace_file'):
+        self._write_trace()
+      if hasattr(self,'profile_file'):
+        self._merge_profiles()
+      if hasattr(self,'broadcasts'):
+        for handle in self.broadcasts:
+          handle.release()
+  
+  def _write_trace(self):
+    trace_dir = self.tracer.trace_dir
+    self.task_timeline.trace_queueing_and_transfer(
+                                                 tracing.read_events(trace_dir))
+    self.tracer.close()
+    tracing.write_trace(tracing.read_events(trace_dir),self.trace_file)
+    shutil.rmtree(trace_dir,ignore_errors=True)
+  
+  def _merge_profiles(self):
+    profile_dir = os.path.dirname(self.worker_profile_glob)
+    profiles = glob.glob(self.worker_profile_glob)
+    if profiles:
+      pstats.Stats(*profiles).dump_stats(self.profile_file)
+    shutil.rmtree(profile_dir,ignore_errors=True)
+  
+  def resize(self,numproc):
+    '''
+    Change the number of tasks running at once, within 1 and the number of
+    worker processes. Tasks already running are not interrupted.
+    '''
+    if not hasattr(self,'concurrency_gate'):
+      raise ValueError("Only a pool created with 'resizable' true or a "\
+                       "'scaling_policy' can be resized")
+    self.concurrency_gate.resize(max(1,min(numproc,self.proc_pool._processes)))
+  
+  def reduce(self):
+    '''
+    Iterate over any results not yet iterated over and return the combination
+    of all results by combiner (None if there were none)
+    '''
+    if not hasattr(self,'accumulator'):
+      raise ValueError("Only a pool created with a 'combiner' can be reduced")
+    for _ in self:
+      pass
+    return self.accumulator.value
+  
+  def snapshot(self):
+    '''
+    Current progress figures, see telemetry.PoolStats.snapshot()
+    Once iteration has ended, all workers are reported as idle.
+    '''
+    if not hasattr(self,'stats'):
+      raise ValueError("Statistics are only collected if 'collect_stats' is "\
+                       "true or a 'stats_callback' is given")
+    return self.stats.snapshot()
   
   def __iter__(self):
       if not hasattr(self,'_iterator'):
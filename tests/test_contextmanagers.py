@@ -1,3 +1,5 @@
+import os
+import errno
 import unittest
 from mock import patch,Mock,MagicMock
 from cliceo import contextmanagers
@@ -99,3 +101,79 @@ class test_CLIcontextManager(unittest.TestCase):
     self.assertEqual(modified_prefix_and_suffix[:4],'pref')
     self.assertEqual(modified_prefix_and_suffix[-3:],'suf')
       
+  
+  def test_exception_details_passed_to_pushed_context(self):
+    cliCM = contextmanagers.CLIcontextManager()
+    exit_callback = Mock(return_value=False)
+    cliCM.push(exit_callback)
+    with self.assertRaises(ValueError):
+      with cliCM:
+        raise ValueError
+    self.assertIs(exit_callback.call_args[0][0],ValueError)
+
+
+class test_file_staging(unittest.TestCase):
+  
+  def setUp(self):
+    import tempfile
+    self.tmpdir = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmpdir,'input.txt')
+    with open(self.src,'w') as fh:
+      fh.write('contents')
+  
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.tmpdir)
+  
+  def test_fallback_through_methods(self):
+    dst = os.path.join(self.tmpdir,'staged')
+    with patch('fcntl.ioctl',side_effect=IOError(errno.EOPNOTSUPP,'')):
+      self.assertEqual(contextmanagers.stage_file(self.src,dst),'hardlink')
+    self.assertEqual(os.stat(dst).st_ino,os.stat(self.src).st_ino)
+    os.unlink(dst)
+    with patch('os.link',side_effect=OSError(errno.EXDEV,'')):
+      self.assertEqual(contextmanagers.stage_file(self.src,dst,
+                                           ('hardlink','symlink')),'symlink')
+    self.assertEqual(os.readlink(dst),self.src)
+    os.unlink(dst)
+    self.assertEqual(contextmanagers.stage_file(self.src,dst,('copy',)),'copy')
+    self.assertFalse(os.path.islink(dst))
+    with open(dst) as fh:
+      self.assertEqual(fh.read(),'contents')
+    os.unlink(dst)
+    with patch('os.link',side_effect=OSError(errno.EXDEV,'')):
+      with self.assertRaises(OSError):
+        contextmanagers.stage_file(self.src,dst,('hardlink',))
+    # Other errors are not taken for a missing feature
+    with patch('os.link',side_effect=OSError(errno.EACCES,'')):
+      with self.assertRaises(OSError):
+        contextmanagers.stage_file(self.src,dst,('hardlink','copy'))
+    self.assertFalse(os.path.exists(dst))
+  
+  def test_existing_file_never_replaced(self):
+    existing = os.path.join(self.tmpdir,'existing.txt')
+    with open(existing,'w') as fh:
+      fh.write('keep')
+    with self.assertRaises(OSError) as cm:
+      with contextmanagers.CLIcontextManager() as cliCM:
+        cliCM.stage_file(self.src,self.tmpdir,name='existing.txt')
+    self.assertEqual(cm.exception.errno,errno.EEXIST)
+    with open(existing) as fh:
+      self.assertEqual(fh.read(),'keep')
+  
+  def test_reflink_or_fallback_leaves_no_partial_file(self):
+    dst = os.path.join(self.tmpdir,'staged')
+    method = contextmanagers.stage_file(self.src,dst,('reflink','copy'))
+    with open(dst) as fh:
+      self.assertEqual(fh.read(),'contents')
+    self.assertTrue(method in ('reflink','copy'))
+  
+  def test_staged_file_removed_on_exit(self):
+    subdir = os.path.join(self.tmpdir,'workdir')
+    os.mkdir(subdir)
+    with contextmanagers.CLIcontextManager() as cliCM:
+      staged = cliCM.stage_file(self.src,subdir,name='renamed.txt')
+      self.assertEqual(staged,os.path.join(subdir,'renamed.txt'))
+      self.assertTrue(os.path.exists(staged))
+    self.assertFalse(os.path.exists(staged))
+    self.assertTrue(os.path.exists(self.src))
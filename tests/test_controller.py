@@ -5,6 +5,10 @@ import subprocess
 from tempfile import template as TEMPFILE_TEMPLATE
 from cliceo import controller
 
+
+class TestError(Exception):
+  pass
+
 @patch('subprocess.Popen')
 class test_CommandLineCaller(unittest.TestCase):
   
@@ -152,6 +156,30 @@ class test_CommandLineCaller(unittest.TestCase):
     self.assertIs(dummycontroller.stderr,subprocess.STDOUT)
     dummycontroller()
     self.assertFalse(patched_open.called)
+  
+  def test_thread_count_env_injection(self,patched_Popen):
+    patched_Popen.return_value.communicate.return_value = (None,None)
+    class MultithreadedController(controller.CommandLineCaller):
+      cores_per_task = 3
+    dummycontroller = MultithreadedController('dummy_callstr')
+    dummycontroller()
+    env = patched_Popen.call_args[1]['env']
+    self.assertEqual(env['OMP_NUM_THREADS'],'3')
+    dummycontroller = MultithreadedController('dummy_callstr',nthreads=5)
+    dummycontroller()
+    env = patched_Popen.call_args[1]['env']
+    self.assertEqual(env['OMP_NUM_THREADS'],'5')
+  
+  @patch('cliceo.resources.child_priority',return_value=(5,None))
+  def test_child_priority(self,patched_child_priority,patched_Popen):
+    patched_Popen.return_value.communicate.return_value = (None,None)
+    controller.CommandLineCaller('dummy_callstr')()
+    preexec_fn = patched_Popen.call_args[1]['preexec_fn']
+    self.assertIs(preexec_fn.func,controller.resources.apply_priority)
+    self.assertEqual(preexec_fn.args,(5,None))
+    patched_child_priority.return_value = None
+    controller.CommandLineCaller('dummy_callstr')()
+    self.assertFalse('preexec_fn' in patched_Popen.call_args[1])
 
 # @patch('subprocess.Popen')
 # class test_CLIcontrollerBase_std_stream_handling(unittest.TestCase):
@@ -300,3 +328,224 @@ class test_CommandLineCaller(unittest.TestCase):
 #     self.assertEqual(dummycontroller.callstr.split()[0],'ls')
 #     self.assertItemsEqual(dummycontroller.callstr.split()[1:],
 #                           ['-l','-vo=value','-u->unknown','--another->a'])
+
+
+class test_CommandLineCaller_STDIN_feeding(unittest.TestCase):
+  
+  @patch('subprocess.Popen')
+  def test_string_input(self,patched_Popen):
+    patched_Popen.return_value.communicate.return_value = (None,None)
+    dummycontroller = controller.CommandLineCaller('dummy_callstr',
+                                                   input_source='data')
+    dummycontroller()
+    patched_Popen.assert_called_once_with('dummy_callstr',stdout=None,
+                                          stderr=None,stdin=subprocess.PIPE,
+                                          shell=True)
+    patched_Popen.return_value.communicate.assert_called_once_with('data')
+  
+  def test_generator_input(self):
+    pulled = []
+    def chunks():
+      for i in xrange(2000):
+        pulled.append(i)
+        yield '%d\n' % i
+    dummycontroller = controller.CommandLineCaller('wc -l',
+                                                   input_source=chunks(),
+                                                   capture_stdout=True)
+    dummycontroller()
+    self.assertEqual(dummycontroller.captured_stdout.strip(),'2000')
+    self.assertEqual(len(pulled),2000)
+  
+  def test_input_stops_when_program_exits(self):
+    def endless_chunks():
+      while True:
+        yield 'y\n'*1000
+    dummycontroller = controller.CommandLineCaller('head -n 1',
+                                                   input_source=endless_chunks(),
+                                                   capture_stdout=True)
+    dummycontroller()
+    self.assertEqual(dummycontroller.captured_stdout,'y\n')
+  
+  def test_file_input(self):
+    import tempfile
+    from StringIO import StringIO
+    with tempfile.TemporaryFile() as fh:
+      fh.write('a\nb\n')
+      fh.seek(0)
+      dummycontroller = controller.CommandLineCaller('cat',input_source=fh,
+                                                     capture_stdout=True)
+      self.assertIs(dummycontroller._stdin(),fh)
+      dummycontroller()
+    self.assertEqual(dummycontroller.captured_stdout,'a\nb\n')
+    dummycontroller = controller.CommandLineCaller('cat',
+                                                   input_source=StringIO('c'),
+                                                   capture_stdout=True)
+    dummycontroller()
+    self.assertEqual(dummycontroller.captured_stdout,'c')
+  
+  def test_input_source_errors_raised(self):
+    def failing_chunks():
+      yield 'a'
+      raise TestError
+    dummycontroller = controller.CommandLineCaller('cat',
+                                                   input_source=failing_chunks(),
+                                                   silence_stdout=True)
+    with self.assertRaises(TestError):
+      dummycontroller()
+
+
+class test_CommandLineCaller_declared_outputs(unittest.TestCase):
+  
+  def test_outputs_kept_from_tmpdir(self):
+    import tempfile
+    outputs_loc = tempfile.mkdtemp()
+    try:
+      class DummyController(controller.CommandLineCaller):
+        output_files = ['out.txt']
+      dummycontroller = DummyController('printf abcdef > out.txt',
+                                        in_tmpdir=True,outputs_loc=outputs_loc)
+      dummycontroller()
+      self.assertFalse(os.path.exists(dummycontroller.tmpdir))
+      handle = dummycontroller.outputs['out.txt']
+      self.assertEqual(os.path.dirname(handle.path),outputs_loc)
+      self.assertEqual(handle.mmap()[2:4],'cd')
+      handle.release()
+      self.assertEqual(os.listdir(outputs_loc),[])
+    finally:
+      os.rmdir(outputs_loc)
+  
+  def test_missing_output(self):
+    dummycontroller = controller.CommandLineCaller('true',in_tmpdir=True,
+                                                   output_files=['out.txt'])
+    with self.assertRaises(IOError):
+      dummycontroller()
+  
+  @patch('subprocess.Popen',side_effect=OSError)
+  def test_outputs_not_collected_on_error(self,patched_Popen):
+    dummycontroller = controller.CommandLineCaller('dummy_callstr',
+                                                   output_files=['out.txt'])
+    with self.assertRaises(OSError):
+      dummycontroller()
+    self.assertFalse(hasattr(dummycontroller,'outputs'))
+
+
+class test_CommandLineCaller_output_to_files(unittest.TestCase):
+  
+  def test_streams_written_to_files(self):
+    import tempfile
+    dirpath = tempfile.mkdtemp()
+    try:
+      out_path = os.path.join(dirpath,'out.txt')
+      err_path = os.path.join(dirpath,'err.txt')
+      dummycontroller = controller.CommandLineCaller('echo out; echo err >&2',
+                                                     capture_stdout=True,
+                                                     stdout_path=out_path,
+                                                     stderr_path=err_path)
+      dummycontroller()
+      self.assertIsNone(dummycontroller.captured_stdout)
+      self.assertTrue(dummycontroller.stdout.closed)
+      with open(out_path) as fh:
+        self.assertEqual(fh.read(),'out\n')
+      with open(err_path) as fh:
+        self.assertEqual(fh.read(),'err\n')
+    finally:
+      import shutil
+      shutil.rmtree(dirpath)
+  
+  def test_stdout_file_as_declared_output_in_tmpdir(self):
+    import tempfile
+    outputs_loc = tempfile.mkdtemp()
+    try:
+      dummycontroller = controller.CommandLineCaller('printf abc',
+                                                     in_tmpdir=True,
+                                                     outputs_loc=outputs_loc,
+                                                     stdout_path='out.txt',
+                                                     output_files=['out.txt'])
+      dummycontroller()
+      handle = dummycontroller.outputs['out.txt']
+      self.assertEqual(handle.mmap()[:],'abc')
+      handle.release()
+    finally:
+      os.rmdir(outputs_loc)
+  
+  def test_err_to_out_precedence_over_stderr_path(self):
+    dummycontroller = controller.CommandLineCaller('dummy_callstr',
+                                                   err_to_out=True,
+                                                   stderr_path='err.txt')
+    self.assertIsNone(dummycontroller.stderr_path)
+    self.assertIs(dummycontroller.stderr,subprocess.STDOUT)
+
+
+class test_CommandLinePipeline(unittest.TestCase):
+  
+  def test_streaming_through_stages(self):
+    mockPIDpublisher = Mock()
+    pipeline = controller.CommandLinePipeline(['printf "a\\nb\\nc\\n"',
+                                               'grep -v b; echo grep >&2',
+                                               'wc -l'],
+                                              PIDpublisher=mockPIDpublisher,
+                                              capture_stdout=True,
+                                              capture_stderr=True)
+    pipeline()
+    self.assertEqual(pipeline.captured_stdout.strip(),'2')
+    self.assertEqual(pipeline.captured_stderr,['','grep\n',''])
+    self.assertEqual(pipeline.returncodes,[0,0,0])
+    published = [c[0][0] for c in mockPIDpublisher.call_args_list]
+    self.assertEqual([len(pids) for pids in published],[1,2,3])
+    self.assertEqual(published[-1][:2],published[1])
+  
+  def test_per_stage_STDERR_control(self):
+    stage = controller.CommandLineCaller('echo silenced >&2; echo x',
+                                         silence_stderr=True)
+    pipeline = controller.CommandLinePipeline([stage,'cat >&2'],
+                                              capture_stderr=True)
+    pipeline()
+    self.assertEqual(pipeline.captured_stderr,[None,'x\n'])
+  
+  def test_stage_STDERR_to_file(self):
+    import tempfile
+    fd,err_path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      pipeline = controller.CommandLinePipeline(['echo a >&2; echo x',
+                                                 'cat; echo b >&2'],
+                                                stderr_path=err_path,
+                                                capture_stdout=True)
+      pipeline()
+      self.assertEqual(pipeline.captured_stdout,'x\n')
+      with open(err_path) as fh:
+        self.assertEqual(sorted(fh.read().split()),['a','b'])
+    finally:
+      os.unlink(err_path)
+  
+  @patch('cliceo.resources.child_priority',return_value=(3,None))
+  def test_stage_priority(self,patched_child_priority):
+    pipeline = controller.CommandLinePipeline(['ps -o ni= -p $$','cat'],
+                                              capture_stdout=True)
+    pipeline()
+    self.assertEqual(int(pipeline.captured_stdout),os.nice(0)+3)
+  
+  def test_input_fed_to_first_stage(self):
+    pipeline = controller.CommandLinePipeline(['sort -r','head -n 2'],
+                                    input_source=('%d\n' % i for i in xrange(5)),
+                                              capture_stdout=True)
+    pipeline()
+    self.assertEqual(pipeline.captured_stdout,'4\n3\n')
+  
+  def test_early_exit_of_reader_stops_writer(self):
+    pipeline = controller.CommandLinePipeline(['yes','head -n 2'],
+                                              capture_stdout=True)
+    pipeline()
+    self.assertEqual(pipeline.captured_stdout,'y\ny\n')
+    self.assertEqual(pipeline.returncodes[1],0)
+  
+  @patch('cliceo.resources.kill_process_tree')
+  @patch('subprocess.Popen')
+  def test_teardown_on_failure(self,patched_Popen,patched_kill_process_tree):
+    first_stage = Mock()
+    patched_Popen.side_effect = [first_stage,OSError]
+    pipeline = controller.CommandLinePipeline(['dummy1','dummy2'])
+    with self.assertRaises(OSError):
+      pipeline()
+    patched_kill_process_tree.assert_called_once_with(first_stage.pid)
+    first_stage.wait.assert_called_once_with()
@@ -0,0 +1,38 @@
+import random
+import unittest
+from mock import patch
+from cliceo import faketool
+
+
+class test_faketool(unittest.TestCase):
+  
+  def test_runtime_distributions(self):
+    rng = random.Random(0)
+    self.assertEqual(faketool.draw_runtime(rng,0.5,'fixed'),0.5)
+    self.assertEqual(faketool.draw_runtime(rng,0,'exponential'),0.0)
+    for distribution in faketool.RUNTIME_DISTRIBUTIONS:
+      draws = [faketool.draw_runtime(rng,1.0,distribution)
+               for _ in xrange(20000)]
+      self.assertAlmostEqual(sum(draws)/len(draws),1.0,delta=0.1)
+  
+  @patch('time.sleep')
+  def test_repeatable_behavior(self,patched_sleep):
+    args = ['--runtime','1','--runtime-dist','uniform','--fail-rate','0.5',
+            '--seed','3']
+    outcomes = [faketool.main(args+['--task',str(task)])
+                for task in xrange(20)]
+    sleeps = [c for c in patched_sleep.call_args_list]
+    self.assertEqual(set(outcomes),set([0,1]))
+    patched_sleep.reset_mock()
+    self.assertEqual([faketool.main(args+['--task',str(task)])
+                      for task in xrange(20)],outcomes)
+    self.assertEqual(patched_sleep.call_args_list,sleeps)
+  
+  @patch('time.sleep')
+  def test_hang_and_output(self,patched_sleep):
+    with patch('sys.stdout') as patched_stdout:
+      faketool.main(['--hang-rate','1','--hang-seconds','60',
+                     '--output-bytes','100'])
+    patched_sleep.assert_called_with(60.0)
+    written = ''.join(c[0][0] for c in patched_stdout.write.call_args_list)
+    self.assertEqual(len(written),100)
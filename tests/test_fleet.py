@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import threading
+import multiprocessing
+from mock import patch,call
+from cliceo import fleet,controller
+
+
+class TestError(Exception):
+  pass
+
+
+def square_or_fail(i):
+  if i == 'fail':
+    raise TestError
+  time.sleep(0.01)
+  return i*i
+
+def make_lock(_):
+  return threading.Lock()
+
+def finish_time(_):
+  return time.time()
+
+def worker_pid(_):
+  time.sleep(0.01)
+  return os.getpid()
+
+def submit_remotely(address,results):
+  job = fleet.connect(address,'secret').submit(worker_pid,xrange(20))
+  results.put(list(job))
+
+class SleepController(controller.CommandLineCaller):
+  def __init__(self,seconds,**kwargs):
+    if seconds == 'fail':
+      raise TestError
+    controller.CommandLineCaller.__init__(self,'sleep %s' % seconds,**kwargs)
+  
+  def result(self):
+    return self.returncode
+
+
+class test_WorkerFleet(unittest.TestCase):
+  
+  def test_concurrent_jobs(self):
+    with fleet.WorkerFleet(2) as workers:
+      job_a = workers.submit(square_or_fail,xrange(10),weight=2)
+      job_b = workers.submit(square_or_fail,xrange(5),number_seq_items=True)
+      self.assertItemsEqual(job_b,[(i,i*i) for i in xrange(5)])
+      self.assertItemsEqual(job_a,[i*i for i in xrange(10)])
+    self.assertEqual(workers.jobs,[])
+  
+  def test_weighted_fair_share(self):
+    with fleet.WorkerFleet(1) as workers:
+      with workers._cond:
+        # Hold scheduling until both jobs are submitted
+        heavy = workers.submit(finish_time,[None]*6,weight=2)
+        light = workers.submit(finish_time,[None]*6)
+      finished = sorted([(t,'H') for t in heavy]+[(t,'L') for t in light])
+    # While both jobs have tasks left, the heavy one gets two tasks for every
+    # one of the light job
+    self.assertEqual(''.join(job for _,job in finished),'HLHHLHHLHLLL')
+  
+  def test_unpicklable_result_fails_job(self):
+    with fleet.WorkerFleet(2) as workers:
+      job = workers.submit(make_lock,[1])
+      with self.assertRaises(TypeError):
+        list(job)
+    self.assertEqual(workers.in_flight,0)
+  
+  def test_job_scoped_halt_on_error(self):
+    with fleet.WorkerFleet(3) as workers:
+      failing = workers.submit(square_or_fail,[('a',1),('b','fail')],
+                               labeled_items=True)
+      healthy = workers.submit(square_or_fail,xrange(6))
+      with self.assertRaises(TestError):
+        list(failing)
+      self.assertEqual(failing.error_on_label,'b')
+      self.assertItemsEqual(healthy,[i*i for i in xrange(6)])
+  
+  def test_failed_job_programs_killed(self):
+    with fleet.WorkerFleet(2) as workers:
+      started = time.time()
+      failing = workers.submit(SleepController,['30','fail'])
+      with self.assertRaises(TestError):
+        list(failing)
+      self.assertEqual(list(workers.submit(SleepController,['0'])),[0])
+    # Also when the failing task fails before the other launches its program
+    self.assertTrue(time.time()-started < 10)
+  
+  @patch('cliceo.resources.kill_process_tree')
+  def test_cancelled_job_tasks(self,patched_kill):
+    cancelled = {3:True}
+    self.assertIsNone(fleet._run_task(3,square_or_fail,False,{},{},cancelled,
+                                      'fail'))
+    # A program registered after cancellation is killed right away
+    fleet._register_PID({},cancelled,3,(11,12))
+    self.assertEqual(patched_kill.call_args_list,[call(11),call(12)])
+    fleet._register_PID({},cancelled,4,13)
+    self.assertEqual(patched_kill.call_count,2)
+
+
+class test_served_fleet(unittest.TestCase):
+  
+  def setUp(self):
+    self.dirpath = tempfile.mkdtemp()
+    self.address = os.path.join(self.dirpath,'fleet')
+    self.server = multiprocessing.Process(target=fleet.serve,
+                                          args=(self.address,'secret',2))
+    self.server.start()
+    while not os.path.exists(self.address):
+      time.sleep(0.01)
+  
+  def tearDown(self):
+    os.kill(self.server.pid,signal.SIGTERM)
+    self.server.join()
+    shutil.rmtree(self.dirpath)
+  
+  def test_jobs_from_separate_processes(self):
+    results = multiprocessing.Queue()
+    submitter = multiprocessing.Process(target=submit_remotely,
+                                        args=(self.address,results))
+    submitter.start()
+    workers = fleet.connect(self.address,'secret')
+    local_pids = list(workers.submit(worker_pid,xrange(20)))
+    remote_pids = results.get()
+    submitter.join()
+    self.assertEqual(len(local_pids),20)
+    self.assertEqual(len(remote_pids),20)
+    # Run by the same two worker processes
+    self.assertLessEqual(len(set(local_pids+remote_pids)),2)
+    self.assertNotIn(os.getpid(),local_pids)
+  
+  def test_job_scoped_halt_on_error(self):
+    workers = fleet.connect(self.address,'secret')
+    failing = workers.submit(square_or_fail,[('a',1),('b','fail')],
+                             labeled_items=True)
+    with self.assertRaises(TestError):
+      list(failing)
+    self.assertEqual(failing.error_on_label,'b')
+    self.assertItemsEqual(workers.submit(square_or_fail,xrange(3)),[0,1,4])
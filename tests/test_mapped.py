@@ -0,0 +1,112 @@
+import os
+import unittest
+import cPickle
+import tempfile
+from cliceo import mapped
+
+
+class test_MappedFile(unittest.TestCase):
+  
+  def setUp(self):
+    fd,self.path = tempfile.mkstemp()
+    with os.fdopen(fd,'wb') as fh:
+      fh.write('0123456789')
+  
+  def tearDown(self):
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+  
+  def test_lazy_mapped_reading(self):
+    handle = mapped.MappedFile(self.path)
+    self.assertIs(handle._map,None)
+    self.assertEqual(handle.size,10)
+    self.assertEqual(handle.mmap()[2:5],'234')
+    self.assertEqual(handle.read(),'0123456789')
+    handle.close()
+    self.assertIs(handle._map,None)
+    with handle:
+      pass
+    self.assertFalse(os.path.exists(self.path))
+  
+  def test_empty_file(self):
+    open(self.path,'wb').close()
+    self.assertEqual(mapped.MappedFile(self.path).read(),'')
+  
+  def test_unpickled_handle_owns_file(self):
+    handle = mapped.MappedFile(self.path)
+    handle.mmap()
+    unpickled = cPickle.loads(cPickle.dumps(handle,cPickle.HIGHEST_PROTOCOL))
+    del handle
+    self.assertTrue(os.path.exists(self.path))
+    self.assertEqual(unpickled.read(),'0123456789')
+    del unpickled
+    self.assertFalse(os.path.exists(self.path))
+  
+  def test_ownership_handed_over(self):
+    handle = mapped.MappedFile(self.path,owner=True)
+    unpickled = cPickle.loads(cPickle.dumps(handle,cPickle.HIGHEST_PROTOCOL))
+    del handle
+    self.assertTrue(os.path.exists(self.path))
+    del unpickled
+    self.assertFalse(os.path.exists(self.path))
+    open(self.path,'wb').close()
+    # Removed with an owning handle never pickled
+    mapped.MappedFile(self.path,owner=True)
+    self.assertFalse(os.path.exists(self.path))
+
+
+class test_spilling(unittest.TestCase):
+  
+  def test_small_results_not_spilled(self):
+    self.assertEqual(mapped.spill_if_large('abc',4),'abc')
+    prepickled = mapped.spill_if_large({'a':1},1000)
+    self.assertEqual(cPickle.loads(cPickle.dumps(prepickled,2)),{'a':1})
+  
+  def test_large_results_spilled(self):
+    spill_dir = tempfile.mkdtemp()
+    try:
+      spilled_str = mapped.spill_if_large('x'*100,10,spill_dir)
+      spilled_obj = mapped.spill_if_large(range(100),10,spill_dir)
+      self.assertEqual(len(os.listdir(spill_dir)),2)
+      spilled_str = cPickle.loads(cPickle.dumps(spilled_str,2))
+      self.assertEqual(spilled_str.mmap()[:3],'xxx')
+      self.assertEqual(spilled_str.load(),'x'*100)
+      self.assertEqual(spilled_obj.load(),range(100))
+      self.assertEqual(os.listdir(spill_dir),[])
+    finally:
+      os.rmdir(spill_dir)
+
+
+class test_Broadcast(unittest.TestCase):
+  
+  def test_string_viewed_in_place(self):
+    with mapped.Broadcast('ACGT'*10) as broadcast:
+      self.assertEqual(broadcast.view()[4:8],'ACGT')
+      self.assertIs(broadcast.value,broadcast.view())
+    self.assertFalse(os.path.exists(broadcast.path))
+  
+  def test_buffer_viewed_in_place(self):
+    with mapped.Broadcast(bytearray('\x00\x01\x02')) as broadcast:
+      self.assertEqual(broadcast.value[1:],'\x01\x02')
+  
+  def test_object_held_until_pickled(self):
+    value = {'a':[1,2]}
+    with mapped.Broadcast(value) as broadcast:
+      self.assertRaises(ValueError,broadcast.view)
+      self.assertIs(broadcast.value,value)
+      self.assertIsNone(broadcast.path)
+      unpickled = cPickle.loads(cPickle.dumps(broadcast,2))
+      self.assertTrue(os.path.exists(broadcast.path))
+      self.assertIs(unpickled.value,unpickled.value)
+      self.assertEqual(unpickled.value,value)
+    self.assertFalse(os.path.exists(broadcast.path))
+  
+  def test_unpickled_handle_does_not_own_file(self):
+    broadcast = mapped.Broadcast(range(5))
+    try:
+      unpickled = cPickle.loads(cPickle.dumps(broadcast,2))
+      self.assertEqual(unpickled.value,range(5))
+      del unpickled
+      self.assertTrue(os.path.exists(broadcast.path))
+    finally:
+      broadcast.release()
@@ -0,0 +1,195 @@
+import os
+import time
+import unittest
+import threading
+from mock import patch,Mock,PropertyMock
+from cliceo import resources
+
+
+def mock_manager():
+  # Lock and dict backed by real in-process objects, as gates only use these
+  return Mock(**{'Lock.return_value':threading.Lock(),
+                 'dict.return_value':{}})
+
+
+class test_thread_count_control(unittest.TestCase):
+  
+  def test_thread_count_env(self):
+    env = resources.thread_count_env(4,{'PATH':'/bin'})
+    self.assertEqual(env['PATH'],'/bin')
+    for var in resources.THREAD_COUNT_ENV_VARS:
+      self.assertEqual(env[var],'4')
+  
+  @patch.dict('os.environ',{},clear=True)
+  def test_set_thread_count(self):
+    resources.set_thread_count(2)
+    self.assertItemsEqual(os.environ.keys(),resources.THREAD_COUNT_ENV_VARS)
+    self.assertEqual(os.environ['OMP_NUM_THREADS'],'2')
+
+
+class test_CPU_partitioning(unittest.TestCase):
+  
+  def test_partition_into_disjoint_slots(self):
+    self.assertEqual(resources.partition_cpus(2,range(7)),
+                     [[0,1],[2,3],[4,5]])
+    self.assertEqual(resources.partition_cpus(1,[3,5]),[[3],[5]])
+    self.assertEqual(resources.partition_cpus(4,range(3)),[])
+  
+  def test_invalid_cores_per_task(self):
+    with self.assertRaises(ValueError):
+      resources.partition_cpus(0,range(4))
+
+
+class test_MemoryGate(unittest.TestCase):
+  
+  def make_gate(self,**kwargs):
+    return resources.MemoryGate(mock_manager(),poll_interval=0,**kwargs)
+  
+  def test_first_task_always_admitted(self):
+    gate = self.make_gate(task_memory=10,memory_budget=5)
+    self.assertTrue(gate.acquire('w1','arg',Mock(value=True)))
+    self.assertEqual(gate.reservations,{'w1':10})
+    gate.release('w1')
+    self.assertEqual(gate.reservations,{})
+  
+  @patch('cliceo.resources.process_tree_rss',return_value=0)
+  def test_budget_delays_admission(self,patched_rss):
+    gate = self.make_gate(task_memory=len,memory_budget=10,
+                          PIDregistry={'w1':'dummyPID'})
+    self.assertTrue(gate.acquire('w1','xxxxxx',Mock(value=True)))
+    self.assertTrue(gate.acquire('w2','xxxx',Mock(value=True)))
+    # Waiting is abandoned when shutdown is announced
+    proceed = Mock()
+    type(proceed).value = PropertyMock(side_effect=[True,True,False])
+    self.assertFalse(gate.acquire('w3','x',proceed))
+    self.assertItemsEqual(gate.reservations.keys(),['w1','w2'])
+    # Actual use above the estimate counts against the budget
+    gate.release('w2')
+    patched_rss.return_value = 9
+    self.assertFalse(gate._fits(2))
+    patched_rss.assert_called_with('dummyPID')
+  
+  @patch('psutil.virtual_memory')
+  def test_min_available_memory(self,patched_virtual_memory):
+    patched_virtual_memory.return_value.available = 100
+    gate = self.make_gate(task_memory=30,min_available=50)
+    gate.reservations['w1'] = 30
+    self.assertFalse(gate._fits(30))
+    self.assertTrue(gate._fits(20))
+
+
+class test_ResourceGate(unittest.TestCase):
+  
+  def make_gate(self,**kwargs):
+    return resources.ResourceGate(mock_manager(),{'disk':2,'license':1},
+                                  poll_interval=0,**kwargs)
+  
+  def tearDown(self):
+    resources.set_child_priority(None)
+  
+  def test_limits_per_class(self):
+    gate = self.make_gate(task_classes=lambda arg: arg)
+    self.assertTrue(gate.acquire('w1',['disk','license'],Mock(value=True)))
+    self.assertTrue(gate.acquire('w2',['disk'],Mock(value=True)))
+    # Tasks using no class are never held up
+    self.assertTrue(gate.acquire('w3',[],Mock(value=True)))
+    proceed = Mock()
+    type(proceed).value = PropertyMock(side_effect=[True,True,False])
+    self.assertFalse(gate.acquire('w4',['disk'],proceed))
+    gate.release('w1')
+    self.assertEqual(gate.held,{'w2':('disk',)})
+    self.assertTrue(gate.acquire('w4',['license'],Mock(value=True)))
+    with self.assertRaises(ValueError):
+      gate.acquire('w5',['network'],Mock(value=True))
+  
+  def test_child_priority(self):
+    gate = self.make_gate(task_classes=('disk','license'),
+                          priorities={'disk':{'nice':5,'ionice':(2,7)},
+                                      'license':{'nice':10,'ionice':(2,4)}})
+    self.assertEqual(gate.priority(('disk',)),(5,(2,7)))
+    self.assertEqual(gate.priority(('license',)),(10,(2,4)))
+    self.assertIsNone(self.make_gate().priority(('disk',)))
+    gate.acquire('w1','arg',Mock(value=True))
+    self.assertEqual(resources.child_priority(),(10,(2,7)))
+    gate.release('w1')
+    self.assertIsNone(resources.child_priority())
+  
+  def test_undeclared_classes(self):
+    with self.assertRaises(ValueError):
+      self.make_gate(task_classes=('network',))
+    with self.assertRaises(ValueError):
+      self.make_gate(priorities={'network':{'nice':1}})
+    with self.assertRaises(ValueError):
+      resources.ResourceGate.check({'disk':0})
+  
+  @patch('psutil.Process')
+  @patch('os.nice')
+  def test_apply_priority(self,patched_nice,patched_Process):
+    resources.apply_priority(5,(2,7))
+    patched_nice.assert_called_once_with(5)
+    patched_Process.return_value.ionice.assert_called_once_with(2,7)
+
+
+class test_process_trees(unittest.TestCase):
+  
+  def test_registered_PIDs(self):
+    self.assertEqual(resources.registered_PIDs(12),(12,))
+    self.assertEqual(resources.registered_PIDs((12,13)),(12,13))
+  
+  @patch('psutil.Process')
+  def test_kill_process_tree(self,patched_Process):
+    top_proc = patched_Process.return_value
+    children = [Mock(),Mock()]
+    top_proc.children.return_value = children
+    resources.kill_process_tree('dummyPID')
+    patched_Process.assert_called_once_with(pid='dummyPID')
+    for proc in [top_proc]+children:
+      proc.kill.assert_called_once_with()
+
+
+class test_dynamic_resizing(unittest.TestCase):
+  
+  def test_ConcurrencyGate(self):
+    gate = resources.ConcurrencyGate(mock_manager(),1,poll_interval=0)
+    gate.target = Mock(value=1)
+    self.assertTrue(gate.acquire('w1','arg',Mock(value=True)))
+    proceed = Mock()
+    type(proceed).value = PropertyMock(side_effect=[True,True,False])
+    self.assertFalse(gate.acquire('w2','arg',proceed))
+    gate.resize(2)
+    self.assertTrue(gate.acquire('w2','arg',Mock(value=True)))
+    gate.release('w1')
+    self.assertEqual(gate.running,{'w2':True})
+  
+  @patch('psutil.cpu_percent',return_value=50.0)
+  @patch('psutil.getloadavg',return_value=(2.0,2.0,2.0))
+  @patch('psutil.virtual_memory')
+  @patch('psutil.cpu_count',return_value=4)
+  def test_LoadScalingPolicy(self,patched_cpu_count,patched_virtual_memory,
+                             patched_getloadavg,patched_cpu_percent):
+    patched_virtual_memory.return_value.available = 100
+    policy = resources.LoadScalingPolicy(min_workers=2,min_available_memory=50)
+    # Two CPUs idle
+    self.assertEqual(policy(3,4),4)
+    self.assertEqual(policy(4,4),4)
+    # Less than one CPU idle
+    patched_cpu_percent.return_value = 80.0
+    self.assertEqual(policy(3,4),3)
+    # Overloaded
+    patched_getloadavg.return_value = (5.0,2.0,2.0)
+    self.assertEqual(policy(3,4),2)
+    self.assertEqual(policy(2,4),2)
+    # Short of memory
+    patched_getloadavg.return_value = (1.0,2.0,2.0)
+    patched_virtual_memory.return_value.available = 10
+    self.assertEqual(policy(4,4),3)
+  
+  def test_Autoscaler_clamps_target(self):
+    gate = Mock(**{'target.value':2})
+    policy = Mock(return_value=10)
+    autoscaler = resources.Autoscaler(gate,policy,4,0.001)
+    autoscaler.start()
+    time.sleep(0.05)
+    autoscaler.stop()
+    policy.assert_called_with(2,4)
+    gate.resize.assert_called_with(4)
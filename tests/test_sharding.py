@@ -0,0 +1,54 @@
+import os
+import unittest
+import cPickle
+import tempfile
+from cliceo import sharding
+
+
+class test_FileShards(unittest.TestCase):
+  
+  def setUp(self):
+    fd,self.path = tempfile.mkstemp()
+    self.lines = ['%d%s\n' % (i,'x'*i) for i in xrange(20)]
+    with os.fdopen(fd,'wb') as fh:
+      fh.write(''.join(self.lines))
+  
+  def tearDown(self):
+    os.unlink(self.path)
+  
+  def test_shards_aligned_to_records(self):
+    shards = list(sharding.FileShards(self.path,30))
+    self.assertTrue(len(shards) > 1)
+    self.assertEqual(shards[0].start,0)
+    self.assertEqual(shards[-1].end,os.path.getsize(self.path))
+    for shard,next_shard in zip(shards,shards[1:]):
+      self.assertTrue(len(shard) >= 30)
+      self.assertEqual(shard.end,next_shard.start)
+      self.assertTrue(shard.read().endswith('\n'))
+    records = [r for shard in shards for r in shard.records()]
+    self.assertEqual([record for _,record in records],self.lines)
+    self.assertEqual([offset for offset,_ in records],
+                     [sum(map(len,self.lines[:i])) for i in xrange(20)])
+  
+  def test_records_split_before_delimiter_end(self):
+    with open(self.path,'wb') as fh:
+      fh.write('>a\nAC\nGT\n>b\nTT\n>c\nG')
+    shards = list(sharding.FileShards(self.path,4,'\n>',1))
+    self.assertEqual([s.read() for s in shards],
+                     ['>a\nAC\nGT\n','>b\nTT\n','>c\nG'])
+    shard = sharding.FileShard(self.path,0,os.path.getsize(self.path),'\n>',1)
+    self.assertEqual(list(shard.records()),
+                     [(0,'>a\nAC\nGT\n'),(9,'>b\nTT\n'),(15,'>c\nG')])
+  
+  def test_empty_file_and_invalid_size(self):
+    open(self.path,'wb').close()
+    self.assertEqual(list(sharding.FileShards(self.path,10)),[])
+    with self.assertRaises(ValueError):
+      list(sharding.FileShards(self.path,0))
+  
+  def test_compact_pickling(self):
+    shard = sharding.FileShard(self.path,3,9)
+    unpickled = cPickle.loads(cPickle.dumps(shard,cPickle.HIGHEST_PROTOCOL))
+    self.assertEqual((unpickled.path,unpickled.start,unpickled.end,
+                      unpickled.delimiter,unpickled.split_at),
+                     (self.path,3,9,'\n',1))
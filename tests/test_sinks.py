@@ -0,0 +1,58 @@
+import os
+import shutil
+import unittest
+import cPickle
+import tempfile
+from cliceo import sinks
+
+
+class test_ShardSink(unittest.TestCase):
+  
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+  
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+  
+  def test_unknown_format(self):
+    with self.assertRaises(ValueError):
+      sinks.ShardSink(self.directory,'csv')
+  
+  def test_live_reading(self):
+    for format in sinks.FORMATS:
+      sink = sinks.ShardSink(self.directory,format)
+      reader = sinks.ShardReader(self.directory,format)
+      sink.write('a',1)
+      sink.write(None,[2,3])
+      self.assertEqual(list(reader.read_new()),[('a',1),(None,[2,3])])
+      self.assertEqual(list(reader.read_new()),[])
+      with open(sink.path,'ab') as fh:
+        # Partially written record is not read until complete
+        fh.write('{"label"' if format == 'jsonl' else '\x00\x00')
+      self.assertEqual(list(reader.read_new()),[])
+      sink.close()
+  
+  def test_sink_pickled_without_file(self):
+    sink = sinks.ShardSink(self.directory,'pickle')
+    sink.write('a',1)
+    unpickled = cPickle.loads(cPickle.dumps(sink))
+    self.assertIs(unpickled._fh,None)
+    self.assertEqual(unpickled.path,sink.path)
+    sink.close()
+  
+  def test_merging(self):
+    sink = sinks.ShardSink(self.directory,'pickle')
+    sink.write('a',1)
+    sink.close()
+    with open(os.path.join(self.directory,'0.pickle'),'wb') as fh:
+      # Complete frame followed by the start of a partially written one
+      frame = cPickle.dumps(('b',2),cPickle.HIGHEST_PROTOCOL)
+      fh.write(sinks._FRAME_HEADER.pack(len(frame))+frame+'\x00')
+    out_path = os.path.join(self.directory,'merged.pickle')
+    self.assertEqual(sinks.merge_shards(self.directory,out_path,'pickle'),2)
+    # Merged file itself is skipped when merging again
+    self.assertEqual(sinks.merge_shards(self.directory,out_path,'pickle'),2)
+    os.unlink(sink.path)
+    os.unlink(fh.name)
+    self.assertItemsEqual(sinks.iterate_shards(self.directory,'pickle'),
+                          [('a',1),('b',2)])
@@ -0,0 +1,23 @@
+import unittest
+from cliceo import soak
+
+
+class test_soak(unittest.TestCase):
+  
+  def test_percentile(self):
+    values = range(101)
+    self.assertEqual(soak.percentile(values,0.5),50)
+    self.assertEqual(soak.percentile(values,0.99),99)
+    self.assertIs(soak.percentile([],0.5),None)
+  
+  def test_soak_run_report(self):
+    report = soak.run_soak(12,2,['--fail-rate','0.5','--output-bytes','10'],
+                           sample_interval=0.05,settle_time=0.1)
+    self.assertEqual(report['tasks'],12)
+    self.assertTrue(0 < report['failures'] < 12)
+    self.assertEqual(report['output_bytes'],120)
+    self.assertTrue(report['latency']['p50'] <= report['latency']['max'])
+    self.assertTrue(report['peak_children_rss'] > 0)
+    self.assertTrue(len(report['rss_samples']) >= 2)
+    self.assertEqual(report['leaked_processes'],[])
+    self.assertEqual(report['leaked_tempdirs'],[])
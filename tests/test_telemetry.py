@@ -0,0 +1,67 @@
+import os
+import unittest
+import tempfile
+from mock import patch,Mock
+from cliceo import telemetry
+
+
+class test_PoolStats(unittest.TestCase):
+  
+  @patch('time.time')
+  def test_snapshot(self,patched_time):
+    patched_time.return_value = 100.0
+    stats = telemetry.PoolStats(total=10,worker_activity={'w1':None,
+                                                          'w2':104.0})
+    self.assertEqual(list(stats.count_dispatched('abcd')),list('abcd'))
+    stats.count_completed(2)
+    patched_time.return_value = 105.0
+    snapshot = stats.snapshot()
+    self.assertEqual(snapshot['dispatched'],4)
+    self.assertEqual(snapshot['completed'],2)
+    # One item is running, the other only dispatched
+    self.assertEqual(snapshot['in_flight'],1)
+    self.assertEqual(snapshot['queued'],1)
+    self.assertEqual(snapshot['throughput'],0.4)
+    self.assertEqual(snapshot['eta'],20.0)
+    self.assertEqual(snapshot['workers'],{'w1':None,'w2':1.0})
+  
+  def test_snapshot_without_total_or_activity(self):
+    snapshot = telemetry.PoolStats().snapshot()
+    self.assertIs(snapshot['eta'],None)
+    self.assertIs(snapshot['workers'],None)
+    self.assertIs(snapshot['in_flight'],None)
+
+
+class test_reporting(unittest.TestCase):
+  
+  def test_reporter_final_snapshot_on_stop(self):
+    callback = Mock()
+    reporter = telemetry.StatsReporter(telemetry.PoolStats(),callback,60)
+    reporter.start()
+    reporter.stop()
+    self.assertFalse(reporter.is_alive())
+    self.assertEqual(callback.call_count,1)
+  
+  def test_metrics_file_export(self):
+    fd,path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      stats = telemetry.PoolStats(total=3,worker_activity={'w1':None})
+      stats.count_completed()
+      telemetry.MetricsFileExporter(path)(stats.snapshot())
+      with open(path) as fh:
+        lines = dict(line.split() for line in fh)
+      self.assertEqual(lines['cliceo_pool_items_completed_total'],'1')
+      self.assertEqual(lines['cliceo_pool_items_total'],'3')
+      self.assertEqual(lines['cliceo_pool_workers_busy'],'0')
+      self.assertEqual(lines['cliceo_pool_tasks_running'],'0')
+      self.assertEqual(lines['cliceo_pool_items_queued'],'0')
+      # Readable by the collector's user
+      umask = os.umask(0o022)
+      try:
+        telemetry.MetricsFileExporter(path)(stats.snapshot())
+      finally:
+        os.umask(umask)
+      self.assertEqual(os.stat(path).st_mode & 0o777,0o644)
+    finally:
+      os.unlink(path)
@@ -0,0 +1,49 @@
+import shutil
+import unittest
+import tempfile
+from cliceo import tracing
+
+
+class test_tracing(unittest.TestCase):
+  
+  def setUp(self):
+    self.trace_dir = tempfile.mkdtemp()
+  
+  def tearDown(self):
+    tracing.deactivate()
+    shutil.rmtree(self.trace_dir)
+  
+  def test_no_events_without_active_tracer(self):
+    with tracing.span('dummy'):
+      tracing.begin('dummy')
+      tracing.end('dummy')
+    self.assertEqual(tracing.read_events(self.trace_dir),[])
+  
+  def test_events_of_active_tracer(self):
+    tracing.activate(self.trace_dir,'dummy process')
+    with tracing.span('outer',task_id=3):
+      tracing.begin('inner')
+      tracing.end('inner')
+    events = tracing.read_events(self.trace_dir)
+    self.assertEqual([(e['ph'],e['name']) for e in events],
+                     [('M','process_name'),('B','inner'),('E','inner'),
+                      ('X','outer')])
+    self.assertEqual(events[0]['args'],{'name':'dummy process'})
+    self.assertEqual(events[-1]['args'],{'task_id':3})
+    self.assertTrue(events[-1]['dur'] >= 0)
+  
+  def test_task_timeline(self):
+    tracer = tracing.Tracer(self.trace_dir)
+    timeline = tracing.TaskTimeline(tracer)
+    tagged = list(timeline.tag_dispatched(['a','b']))
+    self.assertEqual([(t.task_id,t.obj) for t in tagged],[(0,'a'),(1,'b')])
+    self.assertEqual(timeline.untag_received(tracing.TracedTask(0,'A')),'A')
+    worker_events = [{'ph':'X','name':'task','ts':timeline.dispatched[0]+5,
+                      'dur':1,'args':{'task_id':0}}]
+    timeline.trace_queueing_and_transfer(worker_events)
+    tracer.close()
+    events = tracing.read_events(self.trace_dir)
+    self.assertEqual([(e['ph'],e['name'],e['id']) for e in events],
+                     [('b','queued',0),('e','queued',0),
+                      ('b','result transfer',0),('e','result transfer',0)])
+    self.assertEqual(events[1]['ts']-events[0]['ts'],5)
@@ -1,8 +1,16 @@
 import unittest
 import os
+import cPickle
+import psutil
+import threading
+import time
+import shutil
+import tempfile
+import signal
 import subprocess
 from multiprocessing import pool
 from itertools import cycle
+from functools import partial
 from tempfile import template as TEMPFILE_TEMPLATE
 from mock import patch,mock_open,PropertyMock,Mock,call,DEFAULT
 import contextlib2
@@ -78,6 +86,126 @@ class test_Worker(unittest.TestCase):
     self.assertIs(r1,TestError)
     self.assertTrue(isinstance(r2,TestError))
 
+  
+  def test_admission_gates(self,patchedManagerCallable):
+    mocks = self.prepare_IPC_mocks(patchedManagerCallable)
+    mock_work_callable = Mock(return_value='result')
+    gates = [Mock(**{'acquire.return_value':True}) for _ in xrange(2)]
+    
+    worker = workerpool.Worker(mock_work_callable,mocks['permission'],
+                               mocks['sleep_lock'],mocks['ready_to_die_queue'],
+                               gates=gates)
+    self.assertEqual(worker('arg'),'result')
+    for gate in gates:
+      self.assertEqual(gate.acquire.call_args[0][1:],('arg',mocks['permission']))
+      gate.release.assert_called_once_with(gate.acquire.call_args[0][0])
+    
+    # Shutdown announced while waiting for the second gate
+    gates[1].acquire.return_value = False
+    worker('arg')
+    mock_work_callable.assert_called_once_with('arg')
+    self.assertEqual(gates[0].release.call_count,2)
+    self.assertEqual(gates[1].release.call_count,1)
+    mocks['ready_to_die_queue'].get.assert_called_once_with()
+    mocks['sleep_lock'].acquire.assert_called_once_with()
+    
+    # Second gate failing, e.g. on an unknown resource class
+    gates[1].acquire.side_effect = ValueError
+    result = worker(workerpool.LabeledObject('label','arg'))
+    self.assertEqual(result.label,'label')
+    self.assertIs(result.result[0],ValueError)
+    mock_work_callable.assert_called_once_with('arg')
+    self.assertEqual(gates[0].release.call_count,3)
+    self.assertEqual(gates[1].release.call_count,1)
+  
+  def test_result_extraction(self,patchedManagerCallable):
+    mocks = self.prepare_IPC_mocks(patchedManagerCallable)
+    worker = workerpool.Worker(Mock(return_value={'a':1,'b':2}),
+                               mocks['permission'],mocks['sleep_lock'],
+                               mocks['ready_to_die_queue'],
+                               result_extractor=lambda r: r['a'])
+    self.assertEqual(worker('arg'),1)
+    labeled_result = worker(workerpool.LabeledObject('label','arg'))
+    self.assertEqual((labeled_result.label,labeled_result.result),('label',1))
+  
+  @patch('cliceo.workerpool.Finalize')
+  def test_result_combining(self,patched_Finalize,patchedManagerCallable):
+    mocks = self.prepare_IPC_mocks(patchedManagerCallable)
+    partials = Mock()
+    def work_callable(x):
+      # A list is read as records, e.g. by call_on_records()
+      if isinstance(x,list):
+        return workerpool.Batch(['a','b'],x,is_result=True)
+      return x
+    worker = workerpool.Worker(work_callable,mocks['permission'],
+                               mocks['sleep_lock'],mocks['ready_to_die_queue'],
+                               combiner=lambda a,b: a+b,flush_every=3,
+                               partials=partials)
+    worker.initialize()
+    self.assertEqual([worker(i) for i in [1,2]],[None,None])
+    flushed = worker(3)
+    self.assertTrue(isinstance(flushed,workerpool.PartialAggregate))
+    self.assertEqual(flushed.value,6)
+    labeled_ack = worker(workerpool.LabeledObject('label',4))
+    self.assertEqual((labeled_ack.label,labeled_ack.result),('label',None))
+    batch_ack = worker([5,6])
+    self.assertEqual(batch_ack.label,['a','b'])
+    self.assertEqual(batch_ack.result[0],None)
+    self.assertEqual(batch_ack.result[1].value,15)
+    worker(7)
+    # Remainder put on the queue as the worker process exits
+    worker.flush_remaining()
+    partials.put.assert_called_once_with(7)
+    worker.flush_remaining()
+    partials.put.assert_called_once_with(7)
+
+
+class test_LabeledObject(unittest.TestCase):
+  
+  def test_compact_pickling(self):
+    import cPickle
+    lo = workerpool.LabeledObject('label',[1,2],is_result=True)
+    self.assertFalse(hasattr(lo,'__dict__'))
+    for protocol in xrange(cPickle.HIGHEST_PROTOCOL+1):
+      unpickled = cPickle.loads(cPickle.dumps(lo,protocol))
+      self.assertEqual((unpickled.label,unpickled.result),('label',[1,2]))
+  
+  def test_batching(self):
+    labeled = workerpool.LabeledObjectsSequence(enumerate(['a','bb','ccc']))
+    batches = list(workerpool.BatchedSequence(labeled,batch_size=2))
+    self.assertEqual([(b.label,b.obj) for b in batches],
+                     [([0,1],['a','bb']),([2],['ccc'])])
+    batches = list(workerpool.BatchedSequence(['a','bb','ccc','d'],
+                                              batch_bytes=3))
+    self.assertEqual([(b.label,b.obj) for b in batches],
+                     [(None,['a','bb']),(None,['ccc']),(None,['d'])])
+    with workerpool.LabeledObject.strip_label(batches[0]) as (values,reapply):
+      result = reapply([v.upper() for v in values])
+    self.assertTrue(isinstance(result,workerpool.Batch))
+    self.assertEqual((result.label,result.result),(None,['A','BB']))
+  
+  def test_deduplication(self):
+    dedup = workerpool.TaskDeduplicator(key=str.lower,memo_size=1)
+    labeled = workerpool.LabeledObjectsSequence(enumerate(['a','A','b','B',
+                                                           'a','c','a']))
+    dispatched = dedup.dispatch(labeled)
+    tasks = [next(dispatched) for _ in xrange(2)]
+    self.assertEqual([(t.label,t.obj) for t in tasks],[('a','a'),('b','b')])
+    self.assertEqual(dedup.original_label('b'),2)
+    fanned_out = list(dedup.fan_out([('a',1),('b',2)]))
+    self.assertItemsEqual(fanned_out,[(0,1),(1,1),(2,2)])
+    # Only the result for 'b' is still in the memo
+    tasks = list(dispatched)
+    self.assertEqual([t.label for t in tasks],['a','c'])
+    self.assertItemsEqual(dedup.fan_out([('c',3),('a',4)]),
+                          [(3,2),(4,4),(5,3),(6,4)])
+  
+  def test_batch_result_splitting(self):
+    splitter = lambda result,values: list(result)
+    self.assertEqual(workerpool.call_batched(''.join,splitter,['a','b']),
+                     ['a','b'])
+    with self.assertRaises(ValueError):
+      workerpool.call_batched(''.join,None,['ab','c'])
 
 @patch('subprocess.Popen')
 @patch('cliceo.tempdir.TemporaryWorkingDirectory')
@@ -153,6 +281,17 @@ class test_PartializedControllerCallable(unittest.TestCase):
     self.assertIs(dummycontroller.stderr,subprocess.STDOUT)
     patched_Popen.assert_called_once_with('dummy_callstr',stdout=None,
                                           stderr=subprocess.STDOUT,shell=True)
+  
+  def test_controller_result_returned(self,patched_open,patched_TWD,
+                                      patched_Popen):
+    patched_Popen.return_value.communicate.return_value = ('dummySTDOUT',None)
+    class SlimController(controller.CommandLineCaller):
+      def result(self):
+        return self.captured_stdout.lower()
+    dummycallable = workerpool.PartializedControllerCallable(SlimController,
+                                                             'dummy_callstr',
+                                                           capture_stdout=True)
+    self.assertEqual(dummycallable(),'dummystdout')
 
 
 class TestController(controller.CommandLineCaller):
@@ -231,7 +370,8 @@ def patched_multiproc_setup():
         # Several steps in initializing the multiproc mocking setup must happen
         # on instantiation of a worker pool, once the number of requested
         # workers becomes known
-        def Pool_call_side_effect(numproc,initializer,initargs):
+        def Pool_call_side_effect(numproc,initializer,initargs,
+                                  maxtasksperchild=None):
           (real_worker,) = initargs
           mocks['worker_global_dicts'] = [{'num':i,'sleeping':False}
                                           for i in xrange(numproc)]
@@ -427,6 +567,171 @@ class test_successful_parallel_execution_with_PoolManager(unittest.TestCase):
       mocks['workerpool'].join.assert_called_once_with()
 
 
+class test_PoolManager_CPU_oversubscription_control(unittest.TestCase):
+  
+  @patch('cliceo.resources.available_cpus',return_value=range(8))
+  def test_numproc_capped_by_cores_per_task(self,patched_available_cpus):
+    class MultithreadedController(TestController):
+      cores_per_task = 3
+    with patched_multiproc_setup() as mocks:
+      workerpool.PoolManager(MultithreadedController,[],numproc=4)
+      self.assertEqual(mocks['workerpool']._processes,2)
+      workerpool.PoolManager(TestController,[],cores_per_task=4)
+      self.assertEqual(mocks['workerpool']._processes,2)
+      workerpool.PoolManager(TestController,[],numproc=1,cores_per_task=2)
+      self.assertEqual(mocks['workerpool']._processes,1)
+      with self.assertRaises(ValueError):
+        workerpool.PoolManager(TestController,[],cores_per_task=9)
+  
+  @patch('cliceo.resources.pin_current_process')
+  @patch('cliceo.resources.set_thread_count')
+  @patch('cliceo.workerpool.Finalize')
+  def test_worker_initialization(self,patched_Finalize,patched_set_thread_count,
+                                 patched_pin):
+    cpu_slots = Mock(**{'get.return_value':[2,3]})
+    worker = workerpool.Worker(Mock(),Mock(),Mock(),Mock(),nthreads=2,
+                               cpu_slots=cpu_slots)
+    worker.initialize()
+    patched_set_thread_count.assert_called_once_with(2)
+    patched_pin.assert_called_once_with([2,3])
+    patched_Finalize.assert_called_once_with(None,cpu_slots.put,args=([2,3],),
+                                             exitpriority=10)
+    # PIDs registered by a worker are unregistered when the worker exits
+    patched_Finalize.reset_mock()
+    mock_PIDcleanup = Mock()
+    worker = workerpool.Worker(Mock(),Mock(),Mock(),Mock(),mock_PIDcleanup)
+    worker.initialize()
+    patched_Finalize.assert_called_once_with(None,mock_PIDcleanup,
+                                             exitpriority=10)
+    # Per-worker state is set up once and torn down when the worker exits
+    patched_Finalize.reset_mock()
+    mock_setup,mock_teardown = Mock(),Mock()
+    worker = workerpool.Worker(Mock(),Mock(),Mock(),Mock(),setup=mock_setup,
+                               teardown=mock_teardown)
+    try:
+      worker.initialize()
+      self.assertIs(workerpool.get_worker_state(),mock_setup.return_value)
+      patched_Finalize.assert_called_once_with(None,workerpool._call_teardown,
+                                               args=(mock_teardown,),
+                                               exitpriority=10)
+      workerpool._call_teardown(mock_teardown)
+      mock_teardown.assert_called_once_with(mock_setup.return_value)
+    finally:
+      workerpool._worker_state = None
+  
+  @patch('cliceo.resources.kill_process_tree')
+  @patch('cliceo.workerpool._alive',side_effect=lambda pid: pid not in (13,15))
+  def test_worker_loss_recovery(self,patched_alive,patched_kill):
+    inflight = {(0,0):(13,'PoolWorker-1',workerpool.LabeledObject('x',1)),
+                (1,0):(14,'PoolWorker-2',2),
+                # Worker exited cleanly, its result is still on its way
+                (2,0):(15,'PoolWorker-3',3)}
+    claims = {13:(('cpu_slots',[0]),),14:(('cpu_slots',[1]),)}
+    cpu_slots,gate = Mock(),Mock()
+    monitor = workerpool.WorkerLossMonitor(inflight,claims,
+                                           {'cpu_slots':cpu_slots},'fail',1,1,
+                                           PIDregistry={'PoolWorker-1':(7,8)},
+                                           gates=[gate])
+    monitor._set = Mock()
+    monitor.check()
+    cpu_slots.put.assert_called_once_with([0])
+    self.assertEqual(claims.keys(),[14])
+    self.assertItemsEqual(inflight.keys(),[(1,0),(2,0)])
+    self.assertEqual(patched_kill.call_args_list,[call(7),call(8)])
+    gate.release.assert_called_once_with('PoolWorker-1')
+    ((_,(success,lost)),_), = monitor._set.call_args_list
+    self.assertTrue(success)
+    self.assertEqual(lost.label,'x')
+    self.assertIs(lost.result[0],workerpool.WorkerLostError)
+    # Arriving results clear their records
+    monitor.arrived(None,(True,workerpool.TrackedTask(2,0,'result')))
+    self.assertEqual(inflight.keys(),[(1,0)])
+    monitor._set.assert_called_with(None,(True,'result'))
+    # A lost task's result arriving late is dropped
+    monitor.arrived(None,(True,workerpool.TrackedTask(0,0,'late')))
+    self.assertEqual(monitor._set.call_count,2)
+    # Retried until out of retries
+    monitor.policy,monitor.pool = 'retry',Mock()
+    inflight[(3,0)] = (16,'PoolWorker-4',5)
+    monitor.recover((3,0),'PoolWorker-4',5)
+    (_,(retried,)),kwargs = monitor.pool.apply_async.call_args
+    self.assertEqual((retried.task_id,retried.attempt,retried.obj),(3,1,5))
+    self.assertEqual(kwargs['callback'],monitor.retried)
+    inflight[(3,1)] = (17,'PoolWorker-5',5)
+    monitor.recover((3,1),'PoolWorker-5',5)
+    self.assertEqual(monitor._set.call_count,3)
+    # Recovery of a task whose result arrived in the meantime
+    monitor.recover((4,0),'PoolWorker-6',6)
+    self.assertEqual(monitor.pool.apply_async.call_count,1)
+    self.assertEqual(monitor._set.call_count,3)
+  
+  @patch('cliceo.resources.kill_process_tree')
+  def test_worker_PID_reused(self,patched_kill):
+    dead,reused = (1234,1.0),(1234,2.0)
+    claims = {dead:(),reused:()}
+    inflight = {(0,0):(reused,'PoolWorker-2',1)}
+    monitor = workerpool.WorkerLossMonitor(inflight,claims,{},'retry',1,1,
+                                           PIDregistry={'PoolWorker-2':4242})
+    monitor.pool = Mock()
+    with patch('cliceo.workerpool._alive',side_effect=lambda w: w != dead):
+      monitor.check()
+      monitor.check()
+    # The worker now holding the PID keeps its running task and program
+    self.assertEqual(claims.keys(),[reused])
+    self.assertEqual(inflight.keys(),[(0,0)])
+    self.assertFalse(patched_kill.called)
+    self.assertFalse(monitor.pool.apply_async.called)
+    # Processes are told apart by their creation time
+    identity = workerpool._process_identity()
+    self.assertTrue(workerpool._alive(identity))
+    self.assertFalse(workerpool._alive((identity[0],identity[1]-1)))
+  
+  def test_retried_task_completed_once(self):
+    inflight = {(0,0):(13,'PoolWorker-1',1)}
+    monitor = workerpool.WorkerLossMonitor(inflight,{},{},'retry',1,1)
+    monitor._set,monitor.pool = Mock(),Mock()
+    monitor.recover((0,0),'PoolWorker-1',1)
+    # The original result turns up after all, then the retry's
+    inflight[(0,1)] = (14,'PoolWorker-2',1)
+    monitor.arrived(None,(True,workerpool.TrackedTask(0,0,'first')))
+    monitor.retried(workerpool.TrackedTask(0,1,'second'))
+    monitor._set.assert_called_once_with(None,(True,'first'))
+    self.assertEqual(inflight,{})
+  
+  def test_tracked_task_running(self):
+    inflight = {}
+    worker = workerpool.Worker(lambda x: threading.Lock() if x == 'lock' else x,
+                               Mock(),Mock(),Mock(),inflight=inflight)
+    result = worker(workerpool.TrackedTask(7,1,workerpool.LabeledObject('a',2)))
+    self.assertEqual((result.task_id,result.attempt),(7,1))
+    # Pickled in the worker
+    unpickled = cPickle.loads(cPickle.dumps(result.obj,2))
+    self.assertEqual((unpickled.label,unpickled.result),('a',2))
+    # The record stays until the result arrives in the parent
+    worker_id,name,task = inflight[(7,1)]
+    self.assertEqual((worker_id,task.label,task.obj),
+                     (workerpool._process_identity(),'a',2))
+    failed = worker(workerpool.TrackedTask(8,0,'lock'))
+    self.assertTrue(issubclass(failed.obj[0],TypeError))
+  
+  def test_affinity_queue_claiming_and_stealing(self):
+    import Queue
+    queues = [Queue.Queue() for _ in xrange(3)]
+    tokens = list(workerpool.AffinitySequence(['a','b','a','b','b'],
+                                              lambda v: v,queues))
+    self.assertEqual(len(tokens),5)
+    slot_a,slot_b = hash('a') % 3,hash('b') % 3
+    self.assertNotEqual(slot_a,slot_b)
+    slots = Queue.Queue()
+    slots.put(slot_a)
+    worker = workerpool.Worker(Mock(),Mock(),Mock(),Mock(),
+                               affinity_queues=queues,affinity_slots=slots)
+    worker.initialize()
+    claimed = [worker.claim_affine_item() for _ in xrange(5)]
+    # Own items first, then stolen ones
+    self.assertEqual(claimed,['a','a','b','b','b'])
+
+
 class test_exception_handling_by_Worker_and_PoolManager(unittest.TestCase):
    
   def verify_shutdown_announced_and_all_workers_went_to_sleep(self,mocks):
@@ -545,6 +850,96 @@ class DummyController(controller.CommandLineCaller):
     controller.CommandLineCaller.call(self)
     self.newval = self.val+100
 
+class BatchEchoController(controller.CommandLineCaller):
+  def __init__(self,values,**kwargs):
+    controller.CommandLineCaller.__init__(self,'cat; echo $$',
+                                          input_source=''.join(
+                                                 '%s\n' % v for v in values),
+                                          capture_stdout=True,**kwargs)
+
+def split_echoed_lines(caller,values):
+  lines = caller.captured_stdout.splitlines()
+  pid = lines.pop()
+  return [(int(line)+100,pid) for line in lines]
+
+def load_offset():
+  return {'offset':1000}
+
+def add_worker_offset(i):
+  return i+workerpool.get_worker_state()['offset']
+
+def record_teardown(directory,state):
+  open(os.path.join(directory,str(os.getpid())),'w').close()
+
+def look_up(key,table,reference):
+  return table.value[key],reference.view()[key]
+
+def worker_name(key):
+  time.sleep(0.01)
+  return workerpool.multiprocessing.current_process().name
+
+def private_memory_after_look_up(key,table):
+  getattr(table,'value',table)[key]
+  return psutil.Process().memory_full_info().uss
+
+def hold_exclusively(lock_dir,i):
+  # Fails if another task holds the lock file at the same time
+  path = os.path.join(lock_dir,'lock')
+  os.close(os.open(path,os.O_CREAT|os.O_EXCL))
+  time.sleep(0.02)
+  os.unlink(path)
+  return i
+
+class NicenessController(controller.CommandLineCaller):
+  resource_classes = ('background',)
+  
+  def __init__(self,val,**kwargs):
+    controller.CommandLineCaller.__init__(self,'ps -o ni= -p $$',
+                                          capture_stdout=True,**kwargs)
+  
+  def result(self):
+    return int(self.captured_stdout)
+
+class OutputController(controller.CommandLineCaller):
+  output_files = ('out.txt',)
+  
+  def __init__(self,val,**kwargs):
+    controller.CommandLineCaller.__init__(self,'printf %d > out.txt' % val,
+                                          in_tmpdir=True,**kwargs)
+
+class OutputReadingController(OutputController):
+  def result(self):
+    return self.outputs['out.txt'].read()
+
+class DyingWhenPickled(object):
+  # Kills the worker process pickling it, once
+  def __init__(self,marker):
+    self.marker = marker
+  
+  def __reduce__(self):
+    if not os.path.exists(self.marker):
+      open(self.marker,'w').close()
+      os.kill(os.getpid(),signal.SIGKILL)
+    return (str,('sent',))
+
+def die_sending_result(marker_dir,i):
+  return DyingWhenPickled(os.path.join(marker_dir,'sent')) if i == 3 else i
+
+def die_once(marker_dir,i):
+  marker = os.path.join(marker_dir,str(i))
+  if i == 3 and not os.path.exists(marker):
+    open(marker,'w').close()
+    os.kill(os.getpid(),signal.SIGKILL)
+  return i
+
+def timed_nap(i):
+  start = time.time()
+  time.sleep(0.05)
+  return start,time.time()
+
+def max_overlap(intervals):
+  return max(sum(1 for s,e in intervals if s <= t < e) for t,_ in intervals)
+
 class test_PoolManager_integration_with_multiprocessing_Pool(unittest.TestCase):
     
   def test_integration_using_seq_item_numbering(self):
@@ -560,6 +955,356 @@ class test_PoolManager_integration_with_multiprocessing_Pool(unittest.TestCase):
     for label,result in poolmanager:
       self.assertEqual(eval(label)-100,result.newval)
     
+  def test_integration_with_result_extraction(self):
+    poolmanager = workerpool.PoolManager(DummyController,xrange(4),2,
+                                         number_seq_items=True,
+                                      result_extractor=lambda c: c.newval)
+    self.assertItemsEqual(poolmanager,[(i,i+100) for i in xrange(4)])
+  
+  def test_integration_with_result_spilling(self):
+    poolmanager = workerpool.PoolManager(DummyController,xrange(4),2,
+                                         number_seq_items=True,
+                                      result_extractor=lambda c: 'x'*c.newval,
+                                         spill_threshold=102)
+    results = dict(poolmanager)
+    self.assertEqual(results[0],'x'*100)
+    self.assertEqual(results[1],'x'*101)
+    for i in [2,3]:
+      self.assertTrue(isinstance(results[i],workerpool.mapped.SpilledResult))
+      self.assertEqual(results[i].load(),'x'*(i+100))
+  
+  def test_integration_with_worker_recycling(self):
+    poolmanager = workerpool.PoolManager(DummyController,xrange(6),2,
+                                         number_seq_items=True,
+                                         maxtasksperchild=1,
+                                         preload_modules=['json'],
+                                  result_extractor=lambda c: (c.newval,
+                          workerpool.multiprocessing.current_process().name))
+    results = dict(poolmanager)
+    self.assertItemsEqual([newval for newval,_ in results.values()],
+                          range(100,106))
+    self.assertEqual(len(set(name for _,name in results.values())),6)
+  
+  def test_integration_with_progress_telemetry(self):
+    snapshots = []
+    poolmanager = workerpool.PoolManager(DummyController,range(6),2,
+                                         number_seq_items=True,
+                                         stats_callback=snapshots.append,
+                                         stats_interval=0.001)
+    for _ in poolmanager:
+      snapshot = poolmanager.snapshot()
+      self.assertTrue(snapshot['dispatched'] >= 1)
+      # Running tasks, not items dispatched ahead of the workers
+      self.assertTrue(snapshot['in_flight'] <= 2)
+    final = poolmanager.snapshot()
+    self.assertEqual((final['completed'],final['in_flight'],final['queued'],
+                      final['eta']),(6,0,0,0.0))
+    self.assertEqual(snapshots[-1]['completed'],6)
+    self.assertTrue(len(snapshots[-1]['workers']) <= 2)
+    poolmanager = workerpool.PoolManager(DummyController,[],1)
+    with self.assertRaises(ValueError):
+      poolmanager.snapshot()
+    list(poolmanager)
+  
+  def test_integration_with_tracing_and_profiling(self):
+    import json
+    import pstats
+    outdir = tempfile.mkdtemp()
+    try:
+      trace_file = os.path.join(outdir,'trace.json')
+      profile_file = os.path.join(outdir,'profile.prof')
+      poolmanager = workerpool.PoolManager(DummyController,xrange(4),2,
+                                           number_seq_items=True,
+                                           trace_file=trace_file,
+                                           profile_file=profile_file)
+      self.assertItemsEqual([label for label,_ in poolmanager],range(4))
+      with open(trace_file) as fh:
+        events = json.load(fh)['traceEvents']
+      names = [e['name'] for e in events]
+      for name in ['task','work','spawn','program run','CLI context cleanup',
+                   'worker startup','queued','result transfer']:
+        self.assertTrue(name in names,name)
+      self.assertEqual(names.count('task'),4)
+      self.assertTrue(pstats.Stats(profile_file).total_calls > 0)
+      self.assertItemsEqual(os.listdir(outdir),['trace.json','profile.prof'])
+    finally:
+      shutil.rmtree(outdir)
+  
+  def test_integration_with_resizing(self):
+    poolmanager = workerpool.PoolManager(timed_nap,xrange(6),3,resizable=True,
+                                         initial_numproc=1)
+    self.assertEqual(max_overlap(list(poolmanager)),1)
+    poolmanager = workerpool.PoolManager(timed_nap,xrange(6),2,resizable=True,
+                                         initial_numproc=1)
+    poolmanager.resize(5)
+    self.assertEqual(poolmanager.concurrency_gate.target.value,2)
+    self.assertEqual(max_overlap(list(poolmanager)),2)
+  
+  def test_integration_with_batching(self):
+    poolmanager = workerpool.PoolManager(BatchEchoController,xrange(10),2,
+                                         number_seq_items=True,batch_size=3,
+                                         batch_splitter=split_echoed_lines,
+                                         collect_stats=True)
+    results = dict(poolmanager)
+    self.assertEqual(dict((i,r[0]) for i,r in results.items()),
+                     dict((i,i+100) for i in xrange(10)))
+    self.assertEqual(len(set(pid for _,pid in results.values())),4)
+    self.assertEqual(poolmanager.snapshot()['completed'],10)
+    poolmanager = workerpool.PoolManager(sorted,['bb','a','ccc'],2,
+                                         batch_bytes=3)
+    self.assertItemsEqual(poolmanager,['a','bb','ccc'])
+  
+  def test_integration_with_failed_batch(self):
+    poolmanager = workerpool.PoolManager(BatchEchoController,['1','x','3'],1,
+                                         number_seq_items=True,batch_size=2,
+                                         batch_splitter=split_echoed_lines)
+    with self.assertRaises(ValueError):
+      list(poolmanager)
+    self.assertEqual(poolmanager.error_on_label,[0,1])
+  
+  def test_integration_with_deduplication(self):
+    poolmanager = workerpool.PoolManager(BatchEchoController,
+                                         [1,2,1,3,2,1,4],2,
+                                         number_seq_items=True,batch_size=2,
+                                         batch_splitter=split_echoed_lines,
+                                         dedup_key=True,collect_stats=True)
+    results = dict(poolmanager)
+    self.assertEqual([results[i][0] for i in xrange(7)],
+                     [101,102,101,103,102,101,104])
+    self.assertEqual(poolmanager.snapshot()['completed'],7)
+    poolmanager = workerpool.PoolManager(BatchEchoController,
+                                         [('p','x'),('q','x')],1,
+                                         labeled_items=True,batch_size=1,
+                                         batch_splitter=split_echoed_lines,
+                                         dedup_key=str)
+    with self.assertRaises(ValueError):
+      list(poolmanager)
+    self.assertEqual(poolmanager.error_on_label,['p'])
+    poolmanager = workerpool.PoolManager(abs,[-1,1,-2,2],2,dedup_key=abs)
+    self.assertEqual(sorted(poolmanager),[1,1,2,2])
+  
+  def test_integration_with_result_sink(self):
+    from cliceo import sinks
+    directory = tempfile.mkdtemp()
+    try:
+      poolmanager = workerpool.PoolManager(DummyController,xrange(6),2,
+                                           number_seq_items=True,
+                                           result_extractor=lambda c: c.newval,
+                              result_sink=sinks.ShardSink(directory,'jsonl'))
+      self.assertItemsEqual(poolmanager,[(i,None) for i in xrange(6)])
+      self.assertItemsEqual(sinks.iterate_shards(directory),
+                            [(i,i+100) for i in xrange(6)])
+      poolmanager = workerpool.PoolManager(sorted,['b','a','c'],2,batch_size=2,
+                              result_sink=sinks.ShardSink(directory,'pickle'))
+      self.assertItemsEqual(poolmanager,[None]*3)
+      self.assertItemsEqual(sinks.iterate_shards(directory,'pickle'),
+                            [(None,'a'),(None,'b'),(None,'c')])
+      # Written as they are, however large
+      shutil.rmtree(directory)
+      os.mkdir(directory)
+      poolmanager = workerpool.PoolManager(str,['x'*2000,'y'],2,
+                                           spill_threshold=1000,
+                              result_sink=sinks.ShardSink(directory,'jsonl'))
+      self.assertItemsEqual(poolmanager,[None,None])
+      self.assertItemsEqual(sinks.iterate_shards(directory),
+                            [(None,'x'*2000),(None,'y')])
+      with self.assertRaises(ValueError):
+        workerpool.PoolManager(abs,[1],1,dedup_key=True,
+                               result_sink=sinks.ShardSink(directory))
+    finally:
+      shutil.rmtree(directory)
+  
+  def test_integration_with_combiner(self):
+    import operator
+    poolmanager = workerpool.PoolManager(DummyController,xrange(10),2,
+                                         number_seq_items=True,
+                                         result_extractor=lambda c: c.newval,
+                                         combiner=operator.add,flush_every=2)
+    self.assertItemsEqual(poolmanager,[(i,None) for i in xrange(10)])
+    self.assertEqual(poolmanager.reduce(),sum(xrange(100,110)))
+    poolmanager = workerpool.PoolManager(partial(map,len),['a','bb','ccc'],2,
+                                         batch_size=2,
+                                         combiner=operator.add)
+    self.assertEqual(poolmanager.reduce(),6)
+    # Results are combined as they are and flushed combinations spilled
+    poolmanager = workerpool.PoolManager(abs,xrange(6),2,combiner=operator.add,
+                                         spill_threshold=1000)
+    self.assertEqual(poolmanager.reduce(),15)
+    poolmanager = workerpool.PoolManager(str,['x'*600,'y'*600,'z'],1,
+                                         combiner=operator.add,flush_every=2,
+                                         spill_threshold=1000)
+    self.assertEqual(sorted(poolmanager.reduce()),
+                     sorted('x'*600+'y'*600+'z'))
+    poolmanager = workerpool.PoolManager(abs,[],2,combiner=operator.add)
+    self.assertIsNone(poolmanager.reduce())
+    with self.assertRaises(ValueError):
+      workerpool.PoolManager(abs,[1],1,combiner=operator.add,dedup_key=True)
+    with self.assertRaises(ValueError):
+      workerpool.PoolManager(abs,[1],1,flush_every=2)
+    poolmanager = workerpool.PoolManager(abs,[-1],1)
+    self.assertEqual(list(poolmanager),[1])
+    with self.assertRaises(ValueError):
+      poolmanager.reduce()
+  
+  def test_integration_with_resource_classes(self):
+    lock_dir = tempfile.mkdtemp()
+    try:
+      poolmanager = workerpool.PoolManager(partial(hold_exclusively,lock_dir),
+                                           xrange(6),3,
+                                           resource_limits={'lock':1},
+                                           resource_classes=('lock',))
+      self.assertItemsEqual(poolmanager,xrange(6))
+    finally:
+      shutil.rmtree(lock_dir)
+    poolmanager = workerpool.PoolManager(NicenessController,xrange(2),2,
+                                         resource_limits={'background':2},
+                          resource_priorities={'background':{'nice':5}})
+    base = os.nice(0)
+    self.assertEqual(list(poolmanager),[base+5,base+5])
+    with self.assertRaises(ValueError):
+      workerpool.PoolManager(NicenessController,[1],1,
+                             resource_limits={'disk':1})
+    with self.assertRaises(ValueError):
+      workerpool.PoolManager(abs,[1],1,resource_classes=('disk',))
+    # Unknown class returned for one item
+    poolmanager = workerpool.PoolManager(abs,[('a',1),('b',2)],1,
+                                         labeled_items=True,
+                                         resource_limits={'disk':1},
+                        resource_classes=lambda i: ('tape',) if i == 2 else ())
+    with self.assertRaises(ValueError):
+      list(poolmanager)
+    self.assertEqual(poolmanager.error_on_label,'b')
+  
+  def test_moved_output_files_removed(self):
+    outputs_loc = tempfile.mkdtemp()
+    try:
+      # Only contents read from the files leave the workers
+      poolmanager = workerpool.PoolManager(OutputReadingController,xrange(5),
+                                           2,outputs_loc=outputs_loc)
+      self.assertItemsEqual(list(poolmanager),['0','1','2','3','4'])
+      self.assertEqual(os.listdir(outputs_loc),[])
+      # Handles sent back own the files instead
+      poolmanager = workerpool.PoolManager(OutputController,[7],1,
+                                           outputs_loc=outputs_loc)
+      caller, = list(poolmanager)
+      self.assertEqual(len(os.listdir(outputs_loc)),1)
+      self.assertEqual(caller.outputs['out.txt'].read(),'7')
+      del caller
+      self.assertEqual(os.listdir(outputs_loc),[])
+    finally:
+      shutil.rmtree(outputs_loc)
+  
+  def test_integration_with_file_sharding(self):
+    from cliceo import sharding
+    fd,path = tempfile.mkstemp()
+    try:
+      with os.fdopen(fd,'wb') as fh:
+        fh.write(''.join('%d\n' % i for i in xrange(100)))
+      poolmanager = workerpool.PoolManager(len,
+                                           sharding.FileShards(path,40),2,
+                                           map_records=True,
+                                           result_extractor=lambda n: n-1)
+      results = dict(poolmanager)
+      self.assertEqual(len(results),100)
+      with open(path) as fh:
+        for offset,ndigits in results.items():
+          fh.seek(offset)
+          self.assertEqual(len(fh.readline().strip()),ndigits)
+      with self.assertRaises(ValueError):
+        workerpool.PoolManager(len,[],1,map_records=True,batch_size=2)
+      # Failure labeled with the offset of the failing record
+      poolmanager = workerpool.PoolManager(lambda r: 1/(int(r)-42),
+                                           sharding.FileShards(path,40),2,
+                                           map_records=True)
+      with self.assertRaises(ZeroDivisionError):
+        list(poolmanager)
+      with open(path) as fh:
+        self.assertEqual(fh.read().index('42\n'),poolmanager.error_on_label)
+    finally:
+      os.unlink(path)
+  
+  def test_integration_with_worker_setup_and_teardown(self):
+    directory = tempfile.mkdtemp()
+    try:
+      poolmanager = workerpool.PoolManager(add_worker_offset,xrange(6),2,
+                                           worker_setup=load_offset,
+                            worker_teardown=partial(record_teardown,directory))
+      self.assertItemsEqual(poolmanager,range(1000,1006))
+      self.assertEqual(len(os.listdir(directory)),2)
+    finally:
+      shutil.rmtree(directory)
+  
+  def test_integration_with_broadcast(self):
+    spill_dir = tempfile.mkdtemp()
+    try:
+      poolmanager = workerpool.PoolManager(look_up,xrange(4),2,
+                                           broadcast={'table':range(10,14),
+                                                      'reference':'ACGT'},
+                                           broadcast_dir=spill_dir)
+      self.assertEqual(len(os.listdir(spill_dir)),1)
+      self.assertItemsEqual(poolmanager,zip(range(10,14),'ACGT'))
+      self.assertEqual(os.listdir(spill_dir),[])
+      with self.assertRaises(ValueError):
+        workerpool.PoolManager(look_up,[],1,broadcast={'table':[]},table=[])
+    finally:
+      os.rmdir(spill_dir)
+  
+  def test_broadcast_shared_by_workers(self):
+    rss = psutil.Process().memory_info().rss
+    table = dict((i,i) for i in xrange(500000))
+    footprint = psutil.Process().memory_info().rss-rss
+    # Against the same value passed as a plain keyword argument, broadcasting
+    # which saves nothing, but must not cost a copy per worker process either
+    plain = max(workerpool.PoolManager(private_memory_after_look_up,
+                                       xrange(4),2,table=table))
+    broadcast = max(workerpool.PoolManager(private_memory_after_look_up,
+                                           xrange(4),2,
+                                           broadcast={'table':table}))
+    self.assertTrue(abs(broadcast-plain) < footprint/4)
+  
+  def test_integration_with_affinity_keys(self):
+    keys = ['a','b']*10
+    poolmanager = workerpool.PoolManager(worker_name,keys,2,
+                                         number_seq_items=True,
+                                         affinity_key=lambda key: key)
+    results = dict(poolmanager)
+    self.assertEqual(len(results),20)
+    names_by_key = dict((key,[results[i] for i in xrange(20)
+                              if keys[i] == key]) for key in 'ab')
+    # Each key is handled mostly by the worker its queue belongs to
+    for key,names in names_by_key.items():
+      self.assertTrue(max(names.count(name) for name in names) >= 6,key)
+    with self.assertRaises(ValueError):
+      workerpool.PoolManager(worker_name,keys,2,affinity_key=len,batch_size=2)
+  
+  def test_integration_with_worker_loss_recovery(self):
+    marker_dir = tempfile.mkdtemp()
+    try:
+      poolmanager = workerpool.PoolManager(partial(die_once,marker_dir),
+                                           xrange(6),2,pin_workers=True,
+                                           worker_loss_policy='retry',
+                                           worker_check_interval=0.05)
+      self.assertItemsEqual(poolmanager,range(6))
+      os.unlink(os.path.join(marker_dir,'3'))
+      poolmanager = workerpool.PoolManager(partial(die_once,marker_dir),
+                                           xrange(6),2,number_seq_items=True,
+                                           worker_loss_policy='fail',
+                                           worker_check_interval=0.05)
+      with self.assertRaises(workerpool.WorkerLostError):
+        list(poolmanager)
+      self.assertEqual(poolmanager.error_on_label,3)
+      # Dying after the task finished, while sending its result
+      poolmanager = workerpool.PoolManager(partial(die_sending_result,
+                                                   marker_dir),
+                                           xrange(6),2,
+                                           worker_loss_policy='retry',
+                                           worker_check_interval=0.05)
+      self.assertItemsEqual(poolmanager,[0,1,2,'sent',4,5])
+      with self.assertRaises(ValueError):
+        workerpool.PoolManager(abs,[],1,worker_loss_policy='ignore')
+    finally:
+      shutil.rmtree(marker_dir)
+  
   def test_integration_using_next_to_iterate(self):
     poolmanager = workerpool.PoolManager(DummyController,xrange(4),2,
                                          labeled_items=True)